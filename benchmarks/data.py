@@ -0,0 +1,76 @@
+import math
+import random
+import string
+
+from motor.motor_asyncio import AsyncIOMotorClient
+
+
+def _text(rng: random.Random, length: int) -> str:
+    return "".join(rng.choices(string.ascii_letters, k=length))
+
+
+def flat_document(rng: random.Random, index: int, fields: int = 16, payload: int = 32) -> dict:
+    document = {"_id": index, "updatedAt": index}
+    for field in range(fields):
+        document[f"field{field}"] = rng.randint(0, 1_000_000) if field % 2 == 0 else _text(rng, payload)
+    return document
+
+
+def nested_document(rng: random.Random, index: int, fields: int = 16, payload: int = 32) -> dict:
+    return {
+        "_id": index,
+        "updatedAt": index,
+        "owner": {
+            "name": _text(rng, payload),
+            "address": {"city": _text(rng, 12), "zip": rng.randint(10_000, 99_999)},
+        },
+        "tags": [_text(rng, 8) for _ in range(rng.randint(0, 8))],
+        "history": [{"at": index - step, "value": rng.random()} for step in range(fields)],
+    }
+
+
+def geojson_lot(rng: random.Random, index: int, fields: int = 16, payload: int = 32) -> dict:
+    # Modelled on the lots of dummy/cityscape_geo_postprocessing.py: polygons with a few self intersecting ones,
+    # and properties that are frequently null.
+    x, y = rng.uniform(-180, 170), rng.uniform(-80, 70)
+    radius = rng.uniform(0.0001, 0.01)
+    vertices = max(4, fields)
+    ring = list()
+    for vertex in range(vertices):
+        angle = 2 * math.pi * vertex / vertices
+        jitter = rng.uniform(0.8, 1.2)
+        ring.append([x + math.cos(angle) * radius * jitter, y + math.sin(angle) * radius * jitter])
+    if rng.random() < 0.1:
+        ring[0], ring[1] = ring[1], ring[0]
+    ring.append(ring[0])
+    properties = dict()
+    for field in range(8):
+        properties[f"attribute{field}"] = None if rng.random() < 0.4 else _text(rng, payload // 4 + 1)
+    return {
+        "_id": index,
+        "updatedAt": index,
+        "type": "Feature",
+        "geometry": {"type": "Polygon", "coordinates": [ring]},
+        "properties": properties,
+    }
+
+
+SHAPES = {
+    "flat": flat_document,
+    "nested": nested_document,
+    "geojson": geojson_lot,
+}
+
+
+async def seed_collection(client: AsyncIOMotorClient, database: str, collection: str, count: int, shape: str,
+                          seed: int = 0, fields: int = 16, payload: int = 32, batch_size: int = 1000):
+    if shape not in SHAPES:
+        raise Exception(f"Unknown document shape {shape}, expected one of {', '.join(SHAPES)}")
+    # Same seed, same documents, so runs on different revisions read identical data.
+    rng = random.Random(f"{seed}-{collection}")
+    generate = SHAPES[shape]
+    target = client.get_database(database).get_collection(collection)
+    await target.drop()
+    for start in range(0, count, batch_size):
+        batch = [generate(rng, index, fields, payload) for index in range(start, min(count, start + batch_size))]
+        await target.insert_many(batch, ordered=False)
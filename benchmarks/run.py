@@ -0,0 +1,240 @@
+import argparse
+import asyncio
+import json
+import platform
+import resource
+import statistics
+import subprocess
+import sys
+import tempfile
+import time
+from datetime import datetime, timezone
+from pathlib import Path
+from typing import Optional
+
+ROOT = Path(__file__).absolute().parent.parent
+if str(ROOT) not in sys.path:
+    sys.path.append(str(ROOT))
+
+from benchmarks.data import SHAPES, seed_collection
+from benchmarks.workloads import DATABASE, WORKLOADS
+from mongrations.engine.asyncio_engine import AsyncIOEngine
+from mongrations.loading import load_mongration
+from mongrations.metrics import MetricsRegistry
+from mongrations.settings import DEFAULT_URI, Settings
+
+
+def create_client_factory(in_process: bool):
+    if not in_process:
+        from motor.motor_asyncio import AsyncIOMotorClient
+        return AsyncIOMotorClient
+    try:
+        from mongomock_motor import AsyncMongoMockClient
+    except ImportError:
+        raise Exception("--in-process requires the mongomock-motor package, install benchmarks/requirements.txt or "
+                        "point --uri at a mongod")
+    # The stand-in keeps its data in the client, seeding and the run must share one.
+    client = AsyncMongoMockClient()
+    return lambda uri: client
+
+
+def peak_rss_mb() -> tuple[float, float]:
+    # Linux reports kilobytes, macOS bytes. Children are the process executor workers.
+    scale = 1 if sys.platform == "darwin" else 1024
+    own = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss * scale / 2 ** 20
+    children = resource.getrusage(resource.RUSAGE_CHILDREN).ru_maxrss * scale / 2 ** 20
+    return own, children
+
+
+def _stage(phase: dict) -> dict:
+    return {
+        "phase": phase["phase"],
+        "seconds": phase["seconds"],
+        "documents_read": phase["documents_read"],
+        "documents_written": phase["documents_written"],
+        "fetch_p50": phase["fetch_latency"]["p50"],
+        "fetch_p99": phase["fetch_latency"]["p99"],
+        "callback_p50": phase["callback_latency"]["p50"],
+        "callback_p99": phase["callback_latency"]["p99"],
+        "write_p50": phase["write_latency"]["p50"],
+        "write_p99": phase["write_latency"]["p99"],
+        "queue_depth_max": phase["queue_depth"]["max"],
+    }
+
+
+async def _prepare(client, workload, args):
+    await client.drop_database(DATABASE)
+    for collection in workload.inputs:
+        await seed_collection(client, DATABASE, collection, args.documents, workload.shape or args.shape, args.seed,
+                              args.fields, args.payload)
+
+
+def seed_case(args):
+    client = create_client_factory(False)(args.uri)
+    asyncio.run(_prepare(client, WORKLOADS[args.case], args))
+    client.close()
+
+
+def run_case(args) -> dict:
+    workload = WORKLOADS[args.case]
+    client_factory = create_client_factory(args.in_process)
+    if args.in_process:
+        # The stand-in keeps the documents in this process, they count towards its peak RSS whoever seeds them.
+        asyncio.run(_prepare(client_factory(args.uri), workload, args))
+
+    registry = MetricsRegistry(workload.name)
+    settings = Settings(uri=args.uri, namespace=f"benchmark-{workload.name}")
+    engine = AsyncIOEngine(settings, client_factory, registry)
+    start = time.perf_counter()
+    engine.invoke(lambda: load_mongration(workload.mongration(args.executor), fuse=workload.fuse))
+    seconds = time.perf_counter() - start
+
+    own_rss, children_rss = peak_rss_mb()
+    documents = args.documents * len(workload.inputs)
+    report = json.loads(registry.to_json())
+    return {
+        "workload": workload.name,
+        "documents": documents,
+        "seconds": seconds,
+        "docs_per_second": documents / seconds,
+        "peak_rss_mb": own_rss,
+        "peak_worker_rss_mb": children_rss,
+        "stages": [_stage(phase) for phase in report["phases"]],
+    }
+
+
+def _case_arguments(args, workload: str, output: Optional[str]) -> list[str]:
+    arguments = [
+        sys.executable, "-m", "benchmarks.run", "--case", workload,
+        "--documents", str(args.documents), "--shape", args.shape, "--fields", str(args.fields),
+        "--payload", str(args.payload), "--seed", str(args.seed), "--uri", args.uri,
+    ]
+    if args.executor is not None:
+        arguments.extend(["--executor", args.executor])
+    if args.in_process:
+        arguments.append("--in-process")
+    if output is None:
+        arguments.append("--seed-only")
+    else:
+        arguments.extend(["--case-output", output])
+    return arguments
+
+
+def _git_revision():
+    try:
+        return subprocess.run(["git", "rev-parse", "HEAD"], cwd=ROOT, capture_output=True, text=True).stdout.strip()
+    except OSError:
+        return None
+
+
+def run_suite(args) -> dict:
+    runs = list()
+    for workload in args.workloads.split(","):
+        if workload not in WORKLOADS:
+            raise Exception(f"Unknown workload {workload}, expected one of {', '.join(WORKLOADS)}")
+        for repetition in range(args.repeat):
+            # Every case runs in a fresh interpreter, otherwise peak RSS would carry over from the previous one. The
+            # generated documents are seeded from yet another one, they would count towards it too.
+            if not args.in_process:
+                process = subprocess.run(_case_arguments(args, workload, None), cwd=ROOT)
+                if process.returncode != 0:
+                    runs.append({"workload": workload, "repetition": repetition, "error": process.returncode})
+                    continue
+            with tempfile.NamedTemporaryFile(suffix=".json") as output:
+                process = subprocess.run(_case_arguments(args, workload, output.name), cwd=ROOT)
+                if process.returncode != 0:
+                    runs.append({"workload": workload, "repetition": repetition, "error": process.returncode})
+                    continue
+                result = json.loads(Path(output.name).read_text())
+            result["repetition"] = repetition
+            runs.append(result)
+
+    summary = dict()
+    for workload in args.workloads.split(","):
+        rates = [run["docs_per_second"] for run in runs if run["workload"] == workload and "error" not in run]
+        if len(rates) > 0:
+            summary[workload] = {"docs_per_second": statistics.median(rates), "runs": len(rates)}
+    return {
+        "started": datetime.now(timezone.utc).isoformat(),
+        "revision": _git_revision(),
+        "python": platform.python_version(),
+        "platform": platform.platform(),
+        "backend": "in-process" if args.in_process else args.uri,
+        "config": {
+            "documents": args.documents, "shape": args.shape, "fields": args.fields, "payload": args.payload,
+            "seed": args.seed, "executor": args.executor, "repeat": args.repeat,
+        },
+        "summary": summary,
+        "runs": runs,
+    }
+
+
+def print_results(results: dict, baseline: dict = None):
+    for run in results["runs"]:
+        if "error" in run:
+            print(f"{run['workload']} #{run['repetition']}: failed with exit code {run['error']}")
+            continue
+        print(f"{run['workload']} #{run['repetition']}: {run['docs_per_second']:.0f} docs/s, "
+              f"{run['seconds']:.2f} seconds, peak RSS {run['peak_rss_mb']:.0f} MiB "
+              f"(workers {run['peak_worker_rss_mb']:.0f} MiB)")
+        for stage in run["stages"]:
+            latencies = list()
+            for kind in ("fetch", "callback", "write"):
+                if stage[f"{kind}_p50"] is not None:
+                    latencies.append(f"{kind} p50 {stage[f'{kind}_p50'] * 1000:.1f}ms / "
+                                     f"p99 {stage[f'{kind}_p99'] * 1000:.1f}ms")
+            print(f"  {stage['phase']}: {', '.join(latencies)}")
+    if baseline is None:
+        return
+    print(f"Compared to {baseline.get('revision')} from {baseline.get('started')}:")
+    for workload, current in results["summary"].items():
+        previous = baseline.get("summary", dict()).get(workload)
+        if previous is None:
+            continue
+        change = (current["docs_per_second"] / previous["docs_per_second"] - 1) * 100
+        print(f"  {workload}: {previous['docs_per_second']:.0f} -> {current['docs_per_second']:.0f} docs/s "
+              f"({change:+.1f}%)")
+
+
+def main():
+    parser = argparse.ArgumentParser(description='Benchmarks mongrations on synthetic collections.')
+    parser.add_argument('--workloads', type=str, default=",".join(WORKLOADS),
+                        help=f'Comma separated workloads to run, out of {", ".join(WORKLOADS)}.')
+    parser.add_argument('--documents', type=int, default=100_000, help='Documents seeded into every input collection.')
+    parser.add_argument('--shape', type=str, default="flat", choices=list(SHAPES),
+                        help='Shape of the seeded documents, the geojson workload always uses geojson.')
+    parser.add_argument('--fields', type=int, default=16, help='Fields per document, vertices for geojson.')
+    parser.add_argument('--payload', type=int, default=32, help='Length of the generated strings.')
+    parser.add_argument('--seed', type=int, default=0, help='Seed of the document generator.')
+    parser.add_argument('--executor', type=str, default=None, help='Executor of the python phases, thread or process.')
+    parser.add_argument('--repeat', type=int, default=3, help='Runs of every workload, the summary keeps the median.')
+    parser.add_argument('--uri', type=str, default=DEFAULT_URI, help='MongoDB the benchmark database is created in.')
+    parser.add_argument('--in-process', action='store_true',
+                        help='Run against mongomock-motor instead of a mongod. Not every workload is supported.')
+    parser.add_argument('--output', type=str, default=None,
+                        help='Results file, defaults to benchmarks/results/<timestamp>.json.')
+    parser.add_argument('--compare', type=str, default=None, help='Previous results file to compare docs/s against.')
+    parser.add_argument('--case', type=str, default=None, help=argparse.SUPPRESS)
+    parser.add_argument('--case-output', type=str, default=None, help=argparse.SUPPRESS)
+    parser.add_argument('--seed-only', action='store_true', help=argparse.SUPPRESS)
+    args = parser.parse_args()
+
+    if args.seed_only:
+        seed_case(args)
+        return
+    if args.case is not None:
+        Path(args.case_output).write_text(json.dumps(run_case(args)))
+        return
+
+    results = run_suite(args)
+    output = Path(args.output) if args.output is not None else (
+            ROOT / "benchmarks" / "results" / f"{datetime.now().strftime('%Y%m%d-%H%M%S')}.json")
+    output.parent.mkdir(parents=True, exist_ok=True)
+    output.write_text(json.dumps(results, indent=2))
+    baseline = json.loads(Path(args.compare).read_text()) if args.compare is not None else None
+    print_results(results, baseline)
+    print(f"Results written to {output}")
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,152 @@
+from typing import Callable, Optional
+
+from dummy.cityscape_geo_postprocessing import compute_area, correct_polygon, remove_null_properties
+from mongrations.mongration import Mongration
+
+DATABASE = "mongrations-benchmark"
+
+
+# Callbacks live at module level so the process executor can pickle them.
+def add_checksum(doc):
+    doc["checksum"] = sum(len(str(value)) for value in doc.values())
+    return doc
+
+
+def normalize(doc):
+    for key, value in doc.items():
+        if isinstance(value, str):
+            doc[key] = value.lower()
+    return doc
+
+
+def stamp(doc):
+    doc["migrated"] = True
+    return doc
+
+
+class Workload:
+    def __init__(self, name: str, inputs: list[str], shape: Optional[str],
+                 build: Callable[[Mongration, Optional[str]], None], fuse: bool = True):
+        self.name = name
+        # Collections seeded before the run, every one of them with the configured document count.
+        self.inputs = inputs
+        # Document shape the workload needs regardless of the command line, None uses the configured one.
+        self.shape = shape
+        # Workloads measuring the pipes between phases must not have them fused into a single phase.
+        self.fuse = fuse
+        self._build = build
+
+    def mongration(self, executor: Optional[str]):
+        return lambda mongration: self._build(mongration, executor)
+
+
+def _single(mongration: Mongration, executor):
+    phase = mongration.phase("Checksum")
+    phase.from_collection(DATABASE, "input")
+    phase.use_python(add_checksum, executor=executor)
+    phase.into_collection(DATABASE, "out-single", mode="insert")
+
+
+def _stamp(raw: bool):
+    # Touches a single field, raw documents are written back without decoding the others.
+    def build(mongration: Mongration, executor):
+        phase = mongration.phase("Stamp")
+        phase.from_collection(DATABASE, "input", raw=raw)
+        phase.use_python(stamp, executor=executor)
+        phase.into_collection(DATABASE, "out-stamp", mode="insert")
+
+    return build
+
+
+def _chain(mongration: Mongration, executor):
+    checksum = mongration.phase("Checksum")
+    checksum.from_collection(DATABASE, "input")
+    checksum.use_python(add_checksum, executor=executor)
+
+    normalized = mongration.phase("Normalize")
+    normalized.from_phase(checksum)
+    normalized.use_python(normalize, executor=executor)
+
+    stamped = mongration.phase("Stamp")
+    stamped.from_phase(normalized)
+    stamped.use_python(stamp, executor=executor)
+    stamped.into_collection(DATABASE, "out-chain", mode="insert")
+
+
+def _aggregation_python(mongration: Mongration, executor):
+    recent = mongration.phase("Select recent")
+    recent.from_collection(DATABASE, "input")
+    recent.use_aggregation([
+        {"$match": {"updatedAt": {"$mod": [2, 0]}}},
+        {"$addFields": {"half": {"$divide": ["$updatedAt", 2]}}},
+    ])
+
+    stamped = mongration.phase("Stamp")
+    stamped.from_phase(recent)
+    stamped.use_python(stamp, executor=executor)
+    stamped.into_collection(DATABASE, "out-aggregation-python", mode="insert")
+
+
+def _fan_in(mongration: Mongration, executor):
+    left = mongration.phase("Checksum left")
+    left.from_collection(DATABASE, "input-left")
+    left.use_python(add_checksum, executor=executor)
+    left.into_collection(DATABASE, "fan-in-left", mode="insert")
+
+    right = mongration.phase("Checksum right")
+    right.from_collection(DATABASE, "input-right")
+    right.use_python(add_checksum, executor=executor)
+    right.into_collection(DATABASE, "fan-in-right", mode="insert")
+
+    combined = mongration.phase("Combine")
+    combined.from_phase(left)
+    combined.from_phase(right)
+    combined.use_aggregation([{"$project": {"_id": 0, "updatedAt": 1, "checksum": 1}}])
+    combined.into_collection(DATABASE, "out-fan-in", mode="insert")
+
+
+def _materialized(mongration: Mongration, executor):
+    # Both dependants read the checksummed documents back from local segments, not from a temporary collection.
+    checksum = mongration.phase("Checksum")
+    checksum.from_collection(DATABASE, "input")
+    checksum.use_python(add_checksum, executor=executor)
+    checksum.into_temporary()
+
+    normalized = mongration.phase("Normalize")
+    normalized.from_phase(checksum)
+    normalized.use_python(normalize, executor=executor)
+    normalized.into_collection(DATABASE, "out-materialized-normalized", mode="insert")
+
+    stamped = mongration.phase("Stamp")
+    stamped.from_phase(checksum)
+    stamped.use_python(stamp, executor=executor)
+    stamped.into_collection(DATABASE, "out-materialized-stamped", mode="insert")
+
+
+def _geojson(mongration: Mongration, executor):
+    corrected = mongration.phase("Remove intersecting GeoJSON objects")
+    corrected.from_collection(DATABASE, "input")
+    corrected.use_python(correct_polygon, executor=executor)
+
+    cleaned = mongration.phase("Cleanup Properties")
+    cleaned.from_phase(corrected)
+    cleaned.use_python(remove_null_properties, executor=executor)
+
+    area = mongration.phase("Append geometry area to properties")
+    area.from_phase(cleaned)
+    area.use_python(compute_area, executor=executor)
+    area.into_collection(DATABASE, "out-geojson", mode="insert")
+
+
+WORKLOADS = {
+    workload.name: workload for workload in [
+        Workload("single", ["input"], None, _single),
+        Workload("stamp", ["input"], None, _stamp(False)),
+        Workload("stamp-raw", ["input"], None, _stamp(True)),
+        Workload("chain", ["input"], None, _chain, fuse=False),
+        Workload("aggregation-python", ["input"], None, _aggregation_python),
+        Workload("fan-in", ["input-left", "input-right"], None, _fan_in),
+        Workload("materialized", ["input"], None, _materialized),
+        Workload("geojson", ["input"], "geojson", _geojson),
+    ]
+}
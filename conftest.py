@@ -0,0 +1 @@
+# Puts the repository root on sys.path, so the tests import the mongrations package from the checkout.
@@ -49,14 +49,14 @@ def identity(doc):
 def mongration(mongration: Mongration):
     remote_intersecting_geo_objs = mongration.phase("Remove intersecting GeoJSON objects")
     remote_intersecting_geo_objs.from_collection("lots", "geojson")
-    remote_intersecting_geo_objs.use_python(correct_polygon)
+    remote_intersecting_geo_objs.use_python(correct_polygon, executor="process")
 
     clean_up = mongration.phase("Cleanup Properties")
     clean_up.from_phase(remote_intersecting_geo_objs)
-    clean_up.use_python(remove_null_properties)
+    clean_up.use_python(remove_null_properties, executor="process")
 
 
     append_area = mongration.phase("Append geometry area to properties")
     append_area.from_phase(clean_up)
-    append_area.use_python(compute_area)
+    append_area.use_python(compute_area, executor="process")
     append_area.into_collection("lots", "geometry")
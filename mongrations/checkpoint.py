@@ -0,0 +1,84 @@
+import time
+from typing import Optional
+
+from mongrations.io.collection_destination import CollectionDestination, WriteMode
+from mongrations.io.segments import SegmentStore
+from mongrations.state import StateStore
+
+
+class PhaseCheckpoint:
+    def __init__(self, store: StateStore, key: str, interval: float):
+        self._store = store
+        self._key = key
+        self._interval = interval
+        self._last_save = time.monotonic()
+
+    def due(self) -> bool:
+        return time.monotonic() - self._last_save >= self._interval
+
+    async def save(self, source_state: Optional[dict]):
+        await self._store.save(self._key, {"complete": False, "source": source_state})
+        self._last_save = time.monotonic()
+
+
+class Checkpointer:
+    def __init__(self, store: StateStore, namespace: str, interval: float):
+        self._store = store
+        self._namespace = namespace
+        self._interval = interval
+        self._restarted = set()
+
+    def _key(self, phase):
+        return f"{self._namespace}:checkpoint:{phase.name()}"
+
+    def tracks_completion(self, phase) -> bool:
+        # Segments live in a directory of their own run, a phase writing them has to run again to bring them back.
+        destination = phase.destination()
+        return destination is None or not any(isinstance(branch, SegmentStore) for branch in destination.branches())
+
+    def tracks_progress(self, phase) -> bool:
+        # A pipe's consumer needs every document again, only phases writing straight into a collection resume midway.
+        source = phase.source()
+        return (
+            isinstance(phase.destination(), CollectionDestination)
+            and source is not None
+            and source.resumable()
+            and phase.operation().supports_checkpoints()
+        )
+
+    async def restore(self, phases) -> bool:
+        # Phases streaming into each other run as one group, the group is skipped or run again as a whole. Skipping
+        # only the consumer of a pipe would leave its producer blocked on a pipe nobody reads.
+        states = [await self._store.load(self._key(phase)) for phase in phases]
+        if all(state is not None and state.get("complete") and self.tracks_completion(phase)
+               for phase, state in zip(phases, states)):
+            return True
+        for phase, state in zip(phases, states):
+            if state is None:
+                # Marks the phase as started, the next run knows its destinations may already hold some documents.
+                await self._store.save(self._key(phase), {"complete": False, "source": None})
+            else:
+                self._restarted.add(phase)
+            if self.tracks_progress(phase):
+                phase.source().resume(None if state is None or state.get("complete") else state.get("source"))
+                phase.use_checkpoint(PhaseCheckpoint(self._store, self._key(phase), self._interval))
+        return False
+
+    def rewrite_modes(self, phase):
+        # Applied once the phase is about to run, a coordinator keeps groups writing with mode insert to itself.
+        if phase not in self._restarted or phase.destination() is None:
+            return
+        for branch in phase.destination().branches():
+            if isinstance(branch, CollectionDestination) and branch.mode == WriteMode.INSERT:
+                # Documents the interrupted run wrote are written again, plain inserts would fail on their _id.
+                if not branch.temporary:
+                    print(f"{branch} was partly written by an interrupted run, writing into it with mode replace.")
+                branch.mode = WriteMode.REPLACE
+
+    async def complete(self, phase):
+        await self._store.save(self._key(phase), {"complete": True})
+
+    async def clear(self, phases):
+        for phase in phases:
+            await self._store.clear(self._key(phase))
+
@@ -0,0 +1,140 @@
+from bson import json_util
+from motor.motor_asyncio import AsyncIOMotorClient
+
+from mongrations.engine.scheduler import streams_into
+from mongrations.graph import DependencyGraph
+from mongrations.io.collection_destination import CollectionDestination
+from mongrations.io.memory import MemoryCollection
+from mongrations.io.segments import SegmentStore
+from mongrations.io.source import CollectionSource
+from mongrations.operations.aggregation_operation import AggregationOperation
+from mongrations.phase import Phase
+
+SAMPLE_OUTPUT_CHARACTERS = 240
+
+
+class DryRun:
+    # Runs the whole graph on a $sample of every root collection. Collection destinations, temporary ones included,
+    # are swapped for in-memory collections, so nothing is written to the server.
+    def __init__(self, graph: DependencyGraph[Phase], sample: int):
+        self.sample = sample
+        self._graph = graph
+        self._sampled = dict[Phase, list[CollectionSource]]()
+        self._memories = list[MemoryCollection]()
+        self._segments = list[SegmentStore]()
+        self._results = dict[Phase, tuple[float, int]]()
+
+    def prepare(self):
+        graph = self._graph
+        for index in graph.topological_order():
+            phase = graph[index]
+            if len(phase.dependencies()) == 0:
+                sources = [source for source in phase.sources() if isinstance(source, CollectionSource)]
+                for source in sources:
+                    source.use_sample(self.sample)
+                self._sampled[phase] = sources
+            if isinstance(phase.operation(), AggregationOperation):
+                phase.operation().without_output()
+            destination = phase.destination()
+            if destination is None:
+                continue
+            for branch in destination.branches():
+                if isinstance(branch, CollectionDestination):
+                    self._swap(graph, index, branch)
+                elif isinstance(branch, SegmentStore):
+                    self._segments.append(branch)
+
+    def _swap(self, graph: DependencyGraph[Phase], index: int, destination: CollectionDestination):
+        phase = graph[index]
+        memory = MemoryCollection(destination.database, destination.collection)
+        self._memories.append(memory)
+        if phase.destination() is destination:
+            phase.replace_destination(memory)
+        else:
+            phase.destination().replace_branch(destination, memory)
+        for dependant_index in graph.dependants_on(index):
+            dependant = graph[dependant_index]
+            for source in dependant.sources():
+                if (isinstance(source, CollectionSource) and source.database == memory.database
+                        and source.collection == memory.collection):
+                    dependant.replace_source(source, memory.reader_like(source))
+
+    def discard(self):
+        # Local segments hold nothing but the sample, they are deleted although the finalizers do not run.
+        for segments in self._segments:
+            segments.discard()
+
+    async def count_sources(self, client: AsyncIOMotorClient):
+        for sources in self._sampled.values():
+            for source in sources:
+                await source.estimate_total(client)
+
+    def record(self, phase: Phase, seconds: float, documents: int):
+        self._results[phase] = (seconds, documents)
+
+    def _scales(self) -> dict[Phase, float]:
+        # How much bigger the full run is than the sample, phases inherit the biggest ratio among their inputs.
+        graph = self._graph
+        scales = dict()
+        for index in graph.topological_order():
+            phase = graph[index]
+            scale = 1.0
+            for source in self._sampled.get(phase, []):
+                if source.full_count:
+                    scale = max(scale, source.full_count / max(1, min(self.sample, source.full_count)))
+            for dependency in graph.dependencies_of(index):
+                scale = max(scale, scales[graph[dependency]])
+            scales[phase] = scale
+        return scales
+
+    def _projected_wall_clock(self, scales: dict[Phase, float]) -> float:
+        # A phase reading a materialized output starts once it is complete, one reading a pipe runs alongside
+        # its producer and cannot finish before it.
+        graph = self._graph
+        finish = dict()
+        for index in graph.topological_order():
+            phase = graph[index]
+            seconds, _ = self._results.get(phase, (0.0, 0))
+            start, floor = 0.0, 0.0
+            for dependency in graph.dependencies_of(index):
+                if streams_into(graph[dependency], phase):
+                    floor = max(floor, finish[dependency])
+                else:
+                    start = max(start, finish[dependency])
+            finish[index] = max(start + seconds * scales[phase], floor)
+        return max(finish.values(), default=0.0)
+
+    def report(self) -> list[str]:
+        scales = self._scales()
+        lines = [f"Dry run on a sample of up to {self.sample} documents per source collection, nothing was written:"]
+        for index in self._graph.topological_order():
+            phase = self._graph[index]
+            if phase not in self._results:
+                continue
+            seconds, documents = self._results[phase]
+            rate = documents / seconds if seconds > 0 else 0.0
+            scale = scales[phase]
+            lines.append(
+                f"  {phase.name()}: {documents} docs in {seconds:.2f}s ({rate:.0f} docs/s), "
+                f"projected ~{documents * scale:.0f} docs in {_duration(seconds * scale)}"
+            )
+        lines.append(f"Projected wall clock for the full run: {_duration(self._projected_wall_clock(scales))}")
+        for memory in self._memories:
+            if len(memory.documents) == 0:
+                lines.append(f"  {memory} received no documents")
+                continue
+            sample = json_util.dumps(memory.documents[0])
+            if len(sample) > SAMPLE_OUTPUT_CHARACTERS:
+                sample = sample[:SAMPLE_OUTPUT_CHARACTERS] + "..."
+            lines.append(f"  First document of {memory}: {sample}")
+        return lines
+
+
+def _duration(seconds: float) -> str:
+    if seconds < 60:
+        return f"{seconds:.1f}s"
+    minutes, seconds = divmod(int(seconds), 60)
+    if minutes < 60:
+        return f"{minutes}m {seconds}s"
+    hours, minutes = divmod(minutes, 60)
+    return f"{hours}h {minutes}m"
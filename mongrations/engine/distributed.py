@@ -0,0 +1,345 @@
+import asyncio
+import os
+import socket
+import subprocess
+import sys
+import time
+from pathlib import Path
+from typing import Awaitable, Callable, Optional
+
+from bson import ObjectId
+from motor.motor_asyncio import AsyncIOMotorClient
+from pymongo import ReturnDocument, UpdateOne
+
+from mongrations.engine.scheduler import PhaseScheduler
+from mongrations.graph import DependencyGraph
+from mongrations.io.collection_destination import CollectionDestination, WriteMode
+from mongrations.io.partitioning import compute_boundaries, partition_filters
+from mongrations.io.segments import SegmentStore
+from mongrations.io.source import CollectionSource
+from mongrations.operations.join_operation import JoinOperation
+from mongrations.operations.python_operation import PythonOperation
+from mongrations.phase import Phase
+from mongrations.state import STATE_DATABASE
+
+LEASE_COLLECTION = "mongration-leases"
+POLL_SECONDS = 1.0
+
+
+def default_worker_id() -> str:
+    return f"{socket.gethostname()}:{os.getpid()}"
+
+
+def _entries(graph: DependencyGraph[Phase], members: list[int]) -> list[int]:
+    # Phases of a group that read nothing streamed from inside of it.
+    inside = set(members)
+    return [index for index in members if not any(dependency in inside for dependency in graph.dependencies_of(index))]
+
+
+def distributable(graph: DependencyGraph[Phase], members: list[int]) -> Optional[Phase]:
+    # A group can be split when it streams out of a single collection through python callbacks only. Aggregations
+    # run on whole collections and joins need every key of their inputs, they stay on the coordinator.
+    entries = _entries(graph, members)
+    if len(entries) != 1:
+        return None
+    entry = graph[entries[0]]
+    sources = entry.sources()
+    if len(sources) != 1 or not isinstance(sources[0], CollectionSource):
+        return None
+    source = sources[0]
+    if not source.resumable() or source.watermark is not None or source.live:
+        return None
+    for index in members:
+        phase = graph[index]
+        operation = phase.operation()
+        if not isinstance(operation, PythonOperation) or isinstance(operation, JoinOperation):
+            return None
+        # Segments live on the disk of whoever writes them, the coordinator could not read them back.
+        if phase.destination() is not None and any(isinstance(branch, SegmentStore)
+                                                   for branch in phase.destination().branches()):
+            return None
+    if _inserts(graph, members):
+        return None
+    return entry
+
+
+def _inserts(graph: DependencyGraph[Phase], members: list[int]) -> bool:
+    # An expired lease is run again from the start of its partition. Inserts would fail on the documents already
+    # written, and replacing them needs an _id the callbacks may not emit.
+    for index in members:
+        destination = graph[index].destination()
+        if destination is not None and any(isinstance(branch, CollectionDestination) and
+                                           branch.mode == WriteMode.INSERT for branch in destination.branches()):
+            return True
+    return False
+
+
+class _LeaseProgress:
+    # Stands in for the progress bar of a phase run by a worker, the count is reported with every heartbeat.
+    def __init__(self):
+        self.total = None
+        self.n = 0
+
+    def update(self, n=1):
+        self.n += n
+
+    def set_postfix_str(self, text, refresh=True):
+        pass
+
+    def set_description(self, text):
+        pass
+
+    def display(self, text):
+        pass
+
+
+class _Leases:
+    def __init__(self, client: AsyncIOMotorClient, namespace: str):
+        self.namespace = namespace
+        self.collection = client.get_database(STATE_DATABASE).get_collection(LEASE_COLLECTION)
+        self.control_id = f"{namespace}:control"
+
+    def group_id(self, name: str) -> str:
+        return f"{self.namespace}:{name}"
+
+    def partitions(self, name: str) -> dict:
+        return {"namespace": self.namespace, "kind": "partition", "group": name}
+
+
+class Coordinator:
+    # Splits every distributable group of phases into ranges of its source and records one lease per range. Workers,
+    # local processes it spawns or processes started on other hosts, claim the leases. Groups it cannot split run
+    # here, the way the engine runs them without workers.
+    def __init__(self, client: AsyncIOMotorClient, settings, graph: DependencyGraph[Phase]):
+        self._client = client
+        self._settings = settings
+        self._graph = graph
+        self._leases = _Leases(client, settings.namespace)
+        self._run = ObjectId()
+        self._processes = list[subprocess.Popen]()
+        self._progress = None
+
+    def use_progress(self, progress_bars: list):
+        self._progress = progress_bars
+
+    def _partition_count(self) -> int:
+        if self._settings.partitions is not None:
+            return self._settings.partitions
+        # A few ranges per worker, so a slow one does not hold the whole group back.
+        return max(1, self._settings.workers) * 4
+
+    async def start(self):
+        collection = self._leases.collection
+        await collection.create_index([("namespace", 1), ("kind", 1), ("state", 1)])
+        await collection.replace_one({"_id": self._leases.control_id}, {
+            "_id": self._leases.control_id, "namespace": self._leases.namespace, "kind": "control",
+            "state": "running", "run": self._run,
+        }, upsert=True)
+        for _ in range(self._settings.workers):
+            self._processes.append(self._spawn())
+        print(f"Distributing {self._leases.namespace} through {self._leases.collection.database.name}/"
+              f"{LEASE_COLLECTION}, {len(self._processes)} local workers.")
+
+    def _spawn(self) -> subprocess.Popen:
+        main = Path(__file__).parent.parent / "main.py"
+        command = [sys.executable, str(main), "--mongration", self._settings.script, "--uri", self._settings.uri,
+                   "--worker", "--lease-ttl", str(self._settings.lease_ttl)]
+        return subprocess.Popen(command)
+
+    async def run_group(self, members: list[int], start: Callable[[int], Awaitable]):
+        entry = distributable(self._graph, members)
+        if entry is None:
+            if _inserts(self._graph, members):
+                names = ", ".join(self._graph[index].name() for index in members)
+                print(f"{names} write with mode insert, which cannot be retried on another worker. They run on the "
+                      f"coordinator, write with mode replace or set to distribute them.")
+            await asyncio.gather(*[start(index) for index in members])
+            return
+        await self._publish(entry)
+        await self._wait(entry, members)
+        for index in members:
+            self._graph[index].notify_completion()
+
+    async def _publish(self, entry: Phase):
+        leases = self._leases
+        collection = leases.collection
+        group = await collection.find_one({"_id": leases.group_id(entry.name())})
+        if group is None:
+            source = entry.source()
+            filter, _ = source.query()
+            reading = self._client.get_database(source.database).get_collection(source.collection)
+            boundaries = await compute_boundaries(reading, source.partition_key, filter, self._partition_count())
+            group = {"_id": leases.group_id(entry.name()), "namespace": leases.namespace, "kind": "group",
+                     "boundaries": boundaries}
+            await collection.replace_one({"_id": group["_id"]}, group, upsert=True)
+        else:
+            # Left over by a run that did not finish, the ranges already done are not leased again.
+            await collection.update_many(leases.partitions(entry.name()) | {"state": "failed"},
+                                         {"$set": {"state": "pending"}})
+        requests = list()
+        for number in range(len(partition_filters(entry.source().partition_key, group["boundaries"]))):
+            requests.append(UpdateOne({"_id": f"{group['_id']}:{number}"}, {"$setOnInsert": leases.partitions(entry.name()) | {
+                "partition": number, "state": "pending", "owner": None,
+                "expires": None, "attempts": 0, "processed": 0,
+            }}, upsert=True))
+        await collection.bulk_write(requests, ordered=False)
+
+    async def _wait(self, entry: Phase, members: list[int]):
+        leases = self._leases
+        progress = None
+        if self._progress is not None:
+            progress = self._progress[next(index for index in members if self._graph[index] is entry)]
+            progress.set_description(f"{entry.name()}: distributed")
+        announced = False
+        while True:
+            counts = dict()
+            processed = 0
+            async for state in leases.collection.aggregate([
+                {"$match": leases.partitions(entry.name())},
+                {"$group": {"_id": "$state", "count": {"$sum": 1}, "processed": {"$sum": "$processed"}}},
+            ]):
+                counts[state["_id"]] = state["count"]
+                processed += state["processed"]
+            failed = await leases.collection.find_one(leases.partitions(entry.name()) | {"state": "failed"})
+            if failed is not None:
+                raise Exception(f"Partition {failed['partition']} of {entry.name()} failed on worker "
+                                f"{failed['owner']}: {failed.get('error')}")
+            if progress is not None:
+                progress.n = processed
+                progress.set_postfix_str(f"{counts.get('done', 0)}/{sum(counts.values())} partitions, "
+                                         f"{counts.get('running', 0)} leased")
+            if counts.get("pending", 0) + counts.get("running", 0) == 0:
+                return
+            if len(self._processes) > 0 and all(process.poll() is not None for process in self._processes):
+                raise Exception(f"Every local worker exited before {entry.name()} was done")
+            if not announced and counts.get("running", 0) == 0 and len(self._processes) == 0:
+                print(f"Waiting for workers to claim the partitions of {entry.name()} (start them with --worker).")
+                announced = True
+            await asyncio.sleep(POLL_SECONDS)
+
+    async def finish(self, succeeded: bool):
+        leases = self._leases
+        await leases.collection.update_one({"_id": leases.control_id},
+                                           {"$set": {"state": "finished" if succeeded else "failed"}})
+        if succeeded:
+            # Kept after a failure, the next run resumes from the partitions already done.
+            await leases.collection.delete_many({"namespace": leases.namespace, "kind": {"$in": ["group", "partition"]}})
+        for process in self._processes:
+            if not succeeded:
+                process.terminate()
+        for process in self._processes:
+            await asyncio.get_running_loop().run_in_executor(None, process.wait)
+
+
+class Worker:
+    # Claims partitions until the coordinator it joined finishes. A lease expires when its worker stops
+    # heartbeating, another worker then claims it and runs the partition again.
+    def __init__(self, client: AsyncIOMotorClient, settings, mongration_function, worker_id: Optional[str] = None):
+        self._client = client
+        self._settings = settings
+        self._mongration_function = mongration_function
+        self._leases = _Leases(client, settings.namespace)
+        self.worker_id = worker_id or default_worker_id()
+        self.partitions_done = 0
+
+    def _ttl_milliseconds(self) -> int:
+        return int(self._settings.lease_ttl * 1000)
+
+    async def run(self):
+        leases = self._leases
+        joined = None
+        while True:
+            control = await leases.collection.find_one({"_id": leases.control_id})
+            if joined is None:
+                # Workers started before their coordinator wait for it, instead of leaving on the previous run.
+                if control is None or control["state"] != "running":
+                    await asyncio.sleep(POLL_SECONDS)
+                    continue
+                joined = control["run"]
+                print(f"Worker {self.worker_id} joined {leases.namespace}.")
+            elif control is None or control["run"] != joined or control["state"] != "running":
+                break
+            lease = await self._claim()
+            if lease is None:
+                await asyncio.sleep(POLL_SECONDS)
+                continue
+            await self._run_partition(lease)
+        print(f"Worker {self.worker_id} finished, {self.partitions_done} partitions done.")
+
+    async def _claim(self) -> Optional[dict]:
+        # Expiry is judged on the server's clock, workers on other hosts do not need synchronized clocks.
+        leases = self._leases
+        return await leases.collection.find_one_and_update(
+            {"namespace": leases.namespace, "kind": "partition", "$or": [
+                {"state": "pending"},
+                {"state": "running", "$expr": {"$lt": ["$expires", "$$NOW"]}},
+            ]},
+            [{"$set": {
+                "state": "running", "owner": self.worker_id,
+                "expires": {"$add": ["$$NOW", self._ttl_milliseconds()]}, "attempts": {"$add": ["$attempts", 1]},
+            }}],
+            return_document=ReturnDocument.AFTER,
+        )
+
+    def _group(self, graph: DependencyGraph[Phase], name: str):
+        for members in PhaseScheduler(graph).groups():
+            entry = distributable(graph, members)
+            if entry is not None and entry.name() == name:
+                return entry, members
+        return None, None
+
+    async def _run_members(self, graph: DependencyGraph[Phase], members: list[int], progress: dict):
+        async def run(index):
+            phase = graph[index]
+            destination = phase.destination()
+            if destination is not None:
+                destination.init(self._client)
+            await phase.operation().invoke(self._client, progress[index], phase)
+            if destination is not None:
+                await destination.close()
+            phase.notify_completion()
+
+        await asyncio.gather(*[run(index) for index in members])
+
+    async def _run_partition(self, lease: dict):
+        collection = self._leases.collection
+        owned = {"_id": lease["_id"], "owner": self.worker_id, "state": "running"}
+        _, graph = self._mongration_function()
+        entry, members = self._group(graph, lease["group"])
+        if entry is None:
+            await collection.update_one(owned, {"$set": {
+                "state": "failed", "error": f"{lease['group']} is not a distributable group of this mongration"}})
+            return
+        # Groups the partition depends on were completed by the coordinator before it published the lease.
+        for index in graph.all_indices():
+            if index not in members:
+                graph[index].notify_completion()
+        group = await collection.find_one({"_id": self._leases.group_id(lease["group"])})
+        entry.source().use_partition(group["boundaries"], lease["partition"])
+        progress = {index: _LeaseProgress() for index in members}
+        entry_progress = progress[next(index for index in members if graph[index] is entry)]
+
+        start = time.perf_counter()
+        task = asyncio.create_task(self._run_members(graph, members, progress))
+        while not task.done():
+            await asyncio.wait([task], timeout=self._settings.lease_ttl / 3)
+            if task.done():
+                break
+            result = await collection.update_one(owned, [{"$set": {
+                "expires": {"$add": ["$$NOW", self._ttl_milliseconds()]}, "processed": entry_progress.n,
+            }}])
+            if result.matched_count == 0:
+                task.cancel()
+                await asyncio.gather(task, return_exceptions=True)
+                print(f"Worker {self.worker_id} lost its lease on {lease['group']} partition {lease['partition']}.")
+                return
+        try:
+            task.result()
+        except Exception as e:
+            await collection.update_one(owned, {"$set": {"state": "failed", "error": repr(e)}})
+            print(f"Worker {self.worker_id} failed {lease['group']} partition {lease['partition']}: {e!r}")
+            return
+        await collection.update_one(owned, {"$set": {"state": "done", "processed": entry_progress.n}})
+        self.partitions_done += 1
+        print(f"Worker {self.worker_id}: {lease['group']} partition {lease['partition']} done, "
+              f"{entry_progress.n} docs in {time.perf_counter() - start:.1f}s")
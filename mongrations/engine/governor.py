@@ -0,0 +1,135 @@
+import asyncio
+import time
+from typing import Optional
+
+
+class BudgetAccount:
+    def __init__(self, governor: "ResourceGovernor", name: str):
+        self.name = name
+        self.bytes_in_use = 0
+        self.peak_bytes = 0
+        self.cursors_in_use = 0
+        self.peak_cursors = 0
+        self.waits = 0
+        self.wait_seconds = 0.0
+        self._governor = governor
+
+    async def acquire(self, size: int):
+        await self._governor._acquire(self, size, 0)
+
+    def charge(self, size: int):
+        # Counted against the budget without waiting for it, for buffers bounded on their own (pipes).
+        self._governor._charge(self, size, 0)
+
+    async def release(self, size: int):
+        await self._governor._release(self, size, 0)
+
+    async def discharge(self, size: int):
+        await self._governor._release(self, size, 0, acquired=False)
+
+    async def open_cursor(self):
+        await self._governor._acquire(self, 0, 1)
+
+    async def close_cursor(self):
+        await self._governor._release(self, 0, 1)
+
+
+class ResourceGovernor:
+    # Every phase draws from the same memory and cursor budgets through its own account. Bytes charged by pipes
+    # only leave once a consumer drains them, which may itself wait for the budget, so pipes never wait: half of the
+    # budget is carved out as their byte capacities instead and writes wait for the other half. A request that does
+    # not fit is still let through when nothing else that is bound to be released (a write in flight, an open cursor)
+    # is held by any account, otherwise nothing would ever wake it up.
+    def __init__(self, memory_budget: Optional[int] = None, cursor_budget: Optional[int] = None):
+        self.memory_budget = memory_budget
+        self.cursor_budget = cursor_budget
+        self.bytes_in_use = 0
+        self.cursors_in_use = 0
+        self.peak_bytes = 0
+        self._acquired_bytes = 0
+        self._reserved_bytes = 0
+        self._pipes = 0
+        self._accounts = list[BudgetAccount]()
+        self._changed = asyncio.Condition()
+
+    def account(self, name: str) -> BudgetAccount:
+        account = BudgetAccount(self, name)
+        self._accounts.append(account)
+        return account
+
+    def bound_pipes(self, pipes: list):
+        if self.memory_budget is None or len(pipes) == 0:
+            return
+        share = max(1, self.memory_budget // (2 * len(pipes)))
+        for pipe in pipes:
+            if pipe.capacity_bytes is None or pipe.capacity_bytes > share:
+                pipe.resize(capacity_bytes=share)
+            self._reserved_bytes += pipe.capacity_bytes
+            self._pipes += 1
+
+    def _fits(self, size: int, cursors: int) -> bool:
+        if size > 0 and self.memory_budget is not None and self._acquired_bytes > 0:
+            if self._acquired_bytes + size > self.memory_budget - self._reserved_bytes:
+                return False
+        if cursors > 0 and self.cursor_budget is not None and self.cursors_in_use > 0:
+            if self.cursors_in_use + cursors > self.cursor_budget:
+                return False
+        return True
+
+    async def _acquire(self, account: BudgetAccount, size: int, cursors: int):
+        if not self._fits(size, cursors):
+            start = time.perf_counter()
+            account.waits += 1
+            async with self._changed:
+                await self._changed.wait_for(lambda: self._fits(size, cursors))
+            account.wait_seconds += time.perf_counter() - start
+        self._acquired_bytes += size
+        self._charge(account, size, cursors)
+
+    def _charge(self, account: BudgetAccount, size: int, cursors: int):
+        account.bytes_in_use += size
+        account.cursors_in_use += cursors
+        account.peak_bytes = max(account.peak_bytes, account.bytes_in_use)
+        account.peak_cursors = max(account.peak_cursors, account.cursors_in_use)
+        self.bytes_in_use += size
+        self.cursors_in_use += cursors
+        self.peak_bytes = max(self.peak_bytes, self.bytes_in_use)
+
+    async def _release(self, account: BudgetAccount, size: int, cursors: int, acquired: bool = True):
+        account.bytes_in_use -= size
+        account.cursors_in_use -= cursors
+        self.bytes_in_use -= size
+        self.cursors_in_use -= cursors
+        if acquired:
+            self._acquired_bytes -= size
+        async with self._changed:
+            self._changed.notify_all()
+
+    def report(self) -> list[str]:
+        memory = "unlimited" if self.memory_budget is None else f"{self.memory_budget / 2 ** 20:.1f} MiB"
+        cursors = "unlimited" if self.cursor_budget is None else str(self.cursor_budget)
+        lines = [f"Resource budget: memory {memory} (peak {self.peak_bytes / 2 ** 20:.1f} MiB), cursors {cursors}"]
+        if self._pipes > 0:
+            # An empty pipe still takes one chunk over its capacity, and a lone write over the budget is let through.
+            lines.append(
+                f"  {self._pipes} pipes hold up to {self._reserved_bytes / 2 ** 20:.1f} MiB of it, each may exceed "
+                f"its share by a single batch"
+            )
+        for account in self._accounts:
+            if account.peak_bytes == 0 and account.peak_cursors == 0:
+                continue
+            lines.append(
+                f"  {account.name}: peak {account.peak_bytes / 2 ** 20:.1f} MiB, peak {account.peak_cursors} cursors, "
+                f"throttled {account.waits} times for {account.wait_seconds:.2f} seconds"
+            )
+        return lines
+
+
+def parse_size(text: Optional[str]) -> Optional[int]:
+    if text is None:
+        return None
+    units = {"k": 2 ** 10, "m": 2 ** 20, "g": 2 ** 30, "t": 2 ** 40}
+    value = text.strip().lower().removesuffix("ib").removesuffix("b")
+    if len(value) > 0 and value[-1] in units:
+        return int(float(value[:-1]) * units[value[-1]])
+    return int(value)
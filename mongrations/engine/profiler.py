@@ -0,0 +1,219 @@
+import json
+import signal
+import sys
+import threading
+import time
+from collections import Counter
+from pathlib import Path
+from typing import Optional
+
+from mongrations.io.pipe import Pipe
+
+# Where the time of a phase goes, as seen from the event loop awaiting it.
+SPAN_CATEGORIES = ("source", "callback", "queue wait", "write")
+
+# Innermost frame first, the first rule matching a frame of the sampled stack names its category.
+_SAMPLE_RULES = (
+    ("selectors.py", None, "idle"),
+    ("threading.py", "wait", "idle"),
+    ("queue.py", "get", "idle"),
+    ("thread.py", "_worker", "idle"),
+    ("/bson/", None, "bson"),
+    ("lazy_bson.py", None, "bson"),
+    ("pipe.py", None, "pipe"),
+    ("collection_destination.py", None, "write"),
+    ("segments.py", "push_batch", "write"),
+    ("segments.py", None, "source"),
+    ("/pymongo/", None, "driver"),
+    ("/motor/", None, "driver"),
+    ("source.py", None, "source"),
+    ("change_stream.py", None, "source"),
+    ("python_operation.py", "__call__", "callback"),
+)
+
+
+class PhaseProfile:
+    def __init__(self, name: str):
+        self.name = name
+        self.spans = Counter()
+        self.samples = Counter()
+        self.stacks = Counter()
+        # Stacks are kept as code objects while sampling, naming and categorizing them waits until the run is over.
+        self.raw_stacks = Counter()
+
+    def add(self, category: str, seconds: float):
+        self.spans[category] += max(0.0, seconds)
+
+    async def timed(self, batches, category: str, excluding: Optional[str] = None):
+        # Time the loop spent waiting on the iterator. Waits on an inner iterator that are timed on their own
+        # (the source of a transform) are taken out, so nothing is counted twice.
+        iterator = batches.__aiter__()
+        while True:
+            start = time.perf_counter()
+            nested = self.spans[excluding] if excluding is not None else 0.0
+            try:
+                batch = await iterator.__anext__()
+            except StopAsyncIteration:
+                return
+            finally:
+                elapsed = time.perf_counter() - start
+                if excluding is not None:
+                    elapsed -= self.spans[excluding] - nested
+                self.add(category, elapsed)
+            yield batch
+
+    def symbolize(self):
+        for codes, count in self.raw_stacks.items():
+            category = _category(codes)
+            if category == "idle":
+                continue
+            self.samples[category] += count
+            self.stacks[";".join(_label(code) for code in codes)] += count
+        self.raw_stacks.clear()
+
+    def to_dict(self, interval: float) -> dict:
+        return {
+            "phase": self.name,
+            "seconds": {category: self.spans[category] for category in SPAN_CATEGORIES},
+            "sampled_seconds": {category: count * interval for category, count in self.samples.most_common()},
+        }
+
+
+def span_category(endpoint, otherwise: str) -> str:
+    # Pipes only block when the other side is slower, the time is spent queueing and not doing any I/O.
+    return "queue wait" if isinstance(endpoint, Pipe) else otherwise
+
+
+class Profiler:
+    def __init__(self, interval: float = 0.005):
+        self.interval = interval
+        self._phases = list[PhaseProfile]()
+        self._by_phase = dict[int, PhaseProfile]()
+        self._owners = dict[int, PhaseProfile]()
+        # Locals are only read on frames of the owners' methods, the other frames of a sample are never inspected.
+        self._owner_codes = set()
+        # Samples of the loop that belong to no phase, and of threads the driver or the executors run in.
+        self._engine = PhaseProfile("(engine)")
+        self._threads = PhaseProfile("(worker threads)")
+        self._stopped = threading.Event()
+        self._thread = None
+        self._loop_thread = None
+        self._signals = False
+        self._previous_handler = None
+
+    def phase(self, phase) -> PhaseProfile:
+        profile = PhaseProfile(phase.name())
+        self._phases.append(profile)
+        self._by_phase[id(phase)] = profile
+        # Tasks spawned by a phase (pipelined bulk writes) run outside of it, they are recognized by their owner.
+        owners = [phase.operation()]
+        if phase.destination() is not None:
+            owners.extend([phase.destination()] + phase.destination().branches())
+        for owner in owners:
+            if owner is not None:
+                self._owners[id(owner)] = profile
+                for cls in type(owner).__mro__:
+                    self._owner_codes.update(attribute.__code__ for attribute in vars(cls).values()
+                                             if hasattr(attribute, "__code__"))
+        return profile
+
+    def start(self):
+        self._loop_thread = threading.get_ident()
+        self._signals = hasattr(signal, "setitimer") and threading.current_thread() is threading.main_thread()
+        if self._signals:
+            # A sampling thread only gets the GIL when the loop releases it, which is mostly while it idles in
+            # select. A timer signal is handled between two bytecodes of the loop, wherever it is.
+            self._previous_handler = signal.signal(signal.SIGALRM, lambda signum, frame: self._record(frame, True))
+            signal.setitimer(signal.ITIMER_REAL, self.interval, self.interval)
+        self._thread = threading.Thread(target=self._run, name="mongrations-profiler", daemon=True)
+        self._thread.start()
+
+    def stop(self):
+        if self._signals:
+            signal.setitimer(signal.ITIMER_REAL, 0)
+            signal.signal(signal.SIGALRM, self._previous_handler)
+        self._stopped.set()
+        if self._thread is not None:
+            self._thread.join()
+        for profile in self._phases + [self._engine, self._threads]:
+            profile.symbolize()
+
+    def _run(self):
+        own = threading.get_ident()
+        while not self._stopped.wait(self.interval):
+            for thread, frame in sys._current_frames().items():
+                if thread == own or (thread == self._loop_thread and self._signals):
+                    continue
+                self._record(frame, thread == self._loop_thread)
+
+    def _owner(self, stack) -> Optional[PhaseProfile]:
+        for frame in stack:
+            code = frame.f_code
+            if code.co_name == "phase_process":
+                return self._by_phase.get(id(frame.f_locals.get("phase")))
+            if code in self._owner_codes:
+                owner = self._owners.get(id(frame.f_locals.get("self")))
+                if owner is not None:
+                    return owner
+        return None
+
+    def _record(self, frame, on_loop: bool):
+        stack = list()
+        while frame is not None:
+            stack.append(frame)
+            frame = frame.f_back
+        stack.reverse()
+        if on_loop:
+            profile = self._owner(stack) or self._engine
+        else:
+            profile = self._threads
+        profile.raw_stacks[tuple(frame.f_code for frame in stack)] += 1
+
+    def _profiles(self) -> list[PhaseProfile]:
+        return self._phases + [profile for profile in (self._engine, self._threads) if len(profile.samples) > 0]
+
+    def report(self) -> list[str]:
+        lines = list()
+        for profile in self._profiles():
+            spans = ", ".join(f"{profile.spans[category]:.2f}s {category}" for category in SPAN_CATEGORIES
+                              if profile.spans[category] > 0)
+            total = sum(profile.samples.values())
+            sampled = ", ".join(f"{count * 100 / total:.0f}% {category}"
+                                for category, count in profile.samples.most_common())
+            lines.append(f"Profile of {profile.name}: {spans or 'no waits'}" +
+                         (f"; busy {total * self.interval:.2f}s: {sampled}" if total > 0 else ""))
+        return lines
+
+    def write(self, directory: str):
+        target = Path(directory)
+        target.mkdir(parents=True, exist_ok=True)
+        profiles = self._profiles()
+        (target / "profile.json").write_text(json.dumps({
+            "interval": self.interval,
+            "phases": [profile.to_dict(self.interval) for profile in profiles],
+        }, indent=2))
+        # Collapsed stacks, one file per phase plus one with every phase as a root frame, for flamegraph.pl or speedscope.
+        with open(target / "all.folded", "w") as combined:
+            for profile in profiles:
+                name = profile.name.replace(";", ",")
+                with open(target / f"{_file_name(profile.name)}.folded", "w") as file:
+                    for stack, count in profile.stacks.items():
+                        file.write(f"{stack} {count}\n")
+                        combined.write(f"{name};{stack} {count}\n")
+
+
+def _category(codes) -> str:
+    for code in reversed(codes):
+        filename, name = code.co_filename, code.co_name
+        for path, function, category in _SAMPLE_RULES:
+            if path in filename and (function is None or function == name):
+                return category
+    return "engine"
+
+
+def _label(code) -> str:
+    return f"{code.co_name} ({Path(code.co_filename).name}:{code.co_firstlineno})"
+
+
+def _file_name(name: str) -> str:
+    return "".join(character if character.isalnum() or character in "-_" else "-" for character in name)
@@ -0,0 +1,109 @@
+import asyncio
+import heapq
+from typing import Awaitable, Callable, Optional
+
+from mongrations.graph import DependencyGraph
+
+
+def streams_into(dependency, dependant) -> bool:
+    destination = dependency.destination()
+    return destination is not None and destination.streams_into(dependant)
+
+
+class PhaseScheduler:
+    # Phases joined by a streaming destination (a pipe) have to run at the same time, so they are grouped and
+    # scheduled together. A group starts once every phase it reads a materialized output from has completed.
+    def __init__(self, graph: DependencyGraph, max_concurrent: Optional[int] = None):
+        self._graph = graph
+        self._max_concurrent = max_concurrent
+        indices = graph.all_indices()
+        self._group_of = {index: index for index in indices}
+        for index in indices:
+            for dependency in graph.dependencies_of(index):
+                if streams_into(graph[dependency], graph[index]):
+                    self._union(index, dependency)
+
+        self._members = dict[int, list[int]]()
+        for index in indices:
+            self._members.setdefault(self._find(index), list()).append(index)
+
+        self._group_dependants = {group: set() for group in self._members}
+        self._group_indegree = {group: 0 for group in self._members}
+        for index in indices:
+            for dependency in graph.dependencies_of(index):
+                group, dependency_group = self._find(index), self._find(dependency)
+                if group != dependency_group and group not in self._group_dependants[dependency_group]:
+                    self._group_dependants[dependency_group].add(group)
+                    self._group_indegree[group] += 1
+
+        self._priority = self._critical_paths()
+
+    def _find(self, index):
+        while self._group_of[index] != index:
+            self._group_of[index] = self._group_of[self._group_of[index]]
+            index = self._group_of[index]
+        return index
+
+    def _union(self, a, b):
+        root_a, root_b = self._find(a), self._find(b)
+        if root_a != root_b:
+            self._group_of[root_b] = root_a
+
+    def _critical_paths(self) -> dict[int, int]:
+        indegree = dict(self._group_indegree)
+        order = [group for group, degree in indegree.items() if degree == 0]
+        for group in order:
+            for dependant in self._group_dependants[group]:
+                indegree[dependant] -= 1
+                if indegree[dependant] == 0:
+                    order.append(dependant)
+        if len(order) != len(self._members):
+            raise Exception("Phases have a cyclic dependency, they cannot be scheduled")
+        lengths = dict()
+        for group in reversed(order):
+            downstream = max((lengths[d] for d in self._group_dependants[group]), default=0)
+            lengths[group] = len(self._members[group]) + downstream
+        return lengths
+
+    def groups(self) -> list[list[int]]:
+        return list(self._members.values())
+
+    def _fits(self, running: int, group: int) -> bool:
+        # A group bigger than the limit still runs alone, otherwise it could never start.
+        if self._max_concurrent is None or running == 0:
+            return True
+        return running + len(self._members[group]) <= self._max_concurrent
+
+    async def run(self, start: Callable[[int], Awaitable]):
+        async def run_group(members):
+            await asyncio.gather(*[start(index) for index in members])
+
+        await self.run_groups(run_group)
+
+    async def run_groups(self, run_group: Callable[[list[int]], Awaitable]):
+        indegree = dict(self._group_indegree)
+        ready = [(-self._priority[group], group) for group, degree in indegree.items() if degree == 0]
+        heapq.heapify(ready)
+        running = dict[asyncio.Task, int]()
+        running_phases = 0
+
+        try:
+            while ready or running:
+                while ready and self._fits(running_phases, ready[0][1]):
+                    _, group = heapq.heappop(ready)
+                    members = self._members[group]
+                    running[asyncio.create_task(run_group(members))] = group
+                    running_phases += len(members)
+
+                done, _ = await asyncio.wait(running.keys(), return_when=asyncio.FIRST_COMPLETED)
+                for task in done:
+                    group = running.pop(task)
+                    running_phases -= len(self._members[group])
+                    task.result()
+                    for dependant in self._group_dependants[group]:
+                        indegree[dependant] -= 1
+                        if indegree[dependant] == 0:
+                            heapq.heappush(ready, (-self._priority[dependant], dependant))
+        finally:
+            for task in running:
+                task.cancel()
@@ -0,0 +1,174 @@
+from typing import Optional
+
+from motor.motor_asyncio import AsyncIOMotorClient
+from pymongo.errors import OperationFailure
+
+from mongrations.graph import DependencyGraph
+from mongrations.io.collection_destination import CollectionDestination
+from mongrations.io.segments import SegmentSource
+from mongrations.io.source import CollectionSource
+from mongrations.operations.aggregation_operation import AggregationOperation, output_stage
+from mongrations.phase import Phase
+
+
+class CollectionStats:
+    def __init__(self, count: int, average_size: int):
+        self.count = count
+        self.average_size = average_size
+
+    def size(self) -> int:
+        return self.count * self.average_size
+
+
+async def collection_stats(client: AsyncIOMotorClient, database: str, collection: str) -> Optional[CollectionStats]:
+    try:
+        stats = await client.get_database(database).command("collStats", collection)
+    except OperationFailure:
+        return None
+    return CollectionStats(stats.get("count", 0), stats.get("avgObjSize", 0))
+
+
+def _plan_stages(plan, found: list):
+    # Walks the winning plan of a find or of every $cursor stage of an aggregation.
+    if isinstance(plan, dict):
+        if "stage" in plan:
+            found.append((plan["stage"], plan.get("keyPattern")))
+        for value in plan.values():
+            _plan_stages(value, found)
+    elif isinstance(plan, list):
+        for value in plan:
+            _plan_stages(value, found)
+
+
+async def query_plan(client: AsyncIOMotorClient, source: CollectionSource, stages: Optional[list[dict]]) -> Optional[str]:
+    database = client.get_database(source.database)
+    try:
+        if stages is None:
+            filter, projection = source.query()
+            explained = await database.get_collection(source.collection).find(filter, projection).explain()
+        else:
+            explained = await database.command("aggregate", source.collection, pipeline=stages, explain=True)
+    except OperationFailure as e:
+        return f"unavailable ({e.details.get('errmsg', e) if e.details else e})"
+    found = list()
+    _plan_stages(explained.get("queryPlanner", explained), found)
+    scans = [f"IXSCAN {dict(key)}" if stage == "IXSCAN" else stage for stage, key in found
+             if stage in ("COLLSCAN", "IXSCAN", "EOF")]
+    return ", ".join(dict.fromkeys(scans)) if len(scans) > 0 else None
+
+
+def _execution(phase: Phase) -> str:
+    operation = phase.operation()
+    if not isinstance(operation, AggregationOperation):
+        return "client side, every document goes through python"
+    if not all(isinstance(source, CollectionSource) for source in phase.sources()):
+        return "server side, on documents the client sends back to the server"
+    if operation.writes_output() or isinstance(phase.destination(), CollectionDestination):
+        return "fully server side, documents never leave the server"
+    return "server side, results stream back to the client"
+
+
+def _branches(phase: Phase) -> list:
+    destination = phase.destination()
+    return [] if destination is None else destination.branches()
+
+
+def _bytes(size: float) -> str:
+    for unit in ("B", "KiB", "MiB", "GiB"):
+        if size < 1024:
+            return f"{size:.1f} {unit}"
+        size /= 1024
+    return f"{size:.1f} TiB"
+
+
+async def explain(graph: DependencyGraph[Phase], client: AsyncIOMotorClient, checkpointed: bool = False) -> list[str]:
+    lines = list()
+    warnings = list()
+    # Estimated documents and bytes coming out of every phase, selectivity is unknown so these are upper bounds.
+    outputs = dict[Phase, tuple[int, int]]()
+    wire_total = 0
+    for position, index in enumerate(graph.topological_order(), start=1):
+        phase = graph[index]
+        operation = phase.operation()
+        execution = _execution(phase)
+        server_side = execution.startswith("fully")
+        lines.append(f"[{position}] {phase.name()} ({operation})")
+
+        producers = dict()
+        for dependency_index in graph.dependencies_of(index):
+            dependency = graph[dependency_index]
+            for destination in _branches(dependency):
+                for source in phase.sources():
+                    writes_it = isinstance(destination, CollectionDestination) and isinstance(source, CollectionSource) \
+                                and (source.database, source.collection) == (destination.database, destination.collection)
+                    reads_segments = isinstance(source, SegmentSource) and source.store is destination
+                    if source is destination or writes_it or reads_segments:
+                        producers[id(source)] = dependency
+
+        documents, size, read_over_wire = 0, 0, 0
+        for number, source in enumerate(phase.sources()):
+            details = [source.describe_read(checkpointed and operation.supports_checkpoints())]
+            pushdown = source.pushdown()
+            details.append(f"pushdown: {pushdown}" if pushdown is not None else "nothing pushed down")
+            producer = producers.get(id(source))
+            if producer is not None:
+                produced_documents, produced_size = outputs.get(producer, (0, 0))
+                documents += produced_documents
+                size += produced_size
+                if not any(source is branch for branch in _branches(producer)) and not isinstance(source, SegmentSource):
+                    read_over_wire += produced_size
+                details.append(f"up to {produced_documents} docs from {producer.name()}")
+            elif isinstance(source, CollectionSource):
+                stats = await collection_stats(client, source.database, source.collection)
+                if stats is None:
+                    details.append("collection does not exist yet")
+                else:
+                    documents += stats.count
+                    size += stats.size()
+                    read_over_wire += stats.size()
+                    details.append(f"{stats.count} docs, avg {stats.average_size} B, {_bytes(stats.size())}")
+                # An aggregation's primary input is explained with the whole pipeline, unions are folded into it.
+                stages = None
+                if isinstance(operation, AggregationOperation):
+                    stages = operation.pipeline_for(phase) if number == 0 else None
+                elif source.pipeline is not None or source.sample is not None:
+                    stages = source.pipeline_stages()
+                if number == 0 or not isinstance(operation, AggregationOperation):
+                    plan = await query_plan(client, source, stages)
+                    if plan is not None:
+                        details.append(f"plan: {plan}")
+                        if "COLLSCAN" in plan:
+                            filter, _ = source.query()
+                            reason = "filtered " if filter else ""
+                            warnings.append(f"{phase.name()} runs a {reason}full collection scan of {source}")
+            lines.append(f"    source: {source} - {'; '.join(details)}")
+
+        destination = phase.destination()
+        if isinstance(operation, AggregationOperation) and isinstance(destination, CollectionDestination) \
+                and not operation.writes_output():
+            stage = next(iter(output_stage(destination)))
+            lines.append(f"    destination: {destination.mode.value} into {destination} through a server side {stage}")
+        elif destination is not None:
+            lines.append(f"    destination: {destination.describe_write()}")
+        for branch in _branches(phase):
+            if isinstance(branch, CollectionDestination) and branch.temporary:
+                warnings.append(f"{phase.name()} materializes {branch}, it could not be fused into its dependants")
+        lines.append(f"    execution: {execution}")
+
+        outputs[phase] = (documents, size)
+        # Documents cross the wire when read by the client, unless a pipe hands them over, and when written back.
+        if server_side:
+            wire = 0
+        elif isinstance(operation, AggregationOperation):
+            wire = size
+        else:
+            writes = sum(1 for branch in _branches(phase) if isinstance(branch, CollectionDestination))
+            wire = read_over_wire + size * writes
+        wire_total += wire
+        lines.append(f"    estimated bytes: {_bytes(size)} processed, {_bytes(wire)} over the wire")
+
+    lines.append(f"Estimated total over the wire: {_bytes(wire_total)}")
+    if len(warnings) > 0:
+        lines.append("Warnings:")
+        lines.extend(f"  {warning}" for warning in warnings)
+    return lines
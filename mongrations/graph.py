@@ -1,135 +1,9 @@
 from collections import deque
-from enum import Enum
-from typing import Generic, TypeVar, Callable, List, Set
+from typing import Generic, TypeVar, Callable, List
 
 from mongrations.misc.buffered_drawing import BufferedCanvas
 
 
-def is_completed(needed: set, visited: set):
-    return needed.issubset(visited)
-
-
-class _Node:
-    def __init__(self, data=None):
-        self._map = {}
-        self._vertex = data
-
-    @property
-    def connections(self):
-        return self._map
-
-    @property
-    def data(self):
-        return self._vertex
-
-    @data.setter
-    def data(self, value):
-        self._vertex = value
-
-    def edge(self, to):
-        return self._map.get(to, None)
-
-    def connect(self, index, edge_data):
-        self._map[index] = edge_data
-
-    def disconnect(self, index):
-        if index in self._map:
-            del self._map[index]
-            return True
-        return False
-
-    def clear(self):
-        self._map.clear()
-        self._vertex = None
-
-
-class EdgeView:
-    def __init__(self, owner):
-        self._elements = list(owner.connections.items())
-
-    def __iter__(self):
-        return iter(self._elements)
-
-
-# Technically an adjacency list, but nobody cares
-class Graph:
-    def __init__(self):
-        self._nodes = []
-        self._free_indices = []
-        self._free_indices_set = set()
-
-    def clear(self):
-        self._nodes.clear()
-
-    def remove(self, index):
-        if index < len(self._nodes):
-            self._nodes[index].clear()
-            self._free_indices.append(index)
-            self._free_indices_set.add(index)
-
-    def push(self, vertex):
-        if self._free_indices:
-            index = self._free_indices.pop(0)
-            self._free_indices_set.remove(index)
-            self._nodes[index].data = vertex
-        else:
-            index = len(self._nodes)
-            self._nodes.append(_Node(vertex))
-        return index
-
-    def size(self):
-        return len(self._nodes) - len(self._free_indices)
-
-    def empty(self):
-        return self.size() == 0
-
-    def all_vertices_indices(self):
-        return [i for i in range(len(self._nodes)) if i not in self._free_indices_set]
-
-    def vertex(self, index):
-        if index < len(self._nodes):
-            return self._nodes[index].data
-        return None
-
-    def edge(self, from_index, to_index):
-        if from_index < len(self._nodes):
-            return self._nodes[from_index].edge(to_index)
-        return None
-
-    def connect(self, from_index, to_index, edge):
-        if from_index < len(self._nodes):
-            self._nodes[from_index].connect(to_index, edge)
-
-    def edges_from(self, index):
-        if index < len(self._nodes):
-            return EdgeView(self._nodes[index])
-        return None
-
-    def node(self, index):
-        if index < len(self._nodes):
-            return self._nodes[index]
-        return None
-
-    def disconnect(self, from_index, to_index):
-        if from_index < len(self._nodes):
-            return self._nodes[from_index].disconnect(to_index)
-        return False
-
-
-# Define the dependency type using an Enum
-class DependencyType(Enum):
-    USES = 1
-    USED = 2
-
-
-# Convert the C++ `to_string` and operator overload for printing to a simple string representation
-def dependency_type_to_string(dependency_type: DependencyType) -> str:
-    if dependency_type == DependencyType.USES:
-        return "uses"
-    elif dependency_type == DependencyType.USED:
-        return "used"
-
-
 # Define the generic types for the vertex and index
 TVertex = TypeVar('TVertex')
 
@@ -141,66 +15,109 @@ def clamp_string(s, max_size):
 
 
 class DependencyGraph(Generic[TVertex]):
+    # Compact adjacency: for every vertex index, the indices it depends on and the indices depending on it.
     def __init__(self):
-        self._graph = Graph()  # Use the provided Graph class
-        self._independent = set()
+        self._vertices = list()
+        self._dependencies = list[List[int]]()
+        self._dependants = list[List[int]]()
+        self._alive = list[bool]()
+        self._free_indices = deque()
+        self._size = 0
 
     def add_dependency(self, from_: int, to: int):
-        self._independent.discard(from_)
-        self._graph.connect(from_, to, DependencyType.USES)
-        self._graph.connect(to, from_, DependencyType.USED)
+        dependencies = self._dependencies[from_]
+        if to in dependencies:
+            return
+        dependencies.append(to)
+        self._dependants[to].append(from_)
 
     def remove(self, index: int):
-        self._graph.remove(index)
+        if not self._is_alive(index):
+            return
+        for dependency in self._dependencies[index]:
+            self._dependants[dependency].remove(index)
+        for dependant in self._dependants[index]:
+            self._dependencies[dependant].remove(index)
+        self._dependencies[index] = list()
+        self._dependants[index] = list()
+        self._vertices[index] = None
+        self._alive[index] = False
+        self._free_indices.append(index)
+        self._size -= 1
 
     def disconnect(self, from_: int, to: int) -> bool:
-        success_from = self._graph.disconnect(from_, to)
-        success_to = self._graph.disconnect(to, from_)
-        return success_from and success_to
+        if not self._is_alive(from_) or not self._is_alive(to) or to not in self._dependencies[from_]:
+            return False
+        self._dependencies[from_].remove(to)
+        self._dependants[to].remove(from_)
+        return True
 
     def add(self, vertex: TVertex) -> int:
-        index = self._graph.push(vertex)
-        self._independent.add(index)
+        if self._free_indices:
+            index = self._free_indices.popleft()
+            self._vertices[index] = vertex
+            self._alive[index] = True
+        else:
+            index = len(self._vertices)
+            self._vertices.append(vertex)
+            self._dependencies.append(list())
+            self._dependants.append(list())
+            self._alive.append(True)
+        self._size += 1
         return index
 
+    def _is_alive(self, index: int) -> bool:
+        return 0 <= index < len(self._alive) and self._alive[index]
+
     def dependencies_of(self, index: int) -> List[int]:
-        node = self._graph.node(index)
-        if node is None:
+        if not self._is_alive(index):
             return []
-        return [to for to, edge in node.connections.items() if edge == DependencyType.USES]
+        return self._dependencies[index]
 
     def dependants_on(self, index: int) -> List[int]:
-        node = self._graph.node(index)
-        if node is None:
+        if not self._is_alive(index):
             return []
-        return [to for to, edge in node.connections.items() if edge == DependencyType.USED]
+        return self._dependants[index]
 
     def get_size(self) -> int:
-        return self._graph.size()
+        return self._size
+
+    def all_indices(self) -> List[int]:
+        return [i for i, alive in enumerate(self._alive) if alive]
+
+    def topological_order(self) -> List[int]:
+        # Kahn's algorithm, every vertex and edge is visited exactly once.
+        indegree = [len(dependencies) for dependencies in self._dependencies]
+        ready = deque(i for i in self.all_indices() if indegree[i] == 0)
+        order = list()
+        while ready:
+            vertex = ready.popleft()
+            order.append(vertex)
+            for dependant in self._dependants[vertex]:
+                indegree[dependant] -= 1
+                if indegree[dependant] == 0:
+                    ready.append(dependant)
+        if len(order) != self._size:
+            raise Exception("Dependency graph has a cycle")
+        return order
 
     def traverse(
             self,
             per_vertex: Callable[[int], None],
             per_edge: Callable[[int, int], None]
     ):
-        visited = set()
-        ready = deque(self._independent)
-
-        while ready:
-            vertex = ready.pop()
-            if vertex in visited:
-                continue
-            visited.add(vertex)
+        for vertex in self.topological_order():
             per_vertex(vertex)
+            for dependant in self._dependants[vertex]:
+                per_edge(vertex, dependant)
 
-            for edge in self._graph.edges_from(vertex):
-                neighbor, edge_type = edge
-                if neighbor not in visited:
-                    needed = set(self.dependencies_of(neighbor))
-                    if is_completed(needed, visited):
-                        per_edge(vertex, neighbor)
-                        if neighbor not in ready:
-                            ready.appendleft(neighbor)
+    def critical_path_lengths(self, weight: Callable[[int], float] = None) -> dict[int, float]:
+        # Longest weighted path from each vertex down to a sink, walking the topological order backwards.
+        lengths = dict()
+        for vertex in reversed(self.topological_order()):
+            own = 1 if weight is None else weight(vertex)
+            lengths[vertex] = own + max((lengths[d] for d in self._dependants[vertex]), default=0)
+        return lengths
 
     def print_to_terminal(self, circle_radius=5, padding=2, name_selector=None):
         canvas = BufferedCanvas()
@@ -211,8 +128,9 @@ class DependencyGraph(Generic[TVertex]):
                 vertices_to_level[vertex] = 0
 
         def per_edge(src, dst):
+            # Every edge is visited, so a vertex ends up one level below its deepest dependency.
             candidate = vertices_to_level[src] + 1
-            if dst not in vertices_to_level or candidate < vertices_to_level[dst]:
+            if dst not in vertices_to_level or candidate > vertices_to_level[dst]:
                 vertices_to_level[dst] = candidate
 
         self.traverse(per_vertex, per_edge)
@@ -236,13 +154,13 @@ class DependencyGraph(Generic[TVertex]):
             vertex_centers[index] = center
         for level, vertex_map in levels.items():
             for index, center in vertex_map.items():
-                for dst, edge in self._graph.edges_from(index):
+                for dst in self._dependants[index]:
                     canvas.draw_line(center, vertex_centers[dst])
         max_msg_len = circle_radius * circle_radius
         for level, vertex_map in levels.items():
             for index, center in vertex_map.items():
                 canvas.draw_circle(center, circle_radius)
-                vertex = self._graph.vertex(index)
+                vertex = self._vertices[index]
                 if name_selector is not None:
                     msg = name_selector(vertex)
                 else:
@@ -254,8 +172,7 @@ class DependencyGraph(Generic[TVertex]):
         with open("mongration.graph.txt", "w") as f:
             f.writelines(str(canvas))
 
-    def is_completed(self, needed: Set[int], visited: Set[int]) -> bool:
-        return needed.issubset(visited)
-
     def __getitem__(self, index: int):
-        return self._graph.vertex(index)
+        if not self._is_alive(index):
+            return None
+        return self._vertices[index]
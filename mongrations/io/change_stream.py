@@ -0,0 +1,117 @@
+import time
+from typing import Optional
+
+from bson import Timestamp
+from motor.motor_asyncio import AsyncIOMotorClient, AsyncIOMotorCollection
+
+from mongrations.misc.documents import Deletion, hashable
+
+WATCHED_OPERATIONS = ["insert", "update", "replace", "delete"]
+_LOGICAL_OPERATORS = ("$and", "$or", "$nor")
+
+
+async def current_operation_time(client: AsyncIOMotorClient) -> Timestamp:
+    # Captured before the initial scan, so every write the scan might miss is replayed by the change stream.
+    response = await client.admin.command("hello")
+    operation_time = response.get("operationTime")
+    if operation_time is None:
+        raise Exception("Live mode requires change streams, connect to a replica set or a sharded cluster")
+    return operation_time
+
+
+def _on_full_document(filter: dict) -> Optional[dict]:
+    # The filter rewritten for change events, None when top level operators like $expr cannot be moved under it.
+    rewritten = dict()
+    for key, condition in filter.items():
+        if key in _LOGICAL_OPERATORS:
+            parts = [_on_full_document(sub_query) for sub_query in condition]
+            if any(part is None for part in parts):
+                return None
+            rewritten[key] = parts
+        elif key.startswith("$"):
+            return None
+        else:
+            rewritten[f"fullDocument.{key}"] = condition
+    return rewritten
+
+
+class ChangeFeed:
+    # The server evaluates the filter, locally only a subset of its operators could be. Inserts are filtered in the
+    # change stream itself. An update may as well move a document out of the filter, whose copy then has to be
+    # deleted from the target, so updated documents are checked against the collection a batch at a time.
+    def __init__(self, collection: AsyncIOMotorCollection, start: Timestamp, filter: Optional[dict],
+                 batch_size: int, max_await_ms: int = 500):
+        self._collection = collection
+        self._start = start
+        self._filter = filter
+        self._inserts = _on_full_document(filter) if filter else None
+        self._batch_size = batch_size
+        self._max_await_ms = max_await_ms
+        self._stopped = False
+        self.lag = None
+        self.changes = 0
+
+    def stop(self):
+        self._stopped = True
+
+    def _pipeline(self) -> list[dict]:
+        if self._inserts is None:
+            return [{"$match": {"operationType": {"$in": WATCHED_OPERATIONS}}}]
+        return [{"$match": {"$or": [
+            {"operationType": {"$in": ["update", "replace", "delete"]}},
+            {"$and": [{"operationType": "insert"}, self._inserts]},
+        ]}}]
+
+    async def _matching(self, ids: list) -> set:
+        matching = set()
+        query = {"$and": [{"_id": {"$in": ids}}, self._filter]}
+        async for document in self._collection.find(query, projection={"_id": 1}):
+            matching.add(hashable(document["_id"]))
+        return matching
+
+    def _needs_check(self, change) -> bool:
+        # Inserts were filtered by the change stream already, unless the filter could not be moved into it.
+        return bool(self._filter) and (change["operationType"] != "insert" or self._inserts is None)
+
+    async def _to_items(self, changes: list) -> list:
+        changed = [change for change in changes if change["operationType"] != "delete"
+                   and change.get("fullDocument") is not None]
+        checked = [change["fullDocument"]["_id"] for change in changed if self._needs_check(change)]
+        matching = await self._matching(checked) if len(checked) > 0 else set()
+        items = list()
+        for change in changes:
+            if change["operationType"] == "delete":
+                items.append(Deletion(change["documentKey"]["_id"]))
+                continue
+            document = change.get("fullDocument")
+            # An update whose document was deleted before the lookup ran, the delete event follows.
+            if document is None:
+                continue
+            if not self._needs_check(change) or hashable(document["_id"]) in matching:
+                items.append(document)
+            elif change["operationType"] != "insert":
+                # Deleting a document the target never had does nothing.
+                items.append(Deletion(document["_id"]))
+        return items
+
+    async def batches(self):
+        async with self._collection.watch(
+                self._pipeline(),
+                full_document="updateLookup",
+                start_at_operation_time=self._start,
+                max_await_time_ms=self._max_await_ms
+        ) as stream:
+            while not self._stopped:
+                batch = list()
+                while len(batch) < self._batch_size and not self._stopped:
+                    change = await stream.try_next()
+                    if change is None:
+                        # Nothing else pending on the server, the target has caught up with the source.
+                        self.lag = 0.0
+                        break
+                    self.changes += 1
+                    self.lag = max(0.0, time.time() - change["clusterTime"].time)
+                    batch.append(change)
+                items = await self._to_items(batch) if len(batch) > 0 else []
+                if len(items) > 0:
+                    yield items
@@ -1,48 +1,172 @@
-from asyncio import Future
-from queue import Queue
+import asyncio
+import time
+from enum import Enum
+from typing import Optional, Union
 
 from motor.motor_asyncio import AsyncIOMotorClient, AsyncIOMotorCollection
-from pymongo import UpdateOne
+from pymongo import DeleteOne, ReplaceOne, UpdateOne
 
 from mongrations.io.destination import Destination
 from mongrations.io.source import CollectionSource
+from mongrations.misc.documents import Deletion, estimate_batch_size, get_path
+
+# Server side limits for a single bulk write.
+MAX_BATCH_COUNT = 100_000
+MAX_BATCH_BYTES = 16 * 1024 * 1024
+
+
+class WriteMode(Enum):
+    # Plain inserts, only safe on empty targets but by far the cheapest for the server.
+    INSERT = "insert"
+    # Replaces the whole document matched by _id, inserting it if missing.
+    REPLACE = "replace"
+    # $set of every field on the document matched by _id, inserting it if missing.
+    SET = "set"
+    # $set on the document matched by a user chosen key instead of _id.
+    UPSERT = "upsert"
 
 
 class CollectionDestination(Destination):
     _cached_collection: AsyncIOMotorCollection
 
-    def __init__(self, database, collection, batch_size=128):
+    def __init__(self, database, collection, batch_size=1000, batch_bytes=MAX_BATCH_BYTES, max_in_flight=2,
+                 mode: Union[WriteMode, str] = WriteMode.SET, key: Optional[Union[str, list[str]]] = None,
+                 temporary=False):
         self._cached_collection = None
         self.database = database
         self.collection = collection
-        self.batch_size = batch_size
-        self.buffer = Queue()
+        self.temporary = temporary
+        self.mode = WriteMode(mode)
+        if self.mode == WriteMode.UPSERT and key is None:
+            raise Exception(f"Write mode {self.mode.value} into {database}/{collection} requires a key")
+        self.key = [key] if isinstance(key, str) else key
+        self.batch_size = min(batch_size, MAX_BATCH_COUNT)
+        self.batch_bytes = min(batch_bytes, MAX_BATCH_BYTES)
+        self.max_in_flight = max_in_flight
+        self.written = 0
+        self._buffer = list()
+        self._buffer_bytes = 0
+        self._in_flight = set()
+        self._slots = None
+        self._failure = None
 
     def init(self, client: AsyncIOMotorClient):
         self._cached_collection = client.get_database(self.database).get_collection(self.collection)
+        self._slots = asyncio.Semaphore(self.max_in_flight)
 
     async def push(self, item):
-        self.buffer.put(item)
-        if self.buffer.qsize() >= self.batch_size:
-            await self._flush()
+        await self.push_batch([item])
+
+    async def push_batch(self, items: list):
+        self._raise_failure()
+        if len(items) == 0:
+            return
+        # Sizes are sampled once per batch, only raw documents know theirs for free. The driver still splits any
+        # bulk write an estimate let grow past the server's limits.
+        average = estimate_batch_size(items) // len(items)
+        for item in items:
+            raw = getattr(item, "raw", None)
+            size = len(raw) if raw is not None else average
+            if len(self._buffer) > 0 and self._buffer_bytes + size > self.batch_bytes:
+                await self._flush()
+            self._buffer.append(item)
+            self._buffer_bytes += size
+            if len(self._buffer) >= self.batch_size:
+                await self._flush()
+
+    async def validate(self, client: AsyncIOMotorClient):
+        collection = client.get_database(self.database).get_collection(self.collection)
+        empty = await collection.find_one({}, projection={"_id": 1}) is None
+        if empty and self.mode != WriteMode.INSERT:
+            print(f"Warning: {self} is empty, write mode \"{WriteMode.INSERT.value}\" would be faster than \"{self.mode.value}\".")
+        elif not empty and self.mode == WriteMode.INSERT:
+            print(f"Warning: {self} is not empty, write mode \"{self.mode.value}\" may fail with duplicate keys.")
+
+    def _request(self, entry):
+        if isinstance(entry, Deletion):
+            if self.mode == WriteMode.INSERT:
+                raise Exception(f"{self} uses write mode {self.mode.value}, which cannot apply deletions")
+            return DeleteOne({"_id": entry.document_id})
+        if self.mode in (WriteMode.REPLACE, WriteMode.SET) and "_id" not in entry:
+            raise Exception(f"{self} uses write mode {self.mode.value}, which matches documents by _id, but got a "
+                            f"document without one. Keep the _id in the callbacks or write with mode insert.")
+        match self.mode:
+            case WriteMode.INSERT:
+                return entry
+            case WriteMode.REPLACE:
+                return ReplaceOne({"_id": entry["_id"]}, entry, upsert=True)
+            case WriteMode.SET:
+                return UpdateOne({
+                    "_id": entry["_id"]
+                }, {
+                    "$set": entry
+                }, upsert=True)
+            case WriteMode.UPSERT:
+                fields = {key: value for key, value in entry.items() if key != "_id"}
+                update = {"$set": fields}
+                if "_id" in entry:
+                    # _id is immutable, it can only be chosen when the upsert inserts.
+                    update["$setOnInsert"] = {"_id": entry["_id"]}
+                return UpdateOne({key: get_path(entry, key) for key in self.key}, update, upsert=True)
 
     async def _flush(self):
-        requests = list()
-        while not self.buffer.empty():
-            entry = self.buffer.get()
-            requests.append(UpdateOne({
-                "_id": entry["_id"]
-            }, {
-                "$set": entry
-            }, upsert=True))
-        self._cached_collection.bulk_write(requests)
+        if len(self._buffer) == 0:
+            return
+        requests = [self._request(entry) for entry in self._buffer]
+        size = self._buffer_bytes
+        self._buffer = list()
+        self._buffer_bytes = 0
+        if self._memory_budget is not None:
+            await self._memory_budget.acquire(size)
+        # Blocks the producer once max_in_flight writes are pending, which is what gives the pipeline backpressure.
+        await self._slots.acquire()
+        task = asyncio.create_task(self._write(requests, size))
+        self._in_flight.add(task)
+        task.add_done_callback(self._in_flight.discard)
+
+    async def _write(self, requests, size):
+        try:
+            start = time.perf_counter()
+            if self.mode == WriteMode.INSERT:
+                await self._cached_collection.insert_many(requests, ordered=False)
+            else:
+                await self._cached_collection.bulk_write(requests, ordered=False)
+            self.written += len(requests)
+            if self._metrics is not None:
+                self._metrics.observe_write(time.perf_counter() - start, len(requests), size)
+        except Exception as e:
+            if self._failure is None:
+                self._failure = e
+        finally:
+            self._slots.release()
+            if self._memory_budget is not None:
+                await self._memory_budget.release(size)
+
+    def _raise_failure(self):
+        if self._failure is not None:
+            raise Exception(f"Bulk write into {self} failed") from self._failure
+
+    def describe_write(self) -> str:
+        description = f"{self.mode.value} into {self}"
+        if self.key is not None:
+            description += f" keyed on {', '.join(self.key)}"
+        if self.temporary:
+            description += " (temporary collection)"
+        return description + f", batches of {self.batch_size}, {self.max_in_flight} in flight"
 
     def pipe_into(self, src, dest):
-        dest._source = CollectionSource(self.database, self.collection, None)
+        dest._add_source(CollectionSource(self.database, self.collection, None))
         dest.wait_for_phase(src)
 
+    async def flush(self):
+        # Returns once every document pushed so far has been acknowledged by the server.
+        await self._flush()
+        if len(self._in_flight) > 0:
+            await asyncio.gather(*self._in_flight)
+        self._raise_failure()
+
     async def close(self):
-        pass
+        await self.flush()
 
     def __str__(self):
         return f"{self.database}/{self.collection}"
@@ -1,14 +1,48 @@
 class Destination:
+    _memory_budget = None
+    _metrics = None
+
+    def use_metrics(self, metrics):
+        self._metrics = metrics
+
+    def use_memory_budget(self, account):
+        # Bytes held by this destination are charged to the account of the phase writing into it.
+        self._memory_budget = account
+
     async def push(self, item):
         pass
 
+    async def push_batch(self, items: list):
+        for item in items:
+            await self.push(item)
+
+    async def flush(self):
+        pass
+
     async def close(self):
         pass
 
     def init(self, client):
         pass
 
+    async def validate(self, client):
+        pass
+
     def hint_total(self, estimated_total):
         pass
+
+    def describe_write(self) -> str:
+        return str(self)
+
+    def streams_into(self, phase: "mongrations.phase.Phase") -> bool:
+        return False
+
+    def consumed(self) -> bool:
+        # Whether a dependant already reads everything pushed here, another one then needs a branch of its own.
+        return False
+
+    def branches(self) -> list["Destination"]:
+        return [self]
+
     def pipe_into(self, source: "mongrations.phase.Phase", destination: "mongrations.phase.Phase"):
         pass
\ No newline at end of file
@@ -0,0 +1,107 @@
+from typing import Optional
+
+from motor.motor_asyncio import AsyncIOMotorClient
+
+from mongrations.io.destination import Destination
+from mongrations.io.partitioning import combine_filters
+from mongrations.io.source import CollectionSource, Source, _flatten
+from mongrations.misc.documents import Deletion
+from mongrations.misc.matching import Restriction, matches, project, validate_query
+from mongrations.misc.streams import batched
+
+
+class MemoryCollection(Destination):
+    # Stands in for a collection during a dry run, the documents never leave the process.
+    def __init__(self, database: str, collection: str):
+        self.database = database
+        self.collection = collection
+        self.documents = list()
+
+    async def push_batch(self, items: list):
+        self.documents.extend(item for item in items if not isinstance(item, Deletion))
+
+    async def push(self, item):
+        await self.push_batch([item])
+
+    def pipe_into(self, src, dest):
+        dest._add_source(MemorySource(self))
+        dest.wait_for_phase(src)
+
+    def reader_like(self, source: CollectionSource) -> "MemorySource":
+        # Keeps whatever was pushed down into the collection source the dependant used to read this collection with.
+        filter, projection = source.query()
+        return MemorySource(self, filter, projection, source.pipeline)
+
+    def __str__(self):
+        return f"{self.database}/{self.collection} (in memory)"
+
+
+class MemorySource(Source):
+    def __init__(self, memory: MemoryCollection, filter: Optional[dict] = None, projection: Optional[dict] = None,
+                 pipeline: Optional[list[dict]] = None):
+        self.memory = memory
+        self.database = memory.database
+        self.collection = memory.collection
+        self._filter = filter
+        self._projection = projection
+        self.pipeline = pipeline
+
+    def restrict(self, restriction: Restriction):
+        self._filter = combine_filters(self._filter, restriction.where)
+        projection = restriction.projection()
+        if projection is not None:
+            self._projection = projection if self._projection is None else self._projection | projection
+
+    def _local(self) -> bool:
+        try:
+            validate_query(self._filter)
+        except Exception:
+            return False
+        return True
+
+    def _documents(self):
+        fields = None if self._projection is None else list(self._projection.keys())
+        for document in self.memory.documents:
+            if not matches(document, self._filter):
+                continue
+            yield document if fields is None else project(document, fields)
+
+    async def cursor(self, client: AsyncIOMotorClient):
+        batches, estimated_total = await self.batches(client, 1000)
+        return _flatten(batches), estimated_total
+
+    async def batches(self, client: AsyncIOMotorClient, batch_size: int):
+        if self.pipeline is not None or not self._local():
+            # Stages of a fused aggregation and filters using operators only the server knows cannot be evaluated
+            # locally, the server runs them on the documents.
+            cursor = self.aggregate_on(client).aggregate(self.pipeline_stages(), batchSize=batch_size)
+            return self.charge_cursor(batched(cursor, batch_size)), len(self.memory.documents)
+        return batched(_iterate(self._documents()), batch_size), len(self.memory.documents)
+
+    def pipeline_stages(self) -> list[dict]:
+        # $documents runs the aggregation on the documents themselves, it needs MongoDB 5.1 or newer.
+        stages = [{"$documents": self.memory.documents}]
+        if self._filter:
+            stages.append({"$match": self._filter})
+        if self.pipeline is not None:
+            stages.extend(self.pipeline)
+        if self._projection is not None:
+            stages.append({"$project": self._projection})
+        return stages
+
+    def union_stage(self) -> dict:
+        return {"$unionWith": {"pipeline": self.pipeline_stages()}}
+
+    def aggregate_on(self, client: AsyncIOMotorClient):
+        return client.get_database(self.database)
+
+    async def estimate_total(self, client: AsyncIOMotorClient) -> int:
+        return len(self.memory.documents)
+
+    def __str__(self):
+        return str(self.memory)
+
+
+async def _iterate(documents):
+    for document in documents:
+        yield document
@@ -0,0 +1,55 @@
+from typing import Any, Optional
+
+from motor.motor_asyncio import AsyncIOMotorCollection
+
+# How many sampled documents back each partition boundary.
+SAMPLES_PER_PARTITION = 256
+
+
+def combine_filters(*filters: Optional[dict]) -> Optional[dict]:
+    filters = [f for f in filters if f]
+    match len(filters):
+        case 0:
+            return None
+        case 1:
+            return filters[0]
+        case _:
+            return {"$and": filters}
+
+
+async def compute_boundaries(collection: AsyncIOMotorCollection, key: str, filter: Optional[dict],
+                             partitions: int) -> list[Any]:
+    # $bucketAuto over a $sample instead of the whole collection, so splitting stays cheap on huge collections.
+    pipeline = list()
+    if filter:
+        pipeline.append({"$match": filter})
+    pipeline.append({"$sample": {"size": partitions * SAMPLES_PER_PARTITION}})
+    pipeline.append({"$bucketAuto": {"groupBy": f"${key}", "buckets": partitions}})
+    buckets = await collection.aggregate(pipeline).to_list(None)
+    return [bucket["_id"]["min"] for bucket in buckets[1:]]
+
+
+def range_filter(key: str, lower, upper) -> Optional[dict]:
+    bounds = dict()
+    if lower is not None:
+        bounds["$gte"] = lower
+    if upper is not None:
+        bounds["$lt"] = upper
+    if len(bounds) == 0:
+        return None
+    return {key: bounds}
+
+
+def partition_ranges(boundaries: list[Any]) -> list[tuple[Any, Any]]:
+    # The first and last ranges are open ended, documents outside the sampled range still belong to a partition.
+    edges = [None] + list(boundaries) + [None]
+    return [(edges[i], edges[i + 1]) for i in range(len(edges) - 1)]
+
+
+def partition_filters(key: str, boundaries: list[Any]) -> list[Optional[dict]]:
+    ranges = [range_filter(key, lower, upper) for lower, upper in partition_ranges(boundaries)]
+    if len(boundaries) == 0:
+        return ranges
+    # $gte and $lt only match values of the bound's BSON type. Documents whose key is missing, null or of another type
+    # fall in none of the ranges, the last partition reads them.
+    return ranges + [{"$nor": ranges}]
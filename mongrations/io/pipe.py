@@ -1,42 +1,137 @@
 import asyncio
+from collections import deque
+from typing import Optional
 
 from motor.motor_asyncio import AsyncIOMotorClient
 
 from mongrations.io.destination import Destination
 from mongrations.io.source import Source
+from mongrations.misc.documents import estimate_batch_size
+from mongrations.misc.matching import Restriction, validate_query
 
 
 class Pipe(Source, Destination):
-    def __init__(self):
-        self._queue = asyncio.Queue()
+    def __init__(self, capacity: int = 4096, capacity_bytes: Optional[int] = None):
+        self.capacity = capacity
+        self.capacity_bytes = capacity_bytes
+        self._chunks = deque()
+        self._size = 0
+        self._bytes = 0
         self._end_of_pipe = False
         self._total_hint = None
+        self._hinted = asyncio.Event()
+        self._changed = asyncio.Condition()
+        self._restriction = None
+        self._consumer = None
+
+    def resize(self, capacity: Optional[int] = None, capacity_bytes: Optional[int] = None):
+        if capacity is not None:
+            self.capacity = capacity
+        if capacity_bytes is not None:
+            self.capacity_bytes = capacity_bytes
+
+    def restrict(self, restriction: Restriction):
+        # The producer is a python callback, so the restriction is applied as documents enter the pipe.
+        validate_query(restriction.where)
+        self._restriction = restriction
+
+    def _has_room(self, count, size):
+        # An empty pipe always accepts a chunk, otherwise chunks bigger than the capacity would never get through.
+        if len(self._chunks) == 0:
+            return True
+        if self.capacity is not None and self._size + count > self.capacity:
+            return False
+        if self.capacity_bytes is not None and self._bytes + size > self.capacity_bytes:
+            return False
+        return True
 
     async def push(self, item):
-        await self._queue.put(item)
+        await self.push_batch([item])
+
+    async def push_batch(self, items: list):
+        if self._restriction is not None:
+            items = self._restriction.apply(items)
+        count = len(items)
+        if count == 0:
+            return
+        size = 0
+        if self.capacity_bytes is not None or self._memory_budget is not None or self._metrics is not None:
+            size = estimate_batch_size(items)
+        if self._memory_budget is not None:
+            # Charged to the producer until the consumer takes the chunk out. The pipe's capacity bounds it already,
+            # waiting for the budget here could block the very consumer that would free it.
+            self._memory_budget.charge(size)
+        async with self._changed:
+            await self._changed.wait_for(lambda: self._has_room(count, size))
+            self._chunks.append((items, size))
+            self._size += count
+            self._bytes += size
+            if self._metrics is not None:
+                self._metrics.observe_write(None, count, size)
+                self._metrics.observe_queue(self._size)
+            self._changed.notify_all()
 
     async def close(self):
-        self._end_of_pipe = True
-        # Add a sentinel value to unblock the cursor if it's waiting for items.
-        await self._queue.put(None)
+        async with self._changed:
+            self._end_of_pipe = True
+            self._changed.notify_all()
+        # Consumers must not wait forever on a producer that closed without hinting a total.
+        self._hinted.set()
 
     async def cursor(self, client: AsyncIOMotorClient):
-        while self._total_hint is None:
-            await asyncio.sleep(0)
+        await self._hinted.wait()
         return self._cursor(), self._total_hint
 
+    async def batches(self, client: AsyncIOMotorClient, batch_size: int):
+        await self._hinted.wait()
+        return self._batches(), self._total_hint
+
+    async def _batches(self):
+        # Chunks are handed over exactly as they were pushed, so batch boundaries survive the pipe.
+        while True:
+            async with self._changed:
+                await self._changed.wait_for(lambda: len(self._chunks) > 0 or self._end_of_pipe)
+                if len(self._chunks) == 0:
+                    return
+                chunk, size = self._chunks.popleft()
+                self._size -= len(chunk)
+                self._bytes -= size
+                self._changed.notify_all()
+            if self._memory_budget is not None:
+                await self._memory_budget.discharge(size)
+            yield chunk
+
     async def _cursor(self):
-        while not (self._end_of_pipe and self._queue.empty()):
-            item = await self._queue.get()
-            if item is None:
-                break
-            yield item
+        async for chunk in self._batches():
+            for item in chunk:
+                yield item
+
+    def describe_read(self, checkpointed: bool) -> str:
+        return "streamed from the producing phase"
+
+    def pushdown(self):
+        return None if self._restriction is None else str(self._restriction)
+
+    def describe_write(self) -> str:
+        limits = [f"{self.capacity} docs"] if self.capacity is not None else []
+        if self.capacity_bytes is not None:
+            limits.append(f"{self.capacity_bytes} bytes")
+        return f"pipe holding up to {' / '.join(limits) or 'unbounded'}"
 
     def pipe_into(self, src, dst):
-        dst._source = self
+        self._consumer = dst
+        dst._add_source(self)
+
+    def consumed(self) -> bool:
+        # Each chunk is handed to a single reader, two dependants reading the same pipe would split the documents.
+        return self._consumer is not None
+
+    def streams_into(self, phase) -> bool:
+        return any(source is self for source in phase.sources())
 
     def __str__(self):
         return "Pipe"
 
     def hint_total(self, estimated_total):
         self._total_hint = estimated_total
+        self._hinted.set()
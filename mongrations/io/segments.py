@@ -0,0 +1,199 @@
+import asyncio
+import mmap
+import shutil
+import struct
+import tempfile
+import time
+from pathlib import Path
+from typing import Optional
+
+import bson
+from bson.codec_options import DEFAULT_CODEC_OPTIONS
+from motor.motor_asyncio import AsyncIOMotorClient
+
+from mongrations.io.destination import Destination
+from mongrations.io.partitioning import combine_filters
+from mongrations.io.source import Source, _flatten
+from mongrations.misc.documents import Deletion
+from mongrations.misc.lazy_bson import RAW_CODEC_OPTIONS
+from mongrations.misc.matching import Restriction, matches, project, validate_query
+
+_INT32 = struct.Struct("<i")
+
+DEFAULT_SEGMENT_SIZE = 64 * 2 ** 20
+
+
+class SegmentStore(Destination):
+    # Keeps the output of a phase in append-only BSON files on the local disk, for dependants that process it in
+    # this process. The server never sees these documents, unlike with a temporary collection. Every dependant reads
+    # the whole store with a source of its own once the phase writing it completes.
+    def __init__(self, root: Path, name: str, segment_size: int = DEFAULT_SEGMENT_SIZE, raw: bool = False):
+        self.root = Path(root)
+        self.name = name
+        self.namespace = "mongration"
+        # Created by init, every run gets a directory of its own.
+        self.directory = None
+        self.segment_size = segment_size
+        # Dependants read LazyDocuments instead of decoding every field up front.
+        self.raw = raw
+        self.segment_count = 0
+        self.count = 0
+        self.size = 0
+        self._file = None
+        self._written = 0
+
+    def use_namespace(self, namespace: str):
+        self.namespace = namespace
+
+    def init(self, client):
+        self.discard()
+        self.root.mkdir(parents=True, exist_ok=True)
+        # Unique per run, other runs of the same mongration or phases whose names sanitize alike never share it.
+        self.directory = Path(tempfile.mkdtemp(prefix=f"{_file_name(self.namespace)}-{_file_name(self.name)}-",
+                                               dir=self.root))
+
+    def _roll(self):
+        if self._file is not None:
+            self._file.close()
+        self._file = open(self.directory / f"segment-{self.segment_count:05}.bson", "wb")
+        self.segment_count += 1
+        self._written = 0
+
+    async def push_batch(self, items: list):
+        start = time.perf_counter()
+        count, size = 0, 0
+        for item in items:
+            if isinstance(item, Deletion):
+                continue
+            raw = getattr(item, "raw", None)
+            encoded = raw if raw is not None else bson.encode(item)
+            if self._file is None or (self._written > 0 and self._written + len(encoded) > self.segment_size):
+                self._roll()
+            self._file.write(encoded)
+            self._written += len(encoded)
+            count += 1
+            size += len(encoded)
+        self.count += count
+        self.size += size
+        if self._metrics is not None:
+            self._metrics.observe_write(time.perf_counter() - start, count, size)
+
+    async def push(self, item):
+        await self.push_batch([item])
+
+    async def flush(self):
+        if self._file is not None:
+            self._file.flush()
+
+    async def close(self):
+        if self._file is not None:
+            self._file.close()
+            self._file = None
+
+    def discard(self):
+        if self._file is not None:
+            self._file.close()
+            self._file = None
+        self.segment_count = 0
+        self.count = 0
+        self.size = 0
+        if self.directory is not None:
+            shutil.rmtree(self.directory, ignore_errors=True)
+            self.directory = None
+
+    def segments(self) -> list[Path]:
+        if self.directory is None:
+            return []
+        return sorted(self.directory.glob("segment-*.bson"))
+
+    def pipe_into(self, src, dest):
+        dest._add_source(SegmentSource(self))
+        dest.wait_for_phase(src)
+
+    def describe_write(self) -> str:
+        return f"{self} (local BSON segments of up to {self.segment_size / 2 ** 20:.0f} MiB)"
+
+    def __str__(self):
+        if self.directory is None:
+            return str(self.root / f"{_file_name(self.namespace)}-{_file_name(self.name)}-*")
+        return str(self.directory)
+
+
+def _file_name(name: str) -> str:
+    return "".join(character if character.isalnum() or character in "-_" else "-" for character in name)
+
+
+class SegmentSource(Source):
+    # Maps each segment in turn and decodes a batch at a time straight out of the mapping, without reading the
+    # file into a buffer first.
+    def __init__(self, store: SegmentStore, filter: Optional[dict] = None, projection: Optional[dict] = None):
+        self.store = store
+        self._filter = filter
+        self._projection = projection
+
+    def restrict(self, restriction: Restriction):
+        self._filter = combine_filters(self._filter, restriction.where)
+        projection = restriction.projection()
+        if projection is not None:
+            self._projection = projection if self._projection is None else self._projection | projection
+
+    def pushdown(self) -> Optional[str]:
+        parts = list()
+        if self._filter:
+            parts.append(f"filter on {', '.join(self._filter.keys())} (applied locally)")
+        if self._projection is not None:
+            parts.append(f"projection of {len(self._projection)} fields")
+        return ", ".join(parts) if len(parts) > 0 else None
+
+    def _segment_batches(self, path: Path, batch_size: int):
+        with open(path, "rb") as file:
+            if file.seek(0, 2) == 0:
+                return
+            mapping = mmap.mmap(file.fileno(), 0, access=mmap.ACCESS_READ)
+        codec_options = RAW_CODEC_OPTIONS if self.store.raw else DEFAULT_CODEC_OPTIONS
+        view = memoryview(mapping)
+        try:
+            start, end = 0, len(view)
+            while start < end:
+                position = start
+                for _ in range(batch_size):
+                    if position >= end:
+                        break
+                    position += _INT32.unpack_from(view, position)[0]
+                # Decoding copies the documents out, nothing keeps the mapping alive past this segment.
+                yield bson.decode_all(view[start:position], codec_options)
+                start = position
+        finally:
+            view.release()
+            mapping.close()
+
+    async def _batches(self, batch_size: int):
+        validate_query(self._filter)
+        fields = None if self._projection is None else list(self._projection.keys())
+        for path in self.store.segments():
+            for batch in self._segment_batches(path, batch_size):
+                if self._filter:
+                    batch = [document for document in batch if matches(document, self._filter)]
+                if fields is not None:
+                    batch = [project(document, fields) for document in batch]
+                if len(batch) > 0:
+                    yield batch
+                # Decoding does not wait on anything, the other phases get the loop between batches.
+                await asyncio.sleep(0)
+
+    async def cursor(self, client: AsyncIOMotorClient):
+        batches, estimated_total = await self.batches(client, 1000)
+        return _flatten(batches), estimated_total
+
+    async def batches(self, client: AsyncIOMotorClient, batch_size: int):
+        return self._batches(batch_size), await self.estimate_total(client)
+
+    async def estimate_total(self, client: AsyncIOMotorClient) -> Optional[int]:
+        return self.store.count if self.store.segment_count > 0 else None
+
+    def describe_read(self, checkpointed: bool) -> str:
+        return "read from local segments, nothing crosses the wire"
+
+    def __str__(self):
+        return str(self.store)
+
@@ -2,23 +2,369 @@ from typing import Optional
 
 from motor.motor_asyncio import AsyncIOMotorClient
 
+from mongrations.io.change_stream import ChangeFeed, current_operation_time
+from mongrations.io.partitioning import combine_filters, compute_boundaries, partition_filters
+from mongrations.misc.documents import get_path
+from mongrations.misc.lazy_bson import RAW_CODEC_OPTIONS
+from mongrations.misc.matching import Restriction, project
+from mongrations.misc.streams import batched, merge
+
+
+class PartitionBatch(list):
+    # A batch that remembers which partition of its source it was read from.
+    def __init__(self, partition: int, items):
+        super().__init__(items)
+        self.partition = partition
+
 
 class Source:
-    pass
+    _cursor_budget = None
+
+    def use_cursor_budget(self, account):
+        self._cursor_budget = account
+
+    def charge_cursor(self, iterator):
+        # Every server cursor is charged on its own while it is read, partitions of a scan never wait for each other.
+        if self._cursor_budget is None:
+            return iterator
+        return _charge_cursor(iterator, self._cursor_budget)
 
     def cursor(self, client: AsyncIOMotorClient):
         pass
 
+    async def batches(self, client: AsyncIOMotorClient, batch_size: int):
+        cursor, estimated_total = await self.cursor(client)
+        return batched(cursor, batch_size), estimated_total
+
+    def progress_postfix(self) -> Optional[str]:
+        return None
+
+    def restrict(self, restriction: Restriction):
+        pass
+
+    def resumable(self):
+        return False
+
+    def resume(self, state: Optional[dict]):
+        pass
+
+    def acknowledge(self, batch: list):
+        pass
+
+    def checkpoint_state(self) -> Optional[dict]:
+        return None
+
+    def watermark_field(self) -> Optional[str]:
+        return None
+
+    def describe_read(self, checkpointed: bool) -> str:
+        return str(self)
+
+    def pushdown(self) -> Optional[str]:
+        return None
+
 
 class CollectionSource(Source):
-    def __init__(self, database: str, collection: str, filter: Optional[dict]):
+    def __init__(self, database: str, collection: str, filter: Optional[dict], partitions: int = 1,
+                 partition_key: str = "_id", pipeline: Optional[list[dict]] = None, watermark: Optional[str] = None,
+                 raw: bool = False):
         self.database = database
         self.collection = collection
         self._filter = filter
+        # Stages applied server side on top of the collection, for sources that stand in for a fused aggregation.
+        self.pipeline = pipeline
+        self.partitions = partitions
+        self.partition_key = partition_key
+        self.partition_counts = list[int]()
+        self._projection = None
+        self._boundaries = None
+        self._tracking = False
+        self._positions = dict()
+        self._acknowledged = dict()
+        self.watermark = watermark
+        self.watermark_reached = None
+        self.live = False
+        self._feed = None
+        self._stopped = False
+        # Dry runs read a random sample of the collection, full_count keeps the size of the whole of it.
+        self.sample = None
+        self.full_count = None
+        # Documents are kept as the BSON the server sent, fields are decoded when a callback reads them.
+        self.raw = raw
+        # Readers that need the documents in key order (merge joins) get a single scan sorted on it.
+        self.sort_key = None
 
-    async def cursor(self, client: AsyncIOMotorClient):
+    def restrict(self, restriction: Restriction):
+        self._filter = combine_filters(self._filter, restriction.where)
+        projection = restriction.projection()
+        if projection is not None:
+            if self._projection is not None:
+                projection = self._projection | projection
+            self._projection = projection
+
+    def resumable(self):
+        return self.pipeline is None
+
+    def watermark_field(self) -> Optional[str]:
+        return self.watermark
+
+    def enable_live(self):
+        self.live = True
+
+    def use_sample(self, size: int):
+        self.sample = size
+
+    def sort_by(self, key: str):
+        self.sort_key = key
+
+    def use_partition(self, boundaries: list, number: int):
+        # Distributed workers read a single partition, the others are leased to other workers.
+        self._filter = combine_filters(self._filter, partition_filters(self.partition_key, boundaries)[number])
+        self.partitions = 1
+
+    def stop(self):
+        self._stopped = True
+        if self._feed is not None:
+            self._feed.stop()
+
+    async def _follow(self, snapshot, feed: ChangeFeed):
+        async for batch in snapshot:
+            yield batch
+        if self._stopped:
+            return
+        self._feed = feed
+        fields = None if self._projection is None else list(self._projection.keys())
+        # The change stream only holds its cursor once the snapshot's cursors are done.
+        async for batch in self.charge_cursor(feed.batches()):
+            if fields is not None:
+                batch = [item if not isinstance(item, dict) else project(item, fields) for item in batch]
+            yield batch
+
+    def restore_watermark(self, value):
+        # Only documents past the previous run's watermark are read, and their values keep raising it.
+        self.watermark_reached = value
+        if value is not None:
+            self._filter = combine_filters(self._filter, {self.watermark: {"$gt": value}})
+
+    async def _track_watermark(self, batches):
+        async for batch in batches:
+            reached = self.watermark_reached
+            for doc in batch:
+                value = get_path(doc, self.watermark)
+                if value is None:
+                    continue
+                try:
+                    if reached is None or value > reached:
+                        reached = value
+                except TypeError:
+                    continue
+            self.watermark_reached = reached
+            yield batch
+
+    def resume(self, state: Optional[dict]):
+        # Resuming needs a deterministic scan order, every partition is read sorted by the partition key.
+        self._tracking = True
+        if state is None:
+            return
+        self._boundaries = state["boundaries"]
+        self._positions = {index: position for index, position in state["positions"]}
+        self._acknowledged = dict(self._positions)
+
+    def acknowledge(self, batch: list):
+        # The partition catching keys of other types is read again whole, $gt would skip them by type as well.
+        if self._tracking and isinstance(batch, PartitionBatch) and len(batch) > 0 \
+                and batch.partition <= len(self._boundaries):
+            self._acknowledged[batch.partition] = self._position(batch[-1])
+
+    def _position(self, document):
+        value = get_path(document, self.partition_key)
+        if self.partition_key == "_id":
+            return value
+        # Other keys may repeat, the _id breaks ties so documents sharing the last key are not skipped on resume.
+        return [value, get_path(document, "_id")]
+
+    def _after(self, position) -> dict:
+        if self.partition_key == "_id":
+            return {"_id": {"$gt": position}}
+        value, document_id = position
+        return {"$or": [{self.partition_key: {"$gt": value}},
+                        {self.partition_key: value, "_id": {"$gt": document_id}}]}
+
+    def _resume_order(self) -> list:
+        if self.partition_key == "_id":
+            return [("_id", 1)]
+        return [(self.partition_key, 1), ("_id", 1)]
+
+    def checkpoint_state(self) -> Optional[dict]:
+        if not self._tracking:
+            return None
+        return {
+            "boundaries": self._boundaries,
+            "positions": [[index, position] for index, position in self._acknowledged.items()]
+        }
+
+    def pipeline_stages(self) -> list[dict]:
+        stages = list()
+        if self._filter:
+            stages.append({"$match": self._filter})
+        if self.sample is not None:
+            stages.append({"$sample": {"size": self.sample}})
+        if self.pipeline is not None:
+            stages.extend(self.pipeline)
+        if self.sort_key is not None:
+            stages.append({"$sort": {self.sort_key: 1}})
+        if self._projection is not None:
+            stages.append({"$project": self._projection})
+        return stages
+
+    def query(self) -> tuple[Optional[dict], Optional[dict]]:
+        return self._filter, self._projection
+
+    def describe_read(self, checkpointed: bool) -> str:
+        if self.sample is not None:
+            strategy = f"$sample of {self.sample} documents"
+        elif self.pipeline is not None:
+            strategy = f"aggregate with {len(self.pipeline)} fused stages"
+        elif self.partitions > 1:
+            strategy = f"{self.partitions} parallel range scans on {self.partition_key}"
+        else:
+            strategy = "single find"
+        if self.sort_key is not None:
+            strategy += f", sorted on {self.sort_key}"
+        elif checkpointed and self.resumable():
+            strategy += f", sorted on {', '.join(key for key, _ in self._resume_order())} to resume from checkpoints"
+        if self.watermark is not None:
+            strategy += f", incremental on {self.watermark}"
+        if self.live:
+            strategy += ", then follows the change stream"
+        if self.raw:
+            strategy += ", kept as raw BSON"
+        return strategy
+
+    def pushdown(self) -> Optional[str]:
+        parts = list()
+        if self._filter:
+            parts.append(f"filter on {', '.join(self._filter.keys())}")
+        if self._projection is not None:
+            parts.append(f"projection of {len(self._projection)} fields")
+        return ", ".join(parts) if len(parts) > 0 else None
+
+    def union_stage(self) -> dict:
+        return {"$unionWith": {"coll": self.collection, "pipeline": self.pipeline_stages()}}
+
+    def aggregate_on(self, client: AsyncIOMotorClient):
         collection = client.get_database(self.database).get_collection(self.collection)
-        return collection.find(filter=self._filter), await collection.estimated_document_count(maxTimeMS=2 * 1000)
+        if self.raw:
+            collection = collection.with_options(codec_options=RAW_CODEC_OPTIONS)
+        return collection
+
+    async def estimate_total(self, client: AsyncIOMotorClient) -> int:
+        collection = client.get_database(self.database).get_collection(self.collection)
+        if self.sample is not None and self._filter:
+            # The sample is drawn from the filtered documents, the dry run projects from how many of them there are.
+            self.full_count = await collection.count_documents(self._filter)
+        else:
+            self.full_count = await collection.estimated_document_count(maxTimeMS=2 * 1000)
+        if self.sample is not None:
+            return min(self.sample, self.full_count)
+        return self.full_count
+
+    async def cursor(self, client: AsyncIOMotorClient):
+        if self.pipeline is not None or self.sample is not None:
+            batches, estimated_total = await self.batches(client, 1000)
+            return _flatten(batches), estimated_total
+        if self.partitions > 1 or self._tracking or self.watermark is not None:
+            batches, estimated_total = await self.batches(client, 1000)
+            return _flatten(batches), estimated_total
+        collection = self.aggregate_on(client)
+        return collection.find(filter=self._filter, projection=self._projection), await collection.estimated_document_count(maxTimeMS=2 * 1000)
+
+    async def batches(self, client: AsyncIOMotorClient, batch_size: int):
+        start = await current_operation_time(client) if self.live else None
+        batches, estimated_total = await self._batches(client, batch_size)
+        if self.live:
+            collection = client.get_database(self.database).get_collection(self.collection)
+            batches = self._follow(batches, ChangeFeed(collection, start, self._filter, batch_size))
+        if self.watermark is not None:
+            batches = self._track_watermark(batches)
+        return batches, estimated_total
+
+    async def _batches(self, client: AsyncIOMotorClient, batch_size: int):
+        collection = self.aggregate_on(client)
+        estimated_total = await self.estimate_total(client)
+        if self.pipeline is not None or self.sample is not None:
+            cursor = collection.aggregate(self.pipeline_stages(), batchSize=batch_size)
+            return self.charge_cursor(batched(cursor, batch_size)), estimated_total
+        projection = self._projection
+        if projection is not None and self.watermark is not None and self.watermark not in projection:
+            projection = projection | {self.watermark: 1}
+        if self.sort_key is not None and projection is not None and self.sort_key not in projection:
+            projection = projection | {self.sort_key: 1}
+        if (self.partitions <= 1 or self.sort_key is not None) and not self._tracking:
+            # Partitions are read concurrently and interleave, a sorted read has to be a single scan.
+            sort = [(self.sort_key, 1)] if self.sort_key is not None else None
+            cursor = collection.find(filter=self._filter, projection=projection, sort=sort, batch_size=batch_size)
+            return self.charge_cursor(batched(cursor, batch_size)), estimated_total
+
+        if self._boundaries is None:
+            self._boundaries = list()
+            if self.partitions > 1:
+                # Boundaries end up in the checkpoint state, they are always decoded.
+                plain = client.get_database(self.database).get_collection(self.collection)
+                self._boundaries = await compute_boundaries(plain, self.partition_key, self._filter, self.partitions)
+        if projection is not None and self.partition_key not in projection:
+            projection = projection | {self.partition_key: 1}
+        if projection is not None and self._tracking:
+            projection = projection | {"_id": 1}
+        sort = self._resume_order() if self._tracking else None
+        cursors = list()
+        for index, bounds in enumerate(partition_filters(self.partition_key, self._boundaries)):
+            resume_filter = None
+            if index in self._positions:
+                resume_filter = self._after(self._positions[index])
+            partition_filter = combine_filters(self._filter, bounds, resume_filter)
+            cursor = collection.find(filter=partition_filter, projection=projection, sort=sort, batch_size=batch_size)
+            cursors.append(self.charge_cursor(batched(cursor, batch_size)))
+        self.partition_counts = [0] * len(cursors)
+        if len(cursors) == 1:
+            return self._single_partition(cursors[0]), estimated_total
+        return self._merge_partitions(cursors), estimated_total
+
+    async def _single_partition(self, cursor):
+        async for batch in cursor:
+            yield PartitionBatch(0, batch)
+
+    async def _merge_partitions(self, cursors):
+        async for index, batch in merge(cursors):
+            self.partition_counts[index] += len(batch)
+            yield PartitionBatch(index, batch)
+
+    def progress_postfix(self) -> Optional[str]:
+        if self._feed is not None and self._feed.lag is not None:
+            return f"live, {self._feed.changes} changes, lag {self._feed.lag:.1f}s"
+        if len(self.partition_counts) <= 1:
+            return None
+        counts = self.partition_counts
+        return f"{len(counts)} partitions, min {min(counts)} / max {max(counts)} docs"
 
     def __str__(self):
+        if self.pipeline is not None:
+            return f"{self.database}/{self.collection} (+{len(self.pipeline)} stages)"
+        if self.partitions > 1:
+            return f"{self.database}/{self.collection} ({self.partitions} partitions on {self.partition_key})"
         return f"{self.database}/{self.collection}"
+
+
+async def _flatten(batches):
+    async for batch in batches:
+        for item in batch:
+            yield item
+
+
+async def _charge_cursor(iterator, account):
+    await account.open_cursor()
+    try:
+        async for item in iterator:
+            yield item
+    finally:
+        await account.close_cursor()
@@ -0,0 +1,94 @@
+import asyncio
+import copy
+
+from mongrations.io.destination import Destination
+from mongrations.io.pipe import Pipe
+from mongrations.misc.documents import Deletion
+from mongrations.misc.lazy_bson import LazyDocument
+
+
+class Tee(Destination):
+    # Fans the output of one phase out to every dependant reading it, so the phase runs once however many consume it.
+    # A batch is only accepted once every branch accepted it, the slowest consumer sets the pace of the producer.
+    def __init__(self, branches: list[Destination]):
+        self._branches = list(branches)
+
+    @staticmethod
+    def of(output: Destination, branch: Destination) -> "Tee":
+        if isinstance(output, Tee):
+            output.add_branch(branch)
+            return output
+        return Tee([output, branch])
+
+    def add_branch(self, branch: Destination):
+        self._branches.append(branch)
+
+    def replace_branch(self, old: Destination, new: Destination):
+        self._branches = [new if branch is old else branch for branch in self._branches]
+
+    def branches(self) -> list[Destination]:
+        return list(self._branches)
+
+    def use_memory_budget(self, account):
+        for branch in self._branches:
+            branch.use_memory_budget(account)
+
+    def use_metrics(self, metrics):
+        # Every branch reports its own writes, a document sent to two branches is counted twice.
+        for branch in self._branches:
+            branch.use_metrics(metrics)
+
+    async def push(self, item):
+        await self.push_batch([item])
+
+    async def push_batch(self, items: list):
+        # Python consumers change documents in place while collections still hold them in their write buffer. Pipes
+        # get copies of their own, unless every branch is a pipe, the first one then keeps the originals.
+        pushes = list()
+        shared = all(isinstance(branch, Pipe) for branch in self._branches)
+        for branch in self._branches:
+            if isinstance(branch, Pipe):
+                pushes.append(branch.push_batch(items if shared else _copies(items)))
+                shared = False
+            else:
+                pushes.append(branch.push_batch(items))
+        await asyncio.gather(*pushes)
+
+    async def flush(self):
+        await asyncio.gather(*(branch.flush() for branch in self._branches))
+
+    async def close(self):
+        await asyncio.gather(*(branch.close() for branch in self._branches))
+
+    def init(self, client):
+        for branch in self._branches:
+            branch.init(client)
+
+    async def validate(self, client):
+        for branch in self._branches:
+            await branch.validate(client)
+
+    def hint_total(self, estimated_total):
+        for branch in self._branches:
+            branch.hint_total(estimated_total)
+
+    def describe_write(self) -> str:
+        return f"tee into {len(self._branches)} branches: {'; '.join(branch.describe_write() for branch in self._branches)}"
+
+    def streams_into(self, phase) -> bool:
+        return any(branch.streams_into(phase) for branch in self._branches)
+
+    def __str__(self):
+        return f"Tee({', '.join(str(branch) for branch in self._branches)})"
+
+
+def _copies(items: list) -> list:
+    copies = list()
+    for item in items:
+        if isinstance(item, Deletion):
+            copies.append(item)
+        elif isinstance(item, LazyDocument):
+            copies.append(item.copy())
+        else:
+            copies.append(copy.deepcopy(item))
+    return copies
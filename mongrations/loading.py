@@ -3,9 +3,15 @@ import sys
 from pathlib import Path
 
 from mongrations.engine.asyncio_engine import AsyncIOEngine
-from mongrations.graph import DependencyGraph
+from mongrations.engine.governor import parse_size
 from mongrations.mongration import Mongration
 from mongrations.phase import Phase
+from mongrations.planning import plan
+from mongrations.settings import Settings, DEFAULT_URI
+
+
+# Drawing is quadratic in the canvas size, generated mongrations with hundreds of phases skip it.
+MAX_DRAWN_PHASES = 32
 
 
 def load_mongration_script(script_path: Path):
@@ -31,7 +37,34 @@ def run_mongration(args):
 
     mongration_function = load_mongration_script(mongration_path)
     if mongration_function:
-        engine = AsyncIOEngine()
+        settings = Settings(
+            uri=args.uri or DEFAULT_URI,
+            namespace=mongration_path.stem,
+            checkpoint=args.checkpoint,
+            checkpoint_interval=args.checkpoint_interval,
+            state_file=args.state_file,
+            live=args.live,
+            max_concurrent_phases=args.max_concurrent_phases,
+            memory_budget=parse_size(args.memory_budget),
+            cursor_budget=args.cursor_budget,
+            metrics_json=args.metrics_json,
+            metrics_prometheus=args.metrics_prom,
+            profile=args.profile,
+            dry_run=args.dry_run,
+            sample=args.sample,
+            script=str(mongration_path.absolute()),
+            distributed=args.distributed or args.workers > 0,
+            workers=args.workers,
+            partitions=args.partitions,
+            lease_ttl=args.lease_ttl,
+        )
+        engine = AsyncIOEngine(settings)
+        if args.explain:
+            engine.explain(lambda: load_mongration(mongration_function))
+            return
+        if args.worker:
+            engine.work(lambda: load_mongration(mongration_function, draw=False), args.worker_id)
+            return
         engine.invoke(lambda: load_mongration(mongration_function))
 
         print("Mongration process completed successfully.")
@@ -39,26 +72,11 @@ def run_mongration(args):
         print("Failed to load the mongration function.")
 
 
-def build_dependency_graph(phases: list[Phase]) -> DependencyGraph[Phase]:
-    dependency_graph = DependencyGraph()
-    phase_id_cache = dict()
-    for phase in phases:
-        phase_id_cache[phase] = dependency_graph.add(phase)
-
-    for phase in phases:
-        src = phase_id_cache[phase]
-        for dependency in phase.dependencies():
-            dest = phase_id_cache[dependency]
-            dependency_graph.add_dependency(src, dest)
-
-    return dependency_graph
-
-
 def _build_list(phases):
     return ", ".join([f'"{phase.name()}"' for phase in phases])
 
 
-def load_mongration(mongration_function):
+def load_mongration(mongration_function, draw: bool = True, fuse: bool = True):
     mongration_instance = Mongration()
     mongration_function(mongration_instance)
 
@@ -70,10 +88,16 @@ def load_mongration(mongration_function):
         no_dest_msg = _build_list(phases_without_dest)
         raise Exception(
             f"Some phases are misconfigured. Phases without sources: [{no_source_msg}], Phases without destinations: [{no_dest_msg}].")
-    graph = build_dependency_graph(phases)
-    graph.print_to_terminal(
-        circle_radius=8,
-        padding=10,
-        name_selector=lambda phase: phase.name(),
-    )
+    phases, graph = plan(phases, fuse)
+    mongration_instance.replace_phases(phases)
+    if not draw:
+        return mongration_instance, graph
+    if graph.get_size() <= MAX_DRAWN_PHASES:
+        graph.print_to_terminal(
+            circle_radius=8,
+            padding=10,
+            name_selector=lambda phase: phase.name(),
+        )
+    else:
+        print(f"Planned {graph.get_size()} phases, too many to draw.")
     return mongration_instance, graph
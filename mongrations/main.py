@@ -9,6 +9,52 @@ def main():
 
     # Add the --mongration argument
     parser.add_argument('--mongration', type=str, help='Path to the mongration script to be executed.', required=True)
+    parser.add_argument('--uri', type=str, default=None, help='MongoDB connection string.')
+    parser.add_argument('--checkpoint', action='store_true',
+                        help='Persist the progress of each phase and resume from it if the mongration is restarted.')
+    parser.add_argument('--checkpoint-interval', type=float, default=30.0,
+                        help='Seconds between checkpoints of a running phase.')
+    parser.add_argument('--live', action='store_true',
+                        help='After the initial scan, keep replicating changes of the source collections until '
+                             'interrupted with Ctrl+C. Requires a replica set, a single node one is enough.')
+    parser.add_argument('--max-concurrent-phases', type=int, default=None,
+                        help='Maximum number of phases running at once, phases joined by pipes always start together.')
+    parser.add_argument('--memory-budget', type=str, default=None,
+                        help='Memory shared by the buffers of every phase, e.g. 512MB or 2GB. Phases over it are throttled. '
+                             'Half of it bounds the pipes between phases, a pipe or a write larger than its '
+                             'share still goes through one batch at a time.')
+    parser.add_argument('--cursor-budget', type=int, default=None,
+                        help='Maximum number of server cursors open at once across every phase.')
+    parser.add_argument('--metrics-json', type=str, default=None,
+                        help='Write per-phase metrics (throughput, latencies, queue depths) to this JSON file.')
+    parser.add_argument('--metrics-prom', type=str, default=None,
+                        help='Write per-phase metrics to this file in the Prometheus text exposition format.')
+    parser.add_argument('--profile', type=str, nargs='?', const='mongration-profile', default=None,
+                        help='Profile every phase and write the breakdown and collapsed stacks for flame graphs '
+                             'into this directory (mongration-profile by default).')
+    parser.add_argument('--dry-run', action='store_true',
+                        help='Run every phase on a random sample of the source collections into memory, writing '
+                             'nothing, and project how long the full run would take.')
+    parser.add_argument('--sample', type=int, default=1000,
+                        help='Documents sampled from each source collection by --dry-run.')
+    parser.add_argument('--explain', action='store_true',
+                        help='Print how every phase would read, process and write its documents, with collection '
+                             'sizes and query plans, without running the mongration.')
+    parser.add_argument('--distributed', action='store_true',
+                        help='Coordinate a distributed run: ranges of the source collections are leased to worker '
+                             'processes started with --worker, on this host or others.')
+    parser.add_argument('--workers', type=int, default=0,
+                        help='Spawn this many local worker processes, implies --distributed.')
+    parser.add_argument('--worker', action='store_true',
+                        help='Run as a worker of a distributed run, claiming partitions until its coordinator finishes.')
+    parser.add_argument('--worker-id', type=str, default=None,
+                        help='Name of this worker in the lease collection, host:pid by default.')
+    parser.add_argument('--partitions', type=int, default=None,
+                        help='Ranges each distributed source is split in, four per local worker by default.')
+    parser.add_argument('--lease-ttl', type=float, default=30.0,
+                        help='Seconds without a heartbeat after which a worker\'s partition is claimed by another.')
+    parser.add_argument('--state-file', type=str, default=None,
+                        help='Keep checkpoints and watermarks in this local file instead of the mongrations/mongration-state collection.')
 
     # Parse the command line arguments
     args = parser.parse_args()
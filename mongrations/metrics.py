@@ -0,0 +1,218 @@
+import json
+import os
+import time
+from pathlib import Path
+from typing import Optional
+
+from mongrations.misc.documents import estimate_batch_size
+
+# Upper bounds in seconds, shared by every latency histogram so phases can be compared bucket by bucket.
+LATENCY_BUCKETS = (0.001, 0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1.0, 2.5, 5.0, 10.0)
+
+
+class Histogram:
+    def __init__(self, bounds=LATENCY_BUCKETS):
+        self.bounds = bounds
+        self.counts = [0] * (len(bounds) + 1)
+        self.sum = 0.0
+        self.count = 0
+
+    def observe(self, value: float):
+        index = 0
+        while index < len(self.bounds) and value > self.bounds[index]:
+            index += 1
+        self.counts[index] += 1
+        self.sum += value
+        self.count += 1
+
+    def quantile(self, q: float) -> Optional[float]:
+        # Linear interpolation inside the bucket holding the rank, the same estimate Prometheus' histogram_quantile makes.
+        if self.count == 0:
+            return None
+        rank = q * self.count
+        seen = 0
+        for index, count in enumerate(self.counts):
+            if count > 0 and seen + count >= rank:
+                if index == len(self.bounds):
+                    return self.bounds[-1]
+                lower = self.bounds[index - 1] if index > 0 else 0.0
+                return lower + (self.bounds[index] - lower) * (rank - seen) / count
+            seen += count
+        return self.bounds[-1]
+
+    def cumulative(self) -> list[tuple[str, int]]:
+        buckets = list()
+        total = 0
+        for bound, count in zip(list(self.bounds) + ["+Inf"], self.counts):
+            total += count
+            buckets.append((str(bound), total))
+        return buckets
+
+    def to_dict(self) -> dict:
+        return {
+            "count": self.count,
+            "sum": self.sum,
+            "mean": self.sum / self.count if self.count > 0 else None,
+            "p50": self.quantile(0.5),
+            "p99": self.quantile(0.99),
+            "buckets": {bound: count for bound, count in self.cumulative()},
+        }
+
+
+class PhaseMetrics:
+    def __init__(self, name: str):
+        self.name = name
+        self.started = None
+        self.finished = None
+        self.documents_read = 0
+        self.bytes_read = 0
+        self.documents_written = 0
+        self.bytes_written = 0
+        self.callback_cpu_seconds = 0.0
+        self.callback_latency = Histogram()
+        self.fetch_latency = Histogram()
+        self.write_latency = Histogram()
+        self.queue_samples = 0
+        self.queue_depth_sum = 0
+        self.queue_depth_max = 0
+
+    def start(self):
+        self.started = time.time()
+
+    def finish(self):
+        self.finished = time.time()
+
+    def seconds(self) -> float:
+        if self.started is None:
+            return 0.0
+        end = self.finished if self.finished is not None else time.time()
+        return end - self.started
+
+    async def fetches(self, batches):
+        # Time spent waiting on the source for every batch, a slow source shows up here and not in the callback.
+        iterator = batches.__aiter__()
+        while True:
+            start = time.perf_counter()
+            try:
+                batch = await iterator.__anext__()
+            except StopAsyncIteration:
+                return
+            self.fetch_latency.observe(time.perf_counter() - start)
+            self.documents_read += len(batch)
+            self.bytes_read += estimate_batch_size(batch)
+            yield batch
+
+    def observe_fetch(self, seconds: float, documents: int):
+        self.fetch_latency.observe(seconds)
+        self.documents_read += documents
+
+    def observe_callback(self, cpu_seconds: float):
+        self.callback_cpu_seconds += cpu_seconds
+        self.callback_latency.observe(cpu_seconds)
+
+    def observe_write(self, seconds: Optional[float], documents: int, size: int):
+        if seconds is not None:
+            self.write_latency.observe(seconds)
+        self.documents_written += documents
+        self.bytes_written += size
+
+    def observe_queue(self, depth: int):
+        self.queue_samples += 1
+        self.queue_depth_sum += depth
+        self.queue_depth_max = max(self.queue_depth_max, depth)
+
+    def to_dict(self) -> dict:
+        seconds = self.seconds()
+        return {
+            "phase": self.name,
+            "seconds": seconds,
+            "documents_read": self.documents_read,
+            "documents_written": self.documents_written,
+            "read_per_second": self.documents_read / seconds if seconds > 0 else None,
+            "written_per_second": self.documents_written / seconds if seconds > 0 else None,
+            "bytes_read": self.bytes_read,
+            "bytes_written": self.bytes_written,
+            "callback_cpu_seconds": self.callback_cpu_seconds,
+            "callback_latency": self.callback_latency.to_dict(),
+            "fetch_latency": self.fetch_latency.to_dict(),
+            "write_latency": self.write_latency.to_dict(),
+            "queue_depth": {
+                "max": self.queue_depth_max,
+                "mean": self.queue_depth_sum / self.queue_samples if self.queue_samples > 0 else None,
+            },
+        }
+
+
+class MetricsRegistry:
+    def __init__(self, mongration: str):
+        self.mongration = mongration
+        self._phases = list[PhaseMetrics]()
+
+    def phase(self, name: str) -> PhaseMetrics:
+        metrics = PhaseMetrics(name)
+        self._phases.append(metrics)
+        return metrics
+
+    def to_json(self) -> str:
+        return json.dumps({"mongration": self.mongration, "phases": [m.to_dict() for m in self._phases]}, indent=2)
+
+    def to_prometheus(self) -> str:
+        lines = list()
+
+        def family(name, kind, help_text, samples):
+            lines.append(f"# HELP mongration_{name} {help_text}")
+            lines.append(f"# TYPE mongration_{name} {kind}")
+            for metrics in self._phases:
+                for suffix, extra_labels, value in samples(metrics):
+                    labels = {"mongration": self.mongration, "phase": metrics.name} | extra_labels
+                    rendered = ",".join(f'{key}="{_escape(value)}"' for key, value in labels.items())
+                    lines.append(f"mongration_{name}{suffix}{{{rendered}}} {value}")
+
+        def histogram(name, help_text, select):
+            def samples(metrics):
+                observed = select(metrics)
+                for bound, count in observed.cumulative():
+                    yield "_bucket", {"le": bound}, count
+                yield "_sum", {}, observed.sum
+                yield "_count", {}, observed.count
+
+            family(name, "histogram", help_text, samples)
+
+        family("phase_duration_seconds", "gauge", "Wall clock time the phase ran for.",
+               lambda m: [("", {}, m.seconds())])
+        family("documents_read_total", "counter", "Documents read from the phase sources.",
+               lambda m: [("", {}, m.documents_read)])
+        family("documents_written_total", "counter", "Documents pushed into the phase destination.",
+               lambda m: [("", {}, m.documents_written)])
+        family("bytes_read_total", "counter", "Estimated BSON bytes read from the phase sources.",
+               lambda m: [("", {}, m.bytes_read)])
+        family("bytes_written_total", "counter", "Estimated BSON bytes pushed into the phase destination.",
+               lambda m: [("", {}, m.bytes_written)])
+        family("callback_cpu_seconds_total", "counter", "CPU time spent inside python callbacks.",
+               lambda m: [("", {}, m.callback_cpu_seconds)])
+        family("queue_depth_max", "gauge", "Deepest the output pipe of the phase got, in documents.",
+               lambda m: [("", {}, m.queue_depth_max)])
+        histogram("callback_latency_seconds", "CPU time of the python callback for each batch.",
+                  lambda m: m.callback_latency)
+        histogram("fetch_latency_seconds", "Time waited on the source for each batch.", lambda m: m.fetch_latency)
+        histogram("write_latency_seconds", "Time taken by each bulk write.", lambda m: m.write_latency)
+        return "\n".join(lines) + "\n"
+
+    def write(self, json_path: Optional[str], prometheus_path: Optional[str]):
+        if json_path is not None:
+            _write_atomically(json_path, self.to_json())
+        if prometheus_path is not None:
+            _write_atomically(prometheus_path, self.to_prometheus())
+
+
+def _escape(value) -> str:
+    return str(value).replace("\\", "\\\\").replace("\"", "\\\"").replace("\n", "\\n")
+
+
+def _write_atomically(path: str, content: str):
+    # Scrapers such as the node exporter textfile collector must never read a half written file.
+    target = Path(path)
+    temporary = target.with_suffix(target.suffix + ".tmp")
+    with open(temporary, "w") as file:
+        file.write(content)
+    os.replace(temporary, target)
@@ -1,3 +1,17 @@
+from collections.abc import Mapping, MutableMapping
+
+import bson
+
+
+class Deletion:
+    # Travels through the phases in place of a document that was deleted from a live source.
+    def __init__(self, document_id):
+        self.document_id = document_id
+
+    def __repr__(self):
+        return f"Deletion({self.document_id!r})"
+
+
 def deep_set(document, *args):
     # Check if the arguments are sufficient to perform the operation
     if len(args) < 2:
@@ -12,7 +26,7 @@ def deep_set(document, *args):
     current = document
     for key in keys[:-1]:  # Iterate over keys, stopping before the last one
         # If the key doesn't exist or is not a dictionary, create/overwrite it with an empty dictionary
-        if key not in current or not isinstance(current[key], dict):
+        if key not in current or not isinstance(current[key], MutableMapping):
             current[key] = {}
         # Move deeper into the document
         current = current[key]
@@ -28,7 +42,7 @@ def deep_drop(document, *args):
     # Navigate to the deepest dictionary before the target key
     current = document
     for key in args[:-1]:  # Stop before the last key, which is the one to drop
-        if key in current and isinstance(current[key], dict):
+        if key in current and isinstance(current[key], MutableMapping):
             current = current[key]
         else:
             # The path is invalid; the function can either silently return here or raise an error
@@ -37,3 +51,43 @@ def deep_drop(document, *args):
     # Remove the property if it exists in the current dictionary
     if args[-1] in current:
         del current[args[-1]]
+
+
+def get_path(document, path: str, default=None):
+    current = document
+    for key in path.split("."):
+        if not isinstance(current, Mapping) or key not in current:
+            return default
+        current = current[key]
+    return current
+
+
+def hashable(value):
+    # Documents and arrays are not hashable, their encoding compares the way the server compares them.
+    if isinstance(value, (Mapping, list)):
+        return bson.encode({"": value})
+    # True == 1 in python, the server tells them apart.
+    if isinstance(value, bool):
+        return bool, value
+    return value
+
+
+def document_size(document):
+    if isinstance(document, Deletion):
+        return 32
+    raw = getattr(document, "raw", None)
+    if raw is not None:
+        return len(raw)
+    return len(bson.encode(document))
+
+
+def estimate_batch_size(documents, samples=8):
+    # Encoding every document just to measure it would double the encoding work, so only a few are sampled.
+    count = len(documents)
+    if count == 0:
+        return 0
+    if count <= samples:
+        return sum(document_size(doc) for doc in documents)
+    step = count // samples
+    sampled = sum(document_size(documents[i * step]) for i in range(samples))
+    return sampled * count // samples
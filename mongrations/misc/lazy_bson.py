@@ -0,0 +1,196 @@
+import struct
+from collections.abc import Mapping, MutableMapping
+from typing import Optional
+
+import bson
+from bson.codec_options import DEFAULT_CODEC_OPTIONS, CodecOptions
+from bson.errors import InvalidBSON
+from bson.raw_bson import RawBSONDocument
+
+_INT32 = struct.Struct("<i")
+
+# Value sizes of the fixed width BSON types: double, ObjectId, bool, datetime, null, int32, timestamp, int64,
+# decimal128, min key, max key and undefined.
+_FIXED_SIZES = {
+    0x01: 8, 0x06: 0, 0x07: 12, 0x08: 1, 0x09: 8, 0x0A: 0, 0x10: 4, 0x11: 8, 0x12: 8, 0x13: 16, 0x7F: 0, 0xFF: 0,
+}
+_EMBEDDED_DOCUMENT = 0x03
+_ARRAY = 0x04
+
+
+def _value_length(data: bytes, element_type: int, start: int) -> int:
+    if element_type in _FIXED_SIZES:
+        return _FIXED_SIZES[element_type]
+    if element_type in (0x02, 0x0D, 0x0E):
+        return 4 + _INT32.unpack_from(data, start)[0]
+    if element_type in (_EMBEDDED_DOCUMENT, _ARRAY, 0x0F):
+        return _INT32.unpack_from(data, start)[0]
+    if element_type == 0x05:
+        return 5 + _INT32.unpack_from(data, start)[0]
+    if element_type == 0x0B:
+        pattern_end = data.index(b"\x00", start)
+        return data.index(b"\x00", pattern_end + 1) + 1 - start
+    if element_type == 0x0C:
+        return 4 + _INT32.unpack_from(data, start)[0] + 12
+    raise InvalidBSON(f"Unknown BSON element type {element_type:#x}")
+
+
+def _wrap(elements: bytes) -> bytes:
+    return _INT32.pack(len(elements) + 5) + elements + b"\x00"
+
+
+def _encode_element(key: str, value) -> bytes:
+    return bson.encode({key: value})[4:-1]
+
+
+class LazyDocument(MutableMapping):
+    # A document kept as the BSON bytes it was read as. Fields are only decoded when accessed, and unchanged ones are
+    # copied back byte for byte when it is written. The type marker makes pymongo treat it like a RawBSONDocument:
+    # cursors build it straight from the reply and bulk writes send its bytes as they are.
+    _type_marker = RawBSONDocument._type_marker
+
+    def __init__(self, bson_bytes: bytes, codec_options: Optional[CodecOptions] = None):
+        self._data = bson_bytes
+        self._codec_options = codec_options
+        self._elements = None
+        self._values = dict()
+        self._changed = set()
+        self._removed = set()
+        self._added = list()
+        # Spliced bytes of the last read of raw, until the next change. Documents decoded out of this one report
+        # their changes to it through their parent.
+        self._spliced = None
+        self._parent = None
+
+    def _invalidate(self):
+        document = self
+        while document is not None:
+            document._spliced = None
+            document = document._parent
+
+    def _cacheable(self) -> bool:
+        # Lists and dicts that were set or decoded can change in place without the document noticing.
+        for key, value in self._values.items():
+            if key in self._changed and isinstance(value, (list, Mapping)):
+                return False
+            if isinstance(value, LazyDocument) and not value._cacheable():
+                return False
+        return True
+
+    def _index(self) -> dict[str, tuple[int, int, int]]:
+        # Start of the element, start of its value and end of the element, per top level key.
+        if self._elements is None:
+            elements = dict()
+            data = self._data
+            position, end = 4, len(data) - 1
+            while position < end:
+                element_type = data[position]
+                key_end = data.index(b"\x00", position + 1)
+                value_start = key_end + 1
+                value_end = value_start + _value_length(data, element_type, value_start)
+                elements[data[position + 1:key_end].decode("utf-8")] = (position, value_start, value_end)
+                position = value_end
+            self._elements = elements
+        return self._elements
+
+    def _decode(self, key: str):
+        start, value_start, end = self._index()[key]
+        element_type = self._data[start]
+        if element_type == _EMBEDDED_DOCUMENT:
+            document = LazyDocument(self._data[value_start:end], self._codec_options)
+            document._parent = self
+            return document
+        if element_type == _ARRAY:
+            # Arrays are documents keyed by position, the documents they hold stay lazy as well. Lists are mutated
+            # in place without the document noticing, so they are always encoded again.
+            self._changed.add(key)
+            return list(LazyDocument(self._data[value_start:end], self._codec_options).values())
+        options = DEFAULT_CODEC_OPTIONS if self._codec_options is None \
+            else self._codec_options.with_options(document_class=dict)
+        return bson.decode(_wrap(self._data[start:end]), options)[key]
+
+    def __getitem__(self, key):
+        if key in self._values:
+            return self._values[key]
+        if key in self._removed or key not in self._index():
+            raise KeyError(key)
+        value = self._decode(key)
+        self._values[key] = value
+        return value
+
+    def __setitem__(self, key, value):
+        self._invalidate()
+        self._values[key] = value
+        self._changed.add(key)
+        self._removed.discard(key)
+        if key not in self._index() and key not in self._added:
+            self._added.append(key)
+
+    def __delitem__(self, key):
+        if key not in self:
+            raise KeyError(key)
+        self._invalidate()
+        self._values.pop(key, None)
+        self._changed.discard(key)
+        if key in self._added:
+            self._added.remove(key)
+        else:
+            self._removed.add(key)
+
+    def __contains__(self, key):
+        if key in self._added:
+            return True
+        return key in self._index() and key not in self._removed
+
+    def __iter__(self):
+        for key in self._index():
+            if key not in self._removed:
+                yield key
+        yield from self._added
+
+    def __len__(self):
+        return len(self._index()) - len(self._removed) + len(self._added)
+
+    def modified(self) -> bool:
+        if len(self._changed) > 0 or len(self._removed) > 0:
+            return True
+        return any(isinstance(value, LazyDocument) and value.modified() for value in self._values.values())
+
+    @property
+    def raw(self) -> bytes:
+        if not self.modified():
+            return self._data
+        if self._spliced is not None:
+            return self._spliced
+        # Splices the encoded changes in between the untouched elements, which are copied as they are.
+        parts = list()
+        data = self._data
+        for key, (start, value_start, end) in self._index().items():
+            if key in self._removed:
+                continue
+            value = self._values.get(key)
+            if key in self._changed:
+                parts.append(_encode_element(key, value))
+            elif isinstance(value, LazyDocument) and value.modified():
+                parts.append(data[start:value_start] + value.raw)
+            else:
+                parts.append(data[start:end])
+        for key in self._added:
+            parts.append(_encode_element(key, self._values[key]))
+        spliced = _wrap(b"".join(parts))
+        if self._cacheable():
+            self._spliced = spliced
+        return spliced
+
+    def copy(self) -> "LazyDocument":
+        return LazyDocument(self.raw, self._codec_options)
+
+    def __reduce__(self):
+        # Only the bytes travel to process pool workers, which is smaller than a pickled dict.
+        return LazyDocument, (self.raw,)
+
+    def __repr__(self):
+        return f"LazyDocument({dict(self)!r})"
+
+
+RAW_CODEC_OPTIONS = CodecOptions(document_class=LazyDocument)
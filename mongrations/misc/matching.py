@@ -0,0 +1,205 @@
+import re
+from collections.abc import Mapping
+from typing import Optional
+
+from bson.regex import Regex
+
+from mongrations.misc.documents import Deletion
+
+# Subset of the MongoDB query language that can also be evaluated locally, on documents flowing through a Pipe.
+_COMPARISONS = {
+    "$eq": lambda value, operand: _equals(value, operand),
+    "$ne": lambda value, operand: not _equals(value, operand),
+    "$gt": lambda value, operand: _compare(value, operand, lambda a, b: a > b),
+    "$gte": lambda value, operand: _compare(value, operand, lambda a, b: a >= b),
+    "$lt": lambda value, operand: _compare(value, operand, lambda a, b: a < b),
+    "$lte": lambda value, operand: _compare(value, operand, lambda a, b: a <= b),
+    "$in": lambda value, operand: any(_equals(value, candidate) for candidate in operand),
+    "$nin": lambda value, operand: not any(_equals(value, candidate) for candidate in operand),
+}
+_MISSING = object()
+_REGEX_FLAGS = {"i": re.IGNORECASE, "m": re.MULTILINE, "s": re.DOTALL, "x": re.VERBOSE}
+
+
+def _resolve(document, path: str):
+    current = document
+    for key in path.split("."):
+        if not isinstance(current, Mapping) or key not in current:
+            return _MISSING
+        current = current[key]
+    return current
+
+
+def _is_regex(operand) -> bool:
+    return isinstance(operand, (re.Pattern, Regex))
+
+
+def _pattern(operand, options: str = "") -> re.Pattern:
+    if isinstance(operand, Regex):
+        operand = operand.try_compile()
+    if isinstance(operand, re.Pattern):
+        if not options:
+            return operand
+        operand = operand.pattern
+    flags = 0
+    for option in options:
+        if option not in _REGEX_FLAGS:
+            raise Exception(f"Regex option {option} cannot be evaluated outside of MongoDB")
+        flags |= _REGEX_FLAGS[option]
+    return re.compile(operand, flags)
+
+
+def _matches_regex(value, pattern: re.Pattern) -> bool:
+    # Only strings match, arrays match when any of their elements does.
+    candidates = value if isinstance(value, list) else [value]
+    return any(isinstance(candidate, str) and pattern.search(candidate) is not None for candidate in candidates)
+
+
+def _equals(value, operand):
+    if _is_regex(operand):
+        return _matches_regex(value, _pattern(operand))
+    if isinstance(value, list) and not isinstance(operand, list):
+        return operand in value
+    if value is _MISSING:
+        return operand is None
+    return value == operand
+
+
+def _compare(value, operand, comparison):
+    candidates = value if isinstance(value, list) else [value]
+    for candidate in candidates:
+        if candidate is _MISSING or candidate is None:
+            continue
+        try:
+            if comparison(candidate, operand):
+                return True
+        except TypeError:
+            # MongoDB only compares values of the same BSON type, mismatches never match.
+            continue
+    return False
+
+
+def _matches_operators(value, operators: dict) -> bool:
+    for operator, operand in operators.items():
+        if operator == "$exists":
+            if (value is not _MISSING) != bool(operand):
+                return False
+        elif operator == "$not":
+            if _matches_regex(value, _pattern(operand)) if _is_regex(operand) else _matches_operators(value, operand):
+                return False
+        elif operator == "$regex":
+            if not _matches_regex(value, _pattern(operand, operators.get("$options", ""))):
+                return False
+        elif operator == "$options":
+            continue
+        elif operator in _COMPARISONS:
+            if not _COMPARISONS[operator](value, operand):
+                return False
+        else:
+            raise Exception(f"Operator {operator} cannot be evaluated outside of MongoDB")
+    return True
+
+
+def matches(document, query: Optional[dict]) -> bool:
+    if not query:
+        return True
+    for key, condition in query.items():
+        if key == "$and":
+            if not all(matches(document, sub_query) for sub_query in condition):
+                return False
+        elif key == "$or":
+            if not any(matches(document, sub_query) for sub_query in condition):
+                return False
+        elif key == "$nor":
+            if any(matches(document, sub_query) for sub_query in condition):
+                return False
+        elif key.startswith("$"):
+            raise Exception(f"Operator {key} cannot be evaluated outside of MongoDB")
+        else:
+            value = _resolve(document, key)
+            is_operators = isinstance(condition, dict) and len(condition) > 0 and all(
+                operator.startswith("$") for operator in condition
+            )
+            if is_operators:
+                if not _matches_operators(value, condition):
+                    return False
+            elif not _equals(value, condition):
+                return False
+    return True
+
+
+def _validate_operators(operators: dict):
+    for operator, operand in operators.items():
+        if operator == "$not":
+            if _is_regex(operand):
+                _pattern(operand)
+            elif isinstance(operand, dict) and len(operand) > 0:
+                _validate_operators(operand)
+            else:
+                raise Exception(f"$not needs a regex or a document of operators, not {operand!r}")
+        elif operator == "$regex":
+            _pattern(operand, operators.get("$options", ""))
+        elif operator == "$options":
+            if "$regex" not in operators:
+                raise Exception("$options needs a $regex next to it")
+        elif operator != "$exists" and operator not in _COMPARISONS:
+            raise Exception(f"Operator {operator} cannot be evaluated outside of MongoDB")
+
+
+def validate_query(query: Optional[dict]):
+    if not query:
+        return
+    for key, condition in query.items():
+        if key in ("$and", "$or", "$nor"):
+            for sub_query in condition:
+                validate_query(sub_query)
+        elif key.startswith("$"):
+            raise Exception(f"Operator {key} cannot be evaluated outside of MongoDB")
+        elif isinstance(condition, dict) and len(condition) > 0 and all(op.startswith("$") for op in condition):
+            _validate_operators(condition)
+
+
+def project(document, fields: list[str]):
+    projected = dict()
+    for path in fields:
+        value = _resolve(document, path)
+        if value is _MISSING:
+            continue
+        keys = path.split(".")
+        current = projected
+        for key in keys[:-1]:
+            current = current.setdefault(key, dict())
+        current[keys[-1]] = value
+    return projected
+
+
+class Restriction:
+    def __init__(self, fields: Optional[list[str]] = None, where: Optional[dict] = None):
+        if fields is not None and "_id" not in fields:
+            fields = ["_id"] + list(fields)
+        self.fields = fields
+        self.where = where
+
+    def is_empty(self):
+        return self.fields is None and not self.where
+
+    def projection(self) -> Optional[dict]:
+        if self.fields is None:
+            return None
+        return {field: 1 for field in self.fields}
+
+    def apply(self, batch: list) -> list:
+        # Deletions always go through, whatever they refer to has to disappear downstream too.
+        if self.where:
+            batch = [doc for doc in batch if isinstance(doc, Deletion) or matches(doc, self.where)]
+        if self.fields is not None:
+            batch = [doc if isinstance(doc, Deletion) else project(doc, self.fields) for doc in batch]
+        return batch
+
+    def __str__(self):
+        parts = list()
+        if self.fields is not None:
+            parts.append(f"fields={self.fields}")
+        if self.where:
+            parts.append(f"where={self.where}")
+        return ", ".join(parts)
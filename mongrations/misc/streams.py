@@ -0,0 +1,43 @@
+import asyncio
+
+
+async def batched(cursor, batch_size: int):
+    batch = list()
+    async for item in cursor:
+        batch.append(item)
+        if len(batch) >= batch_size:
+            yield batch
+            batch = list()
+    if len(batch) > 0:
+        yield batch
+
+
+# Consumes all iterators concurrently and yields (iterator index, item) as items arrive.
+async def merge(iterators: list, buffer_per_iterator=2):
+    queue = asyncio.Queue(maxsize=max(1, len(iterators) * buffer_per_iterator))
+    finished = object()
+
+    async def drain(index, iterator):
+        try:
+            async for item in iterator:
+                await queue.put((index, item, None))
+        except Exception as e:
+            await queue.put((index, finished, e))
+        else:
+            await queue.put((index, finished, None))
+
+    tasks = [asyncio.create_task(drain(index, iterator)) for index, iterator in enumerate(iterators)]
+    remaining = len(tasks)
+    try:
+        while remaining > 0:
+            index, item, error = await queue.get()
+            if item is finished:
+                # Surface failures of an iterator instead of silently dropping its remaining items.
+                if error is not None:
+                    raise error
+                remaining -= 1
+                continue
+            yield index, item
+    finally:
+        for task in tasks:
+            task.cancel()
@@ -2,7 +2,10 @@ from mongrations.phase import Phase
 
 
 class Mongration:
-    _phases = list[Phase]()
+    _phases: list[Phase]
+
+    def __init__(self):
+        self._phases = list[Phase]()
 
     def phase(self, name):
         ph = Phase(name)
@@ -11,3 +14,6 @@ class Mongration:
 
     def phases(self) -> list[Phase]:
         return self._phases
+
+    def replace_phases(self, phases: list[Phase]):
+        self._phases = phases
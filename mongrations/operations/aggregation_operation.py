@@ -1,12 +1,42 @@
+import time
 from typing import Any
 
 from motor.motor_asyncio import AsyncIOMotorClient
 from tqdm import tqdm
 
-from mongrations.io.collection_destination import CollectionDestination
+from mongrations.engine.profiler import span_category
+from mongrations.io.collection_destination import CollectionDestination, WriteMode
+from mongrations.io.memory import MemorySource
 from mongrations.io.source import CollectionSource
+from mongrations.misc.streams import batched
 from mongrations.operations.operation import Operation
 
+OUTPUT_STAGES = ("$out", "$merge")
+
+
+# How $merge treats a document whose key is already in the target, per write mode of the destination.
+_WHEN_MATCHED = {
+    WriteMode.INSERT: "fail",
+    WriteMode.REPLACE: "replace",
+    WriteMode.SET: "merge",
+    WriteMode.UPSERT: "merge",
+}
+
+
+def output_stage(destination: CollectionDestination) -> dict:
+    if destination.temporary:
+        # Temporary collections belong to this run, $out swaps the whole collection in at once.
+        return {"$out": {"db": destination.database, "coll": destination.collection}}
+    stage = {
+        "into": {"db": destination.database, "coll": destination.collection},
+        "whenMatched": _WHEN_MATCHED[destination.mode],
+        "whenNotMatched": "insert",
+    }
+    if destination.key is not None:
+        # The server requires a unique index on the key fields.
+        stage["on"] = destination.key[0] if len(destination.key) == 1 else list(destination.key)
+    return {"$merge": stage}
+
 
 class AggregationOperation(Operation):
     def __init__(self, aggregation: list[dict[str, Any]]):
@@ -16,46 +46,88 @@ class AggregationOperation(Operation):
     def accepts_dependency_output(self, phase, destination):
         return isinstance(destination, CollectionDestination)
 
+    def accepts_multiple_dependencies(self):
+        return True
+
     def create_default_destination(self, phase):
         col_name = f"mongration-tmp-{phase.sanitized_name()}"
-        destination = CollectionDestination("mongrations", col_name)
+        # Temporary collections start out empty, so plain inserts are enough.
+        destination = CollectionDestination("mongrations", col_name, mode=WriteMode.INSERT, temporary=True)
         phase.finalize_with(
             f"Delete temporary {col_name} collection",
             lambda client: client.get_database("mongrations").drop_collection(col_name)
         )
         return destination
 
+    def stages(self) -> list[dict[str, Any]]:
+        return self._aggregation
+
+    def writes_output(self):
+        return len(self._aggregation) > 0 and any(stage in self._aggregation[-1] for stage in OUTPUT_STAGES)
+
+    def pipeline_for(self, phase) -> list[dict[str, Any]]:
+        sources = phase.sources()
+        primary = sources[0]
+        if not isinstance(primary, (CollectionSource, MemorySource)):
+            raise Exception(f"Incompatible source for aggregation: {primary}. Expected CollectionSource.")
+        pipeline = primary.pipeline_stages()
+        # Every other input is folded in server side, all inputs must live in the primary source's database.
+        for extra in sources[1:]:
+            if isinstance(extra, MemorySource):
+                pipeline.append(extra.union_stage())
+                continue
+            if not isinstance(extra, CollectionSource) or extra.database != primary.database:
+                raise Exception(
+                    f"Incompatible source for aggregation: {extra}. Expected CollectionSource in database {primary.database}.")
+            pipeline.append(extra.union_stage())
+        pipeline.extend(self._aggregation)
+        return pipeline
+
+    def without_output(self):
+        # Dry runs hand the documents back instead of letting the server write them.
+        if self.writes_output():
+            self._aggregation = self._aggregation[:-1]
+
     async def invoke(self, client: AsyncIOMotorClient, progress: tqdm, phase):
-        # for dependency in phase.dependencies():
-        #     await dependency.complete()
         src = phase.source()
         dest = phase.destination()
-        if isinstance(src, CollectionSource):
-            database = src.database
-            collection = src.collection
-        else:
-            raise Exception(f"Incompatible source for aggregation: {src}. Expected CollectionSource.")
-        # Assuming `source.collection_name` gives the name of the source collection
-        collection = client.get_database(database).get_collection(collection)
-        agg = self._aggregation
-        if isinstance(dest, CollectionDestination):
-            last_phase: dict = agg[len(agg) - 1]
-            if last_phase.get("$out", None) is None:
-                agg.append({
-
-                "$out": {"db": dest.database, "coll":dest.collection}
-                })
+        agg = self.pipeline_for(phase)
+        collection = src.aggregate_on(client)
+        if isinstance(dest, CollectionDestination) and not self.writes_output():
+            agg.append(output_stage(dest))
 
         # Start the aggregation
-        cursor = collection.aggregate(agg)
+        start = time.perf_counter()
+        cursor = src.charge_cursor(collection.aggregate(agg))
 
-        # Initialize progress bar
         # Process documents
         sum = 0
-        async for doc in cursor:
-            progress.update()  # Update progress for each document
-            sum += 1
+        if dest is None or isinstance(dest, CollectionDestination):
+            async for doc in cursor:
+                progress.update()  # Update progress for each document
+                sum += 1
+            if self._metrics is not None:
+                # Everything happens server side, the whole aggregation counts as a single fetch.
+                self._metrics.observe_fetch(time.perf_counter() - start, sum)
+            if self._profile is not None:
+                self._profile.add("source", time.perf_counter() - start)
+            return sum
 
+        # Destinations that are not collections (e.g. pipes into python phases) receive the documents themselves.
+        dest.hint_total(await src.estimate_total(client))
+        batches = batched(cursor, 1000)
+        if self._metrics is not None:
+            batches = self._metrics.fetches(batches)
+        if self._profile is not None:
+            batches = self._profile.timed(batches, "source")
+        write_category = span_category(dest, "write")
+        async for batch in batches:
+            push_start = time.perf_counter()
+            await dest.push_batch(batch)
+            if self._profile is not None:
+                self._profile.add(write_category, time.perf_counter() - push_start)
+            progress.update(len(batch))
+            sum += len(batch)
         return sum
 
     def __str__(self):
@@ -0,0 +1,88 @@
+import asyncio
+import multiprocessing
+import os
+import pickle
+import sys
+from collections import deque
+from concurrent.futures import Executor, ProcessPoolExecutor, ThreadPoolExecutor
+from typing import Optional
+
+EXECUTOR_KINDS = ("inline", "thread", "process")
+
+
+def _extend_path(paths):
+    # Workers are spawned, so the directory of the mongration script has to be made importable again.
+    for path in reversed(paths):
+        if path not in sys.path:
+            sys.path.insert(0, path)
+
+
+def validate_executor(kind: Optional[str], callback):
+    if kind is None:
+        return
+    if kind not in EXECUTOR_KINDS:
+        raise Exception(f"Unknown executor {kind}, expected one of: {', '.join(EXECUTOR_KINDS)}.")
+    if kind == "process":
+        try:
+            pickle.dumps(callback)
+        except Exception as e:
+            raise Exception(
+                f"Callback {callback} cannot be used with the process executor, it must be a module level function"
+            ) from e
+
+
+def default_workers(kind: Optional[str], workers: Optional[int]):
+    if workers is not None:
+        return workers
+    if kind is None or kind == "inline":
+        return 1
+    return os.cpu_count() or 1
+
+
+def create_executor(kind: Optional[str], workers: int) -> Optional[Executor]:
+    match kind:
+        case None | "inline":
+            return None
+        case "thread":
+            return ThreadPoolExecutor(max_workers=workers)
+        case "process":
+            return ProcessPoolExecutor(
+                max_workers=workers,
+                mp_context=multiprocessing.get_context("spawn"),
+                initializer=_extend_path,
+                initargs=(list(sys.path),)
+            )
+        case _:
+            raise Exception(f"Unknown executor {kind}, expected one of: {', '.join(EXECUTOR_KINDS)}.")
+
+
+# Yields (batch, result) pairs, keeping at most max_in_flight batches running on the executor.
+async def map_batches(executor: Executor, function, batches, ordered: bool, max_in_flight: int):
+    loop = asyncio.get_running_loop()
+    pending = deque()
+
+    async def drain(wait_all):
+        if ordered:
+            batch, future = pending.popleft()
+            return [(batch, await future)]
+        futures = {future: batch for batch, future in pending}
+        done, _ = await asyncio.wait(
+            futures.keys(),
+            return_when=asyncio.ALL_COMPLETED if wait_all else asyncio.FIRST_COMPLETED
+        )
+        completed = list()
+        for batch, future in list(pending):
+            if future in done:
+                pending.remove((batch, future))
+                completed.append((batch, future.result()))
+        return completed
+
+    async for batch in batches:
+        pending.append((batch, loop.run_in_executor(executor, function, batch)))
+        if len(pending) >= max_in_flight:
+            for completed in await drain(False):
+                yield completed
+
+    while pending:
+        for completed in await drain(True):
+            yield completed
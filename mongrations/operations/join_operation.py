@@ -0,0 +1,359 @@
+import datetime
+import itertools
+import shutil
+import tempfile
+from collections.abc import Mapping
+from pathlib import Path
+from typing import Optional, Union
+
+import bson
+from bson import Decimal128, ObjectId
+from motor.motor_asyncio import AsyncIOMotorClient
+
+from mongrations.engine.governor import parse_size
+from mongrations.engine.scheduler import streams_into
+from mongrations.io.source import CollectionSource
+from mongrations.misc.documents import Deletion, estimate_batch_size, get_path, hashable
+from mongrations.misc.streams import batched, merge
+from mongrations.operations.python_operation import PythonOperation
+
+JOIN_MODES = ("merge", "hash", "union")
+JOIN_KINDS = ("inner", "left", "outer")
+
+_END = object()
+
+
+def _sort_order(value):
+    # Mirrors the order the server sorts mixed types in, so a sorted collection is also sorted here.
+    if value is None:
+        return 0, 0
+    if isinstance(value, bool):
+        return 7, value
+    if isinstance(value, Decimal128):
+        return 1, value.to_decimal()
+    if isinstance(value, (int, float)):
+        return 1, value
+    if isinstance(value, str):
+        return 2, value
+    if isinstance(value, Mapping):
+        return 3, bson.encode(value)
+    if isinstance(value, list):
+        return 4, bson.encode({"": value})
+    if isinstance(value, bytes):
+        return 5, value
+    if isinstance(value, ObjectId):
+        return 6, value
+    if isinstance(value, datetime.datetime):
+        return 8, value
+    return 9, str(value)
+
+
+def _wanted(groups: list, how: str) -> bool:
+    if how == "inner":
+        return all(group is not None for group in groups)
+    if how == "left":
+        return groups[0] is not None
+    return any(group is not None for group in groups)
+
+
+def _combinations(groups: list):
+    # Keys repeated in several inputs yield every combination of their documents, missing inputs are None.
+    return itertools.product(*(group if group is not None else [None] for group in groups))
+
+
+async def _ending(batches):
+    async for batch in batches:
+        yield batch
+    yield _END
+
+
+async def _documents(batches):
+    async for batch in batches:
+        for document in batch:
+            if not isinstance(document, Deletion):
+                yield document
+
+
+class _SortedInput:
+    # Reads one sorted input a key at a time, only the documents sharing the current key are held.
+    def __init__(self, index: int, batches, key: str):
+        self.index = index
+        self._documents = _documents(batches).__aiter__()
+        self._key = key
+        self._lookahead = None
+        self._previous = None
+
+    async def _next_document(self):
+        try:
+            return await self._documents.__anext__()
+        except StopAsyncIteration:
+            return _END
+
+    async def next_group(self) -> Optional[tuple]:
+        if self._lookahead is None:
+            self._lookahead = await self._next_document()
+        first = self._lookahead
+        if first is _END:
+            return None
+        key = get_path(first, self._key)
+        order = _sort_order(key)
+        group = [first]
+        while True:
+            document = await self._next_document()
+            if document is _END or _sort_order(get_path(document, self._key)) != order:
+                break
+            group.append(document)
+        self._lookahead = document
+        if self._previous is not None and not self._previous < order:
+            raise Exception(f"Input {self.index} of the merge join is not sorted on {self._key}, "
+                            f"{key!r} came after a greater key")
+        self._previous = order
+        return order, group
+
+
+async def merge_join(inputs: list[_SortedInput], how: str):
+    heads = [await sorted_input.next_group() for sorted_input in inputs]
+    while any(head is not None for head in heads):
+        order = min(head[0] for head in heads if head is not None)
+        groups = [head[1] if head is not None and head[0] == order else None for head in heads]
+        if _wanted(groups, how):
+            for combination in _combinations(groups):
+                yield combination
+        for index, group in enumerate(groups):
+            if group is not None:
+                heads[index] = await inputs[index].next_group()
+
+
+def _streamed_from(phase, source) -> set:
+    # Every phase streaming documents into the source, directly or through other pipes.
+    producers = set()
+    pending = [dependency for dependency in phase.dependencies() if dependency.destination() is not None
+               and any(branch is source for branch in dependency.destination().branches())]
+    while pending:
+        producer = pending.pop()
+        if producer in producers:
+            continue
+        producers.add(producer)
+        pending.extend(dependency for dependency in producer.dependencies() if streams_into(dependency, producer))
+    return producers
+
+
+def _check_separate_producers(phase, sources):
+    # A merge join reads one input while the others wait. A producer feeding several of them through a Tee blocks
+    # on the input that is not read, and the join then waits forever on the one it does read.
+    seen = dict()
+    for source in sources:
+        for producer in _streamed_from(phase, source):
+            if producer in seen and seen[producer] is not source:
+                raise Exception(f"Phase {phase.name()} merge joins several inputs streamed from phase "
+                                f"{producer.name()}, which would stall. Join them with mode=\"hash\".")
+            seen[producer] = source
+
+
+class HashJoin:
+    # The first input probes tables built from the others. Every input is drained at once, a producer feeding
+    # several of them through a Tee would otherwise stall. Past memory_limit the tables and the probes still waiting
+    # for them are split in partitions on disk, which are then joined one at a time.
+    def __init__(self, keys: list[str], how: str, memory_limit: int, partitions: int = 16):
+        self._keys = keys
+        self._how = how
+        self.memory_limit = memory_limit
+        self.partitions = partitions
+        self._tables = [dict() for _ in keys[1:]]
+        self._pending = list()
+        self._probed = set()
+        self._bytes = 0
+        self._directory = None
+        self._files = dict()
+        self.spilled_bytes = 0
+
+    def _key_of(self, index: int, document):
+        return hashable(get_path(document, self._keys[index]))
+
+    def _probe(self, document):
+        key = self._key_of(0, document)
+        groups = [[document]] + [table.get(key) for table in self._tables]
+        if self._how == "outer":
+            self._probed.add(key)
+        if _wanted(groups, self._how):
+            yield from _combinations(groups)
+
+    def _unmatched(self):
+        # Outer joins also emit the build side keys no probe asked for.
+        if self._how != "outer":
+            return
+        keys = dict()
+        for table in self._tables:
+            keys.update(dict.fromkeys(table))
+        for key in keys:
+            if key not in self._probed:
+                yield from _combinations([None] + [table.get(key) for table in self._tables])
+
+    def _spill(self, index: int, document):
+        key = self._key_of(index, document)
+        partition = hash(key) % self.partitions
+        file = self._files.get((index, partition))
+        if file is None:
+            file = open(self._directory / f"{index}-{partition}.bson", "wb")
+            self._files[(index, partition)] = file
+        raw = getattr(document, "raw", None)
+        encoded = raw if raw is not None else bson.encode(document)
+        self.spilled_bytes += len(encoded)
+        file.write(encoded)
+
+    def _start_spilling(self):
+        self._directory = Path(tempfile.mkdtemp(prefix="mongrations-join-"))
+        for document in self._pending:
+            self._spill(0, document)
+        for index, table in enumerate(self._tables, start=1):
+            for documents in table.values():
+                for document in documents:
+                    self._spill(index, document)
+        self._pending = list()
+        self._tables = [dict() for _ in self._tables]
+
+    def _read_partition(self, index: int, partition: int):
+        path = self._directory / f"{index}-{partition}.bson"
+        if not path.exists():
+            return
+        with open(path, "rb") as file:
+            yield from bson.decode_file_iter(file)
+
+    async def run(self, inputs: list):
+        building = len(inputs) - 1
+        try:
+            async for index, batch in merge([_ending(batches) for batches in inputs]):
+                if batch is _END:
+                    if index > 0:
+                        building -= 1
+                    if building == 0 and self._directory is None:
+                        for document in self._pending:
+                            for combination in self._probe(document):
+                                yield combination
+                        self._pending = list()
+                    continue
+                documents = [document for document in batch if not isinstance(document, Deletion)]
+                if index == 0 and building == 0 and self._directory is None:
+                    for document in documents:
+                        for combination in self._probe(document):
+                            yield combination
+                    continue
+                if self._directory is not None:
+                    for document in documents:
+                        self._spill(index, document)
+                    continue
+                if index == 0:
+                    self._pending.extend(documents)
+                else:
+                    table = self._tables[index - 1]
+                    for document in documents:
+                        table.setdefault(self._key_of(index, document), list()).append(document)
+                self._bytes += estimate_batch_size(documents)
+                if self._bytes > self.memory_limit:
+                    self._start_spilling()
+
+            if self._directory is None:
+                for combination in self._unmatched():
+                    yield combination
+                return
+            for file in self._files.values():
+                file.close()
+            for partition in range(self.partitions):
+                self._tables = [dict() for _ in self._tables]
+                self._probed = set()
+                for index in range(1, len(inputs)):
+                    table = self._tables[index - 1]
+                    for document in self._read_partition(index, partition):
+                        table.setdefault(self._key_of(index, document), list()).append(document)
+                for document in self._read_partition(0, partition):
+                    for combination in self._probe(document):
+                        yield combination
+                for combination in self._unmatched():
+                    yield combination
+        finally:
+            for file in self._files.values():
+                file.close()
+            if self._directory is not None:
+                shutil.rmtree(self._directory, ignore_errors=True)
+
+
+async def union(inputs: list):
+    count = len(inputs)
+    async for index, batch in merge(inputs):
+        for document in batch:
+            if not isinstance(document, Deletion):
+                yield (None,) * index + (document,) + (None,) * (count - index - 1)
+
+
+class JoinOperation(PythonOperation):
+    # Combines the documents of every input of the phase, the callback receives one tuple with a document (or None)
+    # per input, in the order the inputs were added.
+    _fusable = False
+
+    def __init__(self, block, mode: str = "merge", key: Union[str, list[str]] = "_id", how: str = "inner",
+                 memory_limit: Union[int, str] = 256 * 2 ** 20, executor: Optional[str] = None,
+                 workers: Optional[int] = None, ordered=True, batch_size=64):
+        super().__init__(block, executor, workers, ordered, batch_size)
+        if mode not in JOIN_MODES:
+            raise Exception(f"Unknown join mode {mode}, expected one of: {', '.join(JOIN_MODES)}.")
+        if how not in JOIN_KINDS:
+            raise Exception(f"Unknown join kind {how}, expected one of: {', '.join(JOIN_KINDS)}.")
+        self._mode = mode
+        self._key = key
+        self._how = how
+        self._memory_limit = parse_size(memory_limit) if isinstance(memory_limit, str) else memory_limit
+        self._hash_join = None
+
+    def accepts_multiple_dependencies(self):
+        return True
+
+    def supports_live(self):
+        return False
+
+    def supports_checkpoints(self):
+        return False
+
+    def _keys(self, count: int) -> list[str]:
+        if isinstance(self._key, str):
+            return [self._key] * count
+        if len(self._key) != count:
+            raise Exception(f"Join {self} has {len(self._key)} keys for {count} inputs")
+        return list(self._key)
+
+    async def _read(self, client: AsyncIOMotorClient, phase):
+        sources = phase.sources()
+        if len(sources) < 2:
+            raise Exception(f"Phase {phase.name()} joins {len(sources)} input, it needs at least two")
+        keys = self._keys(len(sources))
+        if self._mode == "merge":
+            _check_separate_producers(phase, sources)
+            for source, key in zip(sources, keys):
+                if isinstance(source, CollectionSource):
+                    source.sort_by(key)
+        inputs = list()
+        estimated_total = 0
+        for source in sources:
+            batches, estimated = await source.batches(client, self._batch_size)
+            inputs.append(batches)
+            estimated_total += estimated or 0
+        match self._mode:
+            case "merge":
+                combinations = merge_join([_SortedInput(index, batches, key)
+                                           for index, (batches, key) in enumerate(zip(inputs, keys))], self._how)
+            case "hash":
+                self._hash_join = HashJoin(keys, self._how, self._memory_limit)
+                combinations = self._hash_join.run(inputs)
+            case _:
+                combinations = union(inputs)
+        return batched(combinations, self._batch_size), estimated_total
+
+    def report(self) -> list[str]:
+        if self._hash_join is None or self._hash_join.spilled_bytes == 0:
+            return []
+        return [f"  Hash join spilled {self._hash_join.spilled_bytes / 2 ** 20:.1f} MiB to disk in "
+                f"{self._hash_join.partitions} partitions"]
+
+    def __str__(self):
+        if self._mode == "union":
+            return f"{self._block.__name__} (union)"
+        return f"{self._block.__name__} ({self._how} {self._mode} join on {self._key})"
@@ -0,0 +1,177 @@
+import time
+from collections import OrderedDict
+from typing import Optional
+
+import bson
+from bson.codec_options import CodecOptions
+from bson.raw_bson import RawBSONDocument
+from motor.motor_asyncio import AsyncIOMotorClient
+
+from mongrations.misc.documents import Deletion, deep_set, get_path, hashable
+from mongrations.operations.python_operation import PythonOperation
+
+_MISSING = object()
+_RAW = CodecOptions(document_class=RawBSONDocument)
+
+
+def keep(doc):
+    # Default callback of a lookup phase, the enriched documents are written as they are.
+    return doc
+
+
+class LookupCache:
+    # Least recently used keys are evicted past capacity, entries older than ttl seconds are fetched again.
+    # Keys the lookup collection does not have are cached too, so they are not asked for on every batch.
+    def __init__(self, capacity: int = 10_000, ttl: Optional[float] = None):
+        self.capacity = capacity
+        self.ttl = ttl
+        self._entries = OrderedDict()
+        self.hits = 0
+        self.misses = 0
+        self.evictions = 0
+
+    def get(self, key):
+        entry = self._entries.get(key)
+        if entry is None:
+            self.misses += 1
+            return _MISSING
+        value, stored = entry
+        if self.ttl is not None and time.monotonic() - stored > self.ttl:
+            del self._entries[key]
+            self.misses += 1
+            return _MISSING
+        self._entries.move_to_end(key)
+        self.hits += 1
+        return value
+
+    def put(self, key, value):
+        if self.capacity <= 0:
+            return
+        self._entries[key] = (value, time.monotonic())
+        self._entries.move_to_end(key)
+        while len(self._entries) > self.capacity:
+            self._entries.popitem(last=False)
+            self.evictions += 1
+
+    def hit_rate(self) -> float:
+        total = self.hits + self.misses
+        return self.hits / total if total > 0 else 0.0
+
+    def __len__(self):
+        return len(self._entries)
+
+
+class LookupOperation(PythonOperation):
+    # Enriches every document with the documents of another collection whose foreign_field matches its local_field,
+    # like $lookup does, before handing it to the callback. Keys are resolved a batch at a time with a single $in
+    # query, hot keys are served from the cache. The cache holds the BSON the server sent, every document enriched
+    # decodes a copy of its own, so callbacks changing it touch neither the cache nor the other documents.
+    _fusable = False
+
+    def __init__(self, database: str, collection: str, local_field: str, foreign_field: str = "_id",
+                 into: Optional[str] = None, block=keep, many: bool = False, projection: Optional[dict] = None,
+                 cache_size: int = 10_000, ttl: Optional[float] = None, executor: Optional[str] = None,
+                 workers: Optional[int] = None, ordered=True, batch_size=512):
+        super().__init__(block, executor, workers, ordered, batch_size)
+        self.database = database
+        self.collection = collection
+        self._local_field = local_field
+        self._foreign_field = foreign_field
+        self._into = into if into is not None else collection
+        self._many = many
+        self._projection = projection
+        self.cache = LookupCache(cache_size, ttl)
+        self.queries = 0
+        self.query_seconds = 0.0
+        self.fetched = 0
+
+    def _projection_with_key(self) -> Optional[dict]:
+        projection = self._projection
+        if projection is not None and self._foreign_field not in projection and any(projection.values()):
+            projection = projection | {self._foreign_field: 1}
+        return projection
+
+    async def _resolve(self, collection, keys: dict):
+        # keys maps the hashable form of every key missing from the cache to the key itself.
+        found = {key: ([] if self._many else None) for key in keys}
+        start = time.perf_counter()
+        cursor = collection.with_options(codec_options=_RAW).find({self._foreign_field: {"$in": list(keys.values())}},
+                                                                  self._projection_with_key())
+        async for document in cursor:
+            self.fetched += 1
+            value = get_path(document, self._foreign_field)
+            # Array fields match every one of their elements.
+            for candidate in (value if isinstance(value, list) else [value]):
+                key = hashable(candidate)
+                if key not in found:
+                    continue
+                if self._many:
+                    found[key].append(document.raw)
+                elif found[key] is None:
+                    found[key] = document.raw
+        self.queries += 1
+        self.query_seconds += time.perf_counter() - start
+        for key, value in found.items():
+            self.cache.put(key, value)
+        return found
+
+    def _local_keys(self, document) -> list:
+        value = get_path(document, self._local_field)
+        return value if isinstance(value, list) else [value]
+
+    async def _enrich(self, collection, batches):
+        async for batch in batches:
+            documents = [document for document in batch if not isinstance(document, Deletion)]
+            resolved = dict()
+            missing = dict()
+            for document in documents:
+                for value in self._local_keys(document):
+                    key = hashable(value)
+                    if key in resolved or key in missing:
+                        continue
+                    cached = self.cache.get(key)
+                    if cached is _MISSING:
+                        missing[key] = value
+                    else:
+                        resolved[key] = cached
+            if len(missing) > 0:
+                resolved.update(await self._resolve(collection, missing))
+            for document in documents:
+                values = get_path(document, self._local_field)
+                if isinstance(values, list):
+                    matches = list()
+                    for value in values:
+                        match = resolved[hashable(value)]
+                        if self._many:
+                            matches.extend(self._decoded(match))
+                        elif match is not None:
+                            matches.append(self._decoded(match))
+                    deep_set(document, *self._into.split("."), matches)
+                else:
+                    deep_set(document, *self._into.split("."), self._decoded(resolved[hashable(values)]))
+            # Documents are enriched in place, the batch keeps its partition for checkpoints.
+            yield batch
+
+    def _decoded(self, match):
+        if self._many:
+            return [bson.decode(raw) for raw in match]
+        return None if match is None else bson.decode(match)
+
+    async def _read(self, client: AsyncIOMotorClient, phase):
+        batches, estimated_total = await super()._read(client, phase)
+        collection = client.get_database(self.database).get_collection(self.collection)
+        return self._enrich(collection, batches), estimated_total
+
+    def report(self) -> list[str]:
+        cache = self.cache
+        return [
+            f"  Lookup in {self.database}/{self.collection}: {self.queries} queries in {self.query_seconds:.2f}s, "
+            f"{self.fetched} docs fetched, cache hit rate {cache.hit_rate() * 100:.1f}% "
+            f"({cache.hits} hits, {cache.misses} misses, {cache.evictions} evictions, {len(cache)} cached)"
+        ]
+
+    def __str__(self):
+        lookup = f"lookup {self._local_field} in {self.database}/{self.collection}.{self._foreign_field}"
+        if self._block is keep:
+            return lookup
+        return f"{lookup} -> {super().__str__()}"
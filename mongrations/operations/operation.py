@@ -3,15 +3,38 @@ from tqdm import tqdm
 
 
 class Operation:
+    _metrics = None
+    _profile = None
 
     def __init__(self):
         super().__init__()
 
+    def use_metrics(self, metrics):
+        self._metrics = metrics
+
+    def use_profile(self, profile):
+        self._profile = profile
+
     def accepts_dependency_output(self, phase, destination):
         return True
 
+    def accepts_multiple_dependencies(self):
+        return False
+
+    def supports_checkpoints(self):
+        return False
+
+    def supports_live(self):
+        return False
+
     def create_default_destination(self, phase):
         pass
 
+    def restriction(self):
+        return None
+
+    def report(self) -> list[str]:
+        return []
+
     def invoke(self, client: AsyncIOMotorClient, progress: tqdm, phase):
         raise Exception("Not implemented")
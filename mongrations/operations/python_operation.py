@@ -1,55 +1,246 @@
 import asyncio
+import time
+from typing import Optional
 
 from motor.motor_asyncio import AsyncIOMotorClient
 from tqdm import tqdm
 
+from mongrations.engine.profiler import span_category
 from mongrations.io.pipe import Pipe
+from mongrations.misc.documents import Deletion
+from mongrations.misc.matching import Restriction
+from mongrations.operations.executors import create_executor, default_workers, map_batches, validate_executor
 from mongrations.operations.operation import Operation
 
 
-class PythonOperation(Operation):
+class _ApplyEach:
+    # Module level class so it can be pickled and shipped to process pool workers.
+    def __init__(self, block):
+        self._block = block
+
+    def __call__(self, batch):
+        results = list()
+        for doc in batch:
+            if isinstance(doc, Deletion):
+                results.append(doc)
+                continue
+            result = self._block(doc)
+            # Returning None from a per-document callback drops the document.
+            if result is not None:
+                results.append(result)
+        return results
+
+
+class _ApplyBatch:
     def __init__(self, block):
+        self._block = block
+
+    def __call__(self, batch):
+        deletions = [doc for doc in batch if isinstance(doc, Deletion)]
+        if len(deletions) > 0:
+            batch = [doc for doc in batch if not isinstance(doc, Deletion)]
+        results = self._block(batch) if len(batch) > 0 else None
+        if results is None:
+            results = []
+        elif not isinstance(results, list):
+            results = list(results)
+        return results + deletions
+
+
+class _Timed:
+    # Measures the callback where it runs, inside the worker thread or process when an executor is used.
+    def __init__(self, transform):
+        self._transform = transform
+
+    def __call__(self, batch):
+        start = time.thread_time()
+        results = self._transform(batch)
+        return results, time.thread_time() - start
+
+
+class PythonOperation(Operation):
+    # Operations whose input is not the plain stream of a single source cannot be folded into a chain.
+    _fusable = True
+
+    def __init__(self, block, executor: Optional[str] = None, workers: Optional[int] = None, ordered=True,
+                 batch_size=64, fields: Optional[list[str]] = None, where: Optional[dict] = None):
         super().__init__()
+        validate_executor(executor, block)
         self._block = block
+        self._executor = executor
+        self._workers = default_workers(executor, workers)
+        self._ordered = ordered
+        self._batch_size = batch_size
+        self._restriction = Restriction(fields, where)
+
+    def restriction(self):
+        if self._restriction.is_empty():
+            return None
+        return self._restriction
+
+    def supports_live(self):
+        return True
+
+    def supports_checkpoints(self):
+        # Unordered executors may finish a later batch first, so the last pushed batch is not a safe position.
+        return self._ordered
+
+    def can_fuse_with(self, other: "PythonOperation"):
+        return (
+            isinstance(other, PythonOperation)
+            and self._fusable
+            and other._fusable
+            and self._executor == other._executor
+            and self._workers == other._workers
+            and self._ordered == other._ordered
+        )
+
+    def transform(self):
+        return _ApplyEach(self._block)
+
+    def _observe_callback(self, cpu_seconds):
+        if self._metrics is not None:
+            self._metrics.observe_callback(cpu_seconds)
+
+    async def _process(self, batches):
+        transform = _Timed(self.transform())
+        async for batch in batches:
+            results, cpu_seconds = transform(batch)
+            self._observe_callback(cpu_seconds)
+            yield batch, results
 
-    async def _process(self, cursor, progress):
-        async for doc in cursor:
-            yield self._block(doc)
-            progress.update()
+    async def _process_in_executor(self, executor, batches):
+        timed = _Timed(self.transform())
+        async for batch, (results, cpu_seconds) in map_batches(executor, timed, batches, self._ordered,
+                                                               self._workers * 2):
+            self._observe_callback(cpu_seconds)
+            yield batch, results
 
     def create_default_destination(self, phase):
         return Pipe()
 
-    async def invoke(self, client: AsyncIOMotorClient, progress: tqdm, phase):
-        batch_size = 64
+    async def _read(self, client: AsyncIOMotorClient, phase):
+        return await phase.source().batches(client, self._batch_size)
 
+    async def invoke(self, client: AsyncIOMotorClient, progress: tqdm, phase):
         source = phase.source()
         destination = phase.destination()
-        cursor, estimated_total = await source.cursor(client)
+        batches, estimated_total = await self._read(client, phase)
         progress.total = estimated_total
+        if self._metrics is not None:
+            batches = self._metrics.fetches(batches)
+        profile = self._profile
+        source_category = span_category(source, "source")
+        write_category = span_category(destination, "write")
+        if profile is not None:
+            batches = profile.timed(batches, source_category)
 
-        destination.hint_total(estimated_total)
+        if destination is not None:
+            destination.hint_total(estimated_total)
 
-        increment = 0
-        current_batch = 0
-        if destination is None:
-            async for _ in self._process(cursor, progress):
-                current_batch = await self._notify_batch(batch_size, current_batch)
-                increment += 1
+        executor = create_executor(self._executor, self._workers)
+        if executor is None:
+            processed = self._process(batches)
         else:
-            async for new_doc in self._process(cursor, progress):
-                await destination.push(new_doc)
-                current_batch = await self._notify_batch(batch_size, current_batch)
-                increment += 1
+            processed = self._process_in_executor(executor, batches)
+        if profile is not None:
+            # Inline callbacks run while the loop waits for the next result, executor ones while it waits on them.
+            processed = profile.timed(processed, "callback", excluding=source_category)
 
-        return increment
+        checkpoint = phase.checkpoint()
+        increment = 0
+        try:
+            async for batch, results in processed:
+                if destination is not None and len(results) > 0:
+                    start = time.perf_counter()
+                    await destination.push_batch(results)
+                    if profile is not None:
+                        profile.add(write_category, time.perf_counter() - start)
+                if checkpoint is not None:
+                    source.acknowledge(batch)
+                    if checkpoint.due():
+                        await destination.flush()
+                        await checkpoint.save(source.checkpoint_state())
+                increment += len(results)
+                progress.update(len(batch))
+                postfix = source.progress_postfix()
+                if postfix is not None:
+                    progress.set_postfix_str(postfix, refresh=False)
+                # Inline callbacks never suspend on their own, give the other phases a chance to run.
+                await asyncio.sleep(0)
+        finally:
+            if executor is not None:
+                executor.shutdown(wait=False, cancel_futures=True)
 
-    async def _notify_batch(self, batch_size, current_batch):
-        if current_batch > batch_size:
-            await asyncio.sleep(0)
-            return 0
-        else:
-            return current_batch + 1
+        return increment
 
     def __str__(self):
+        if self._executor is not None:
+            return f"{self._block.__name__} ({self._executor} x{self._workers})"
         return self._block.__name__
+
+
+class PythonBatchOperation(PythonOperation):
+    def __init__(self, block, executor: Optional[str] = None, workers: Optional[int] = None, ordered=True,
+                 batch_size=512, fields: Optional[list[str]] = None, where: Optional[dict] = None):
+        super().__init__(block, executor, workers, ordered, batch_size, fields, where)
+
+    def transform(self):
+        return _ApplyBatch(self._block)
+
+
+class _Composed:
+    def __init__(self, transforms, restrictions):
+        self._transforms = transforms
+        self._restrictions = restrictions
+
+    def __call__(self, batch):
+        stats = list()
+        for transform, restriction in zip(self._transforms, self._restrictions):
+            start = time.perf_counter()
+            # The restriction a stage declared would have been applied by the pipe that used to feed it.
+            if restriction is not None:
+                batch = restriction.apply(batch)
+            batch = transform(batch)
+            stats.append((time.perf_counter() - start, len(batch)))
+        return batch, stats
+
+
+class FusedPythonOperation(PythonOperation):
+    def __init__(self, names: list[str], operations: list[PythonOperation]):
+        first = operations[0]
+        super().__init__(first._block, first._executor, first._workers, first._ordered,
+                         max(operation._batch_size for operation in operations))
+        self._restriction = first._restriction
+        self._names = names
+        self._operations = operations
+        self._stage_seconds = [0.0] * len(operations)
+        self._stage_documents = [0] * len(operations)
+
+    def transform(self):
+        restrictions = [None] + [operation.restriction() for operation in self._operations[1:]]
+        return _Composed([operation.transform() for operation in self._operations], restrictions)
+
+    def _accumulate(self, stats):
+        for index, (seconds, documents) in enumerate(stats):
+            self._stage_seconds[index] += seconds
+            self._stage_documents[index] += documents
+
+    async def _process(self, batches):
+        async for batch, (results, stats) in super()._process(batches):
+            self._accumulate(stats)
+            yield batch, results
+
+    async def _process_in_executor(self, executor, batches):
+        async for batch, (results, stats) in super()._process_in_executor(executor, batches):
+            self._accumulate(stats)
+            yield batch, results
+
+    def report(self) -> list[str]:
+        lines = list()
+        for name, seconds, documents in zip(self._names, self._stage_seconds, self._stage_documents):
+            lines.append(f"  {name}: {seconds:.2f} seconds in callback, {documents} docs out")
+        return lines
+
+    def __str__(self):
+        return " -> ".join(str(operation) for operation in self._operations)
@@ -1,13 +1,20 @@
-from asyncio import Future
-from typing import Callable
+import asyncio
+import tempfile
+from pathlib import Path
+from typing import Callable, Optional, Union
 
 from mongrations.io.collection_destination import CollectionDestination
 from mongrations.io.destination import Destination
+from mongrations.engine.governor import parse_size
 from mongrations.io.pipe import Pipe
+from mongrations.io.segments import DEFAULT_SEGMENT_SIZE, SegmentStore
 from mongrations.io.source import Source, CollectionSource
+from mongrations.io.tee import Tee
 from mongrations.operations.aggregation_operation import AggregationOperation
+from mongrations.operations.join_operation import JoinOperation
+from mongrations.operations.lookup_operation import LookupOperation, keep
 from mongrations.operations.operation import Operation
-from mongrations.operations.python_operation import PythonOperation
+from mongrations.operations.python_operation import PythonOperation, PythonBatchOperation
 
 
 class Phase:
@@ -29,15 +36,26 @@ class Phase:
         self._completionCallbacks = list[str, Callable]()
         self._isComplete = False
         self._must_wait = list()
+        self._wait_for = list["Phase"]()
+        self._completion_event = None
+        self._extra_sources = list[Source]()
+        self._checkpoint = None
         self._needs_configuration = list["Phase"]()
+        self._pipe_capacities = dict()
+        # Dependants already reading the current destination, it has to keep being written.
+        self._readers = list["Phase"]()
 
-    def from_collection(self, database: str, collection: str, filter: dict = None):
-        self._source = CollectionSource(database, collection, filter)
+    def from_collection(self, database: str, collection: str, filter: dict = None, partitions: int = 1,
+                        partition_key: str = "_id", watermark: str = None, raw: bool = False):
+        self._source = CollectionSource(database, collection, filter, partitions, partition_key, watermark=watermark,
+                                        raw=raw)
 
-    def from_phase(self, source_phase: "Phase"):
+    def from_phase(self, source_phase: "Phase", capacity: int = None, capacity_bytes: int = None):
         if self == source_phase:
             raise Exception("Cannot read phase from itself")
         self._dependencies.append(source_phase)
+        if capacity is not None or capacity_bytes is not None:
+            self._pipe_capacities[source_phase] = (capacity, capacity_bytes)
         if self._operation is not None:
             self._configure_dependency(source_phase)
         else:
@@ -47,11 +65,21 @@ class Phase:
         if self._operation is None:
             raise Exception(
                 f"Phase {self._name} doesn't have an operation set, cannot create default destination from {source_phase._name}")
-        dest = source_phase.destination()
-        if dest is None or not self._operation.accepts_dependency_output(source_phase, dest):
+        output = source_phase.destination()
+        dest = None
+        if output is not None:
+            for branch in output.branches():
+                if not branch.consumed() and self._operation.accepts_dependency_output(source_phase, branch):
+                    dest = branch
+                    break
+        if dest is None:
             dest = self._operation.create_default_destination(source_phase)
-        source_phase._destination = dest
+            # Outputs other dependants already read from are kept, the phase writes into every branch at once.
+            source_phase._destination = dest if output is None else Tee.of(output, dest)
+        if isinstance(dest, Pipe) and source_phase in self._pipe_capacities:
+            dest.resize(*self._pipe_capacities[source_phase])
         dest.pipe_into(source_phase, self)
+        source_phase._readers.append(self)
 
     def name(self):
         return self._name
@@ -68,8 +96,26 @@ class Phase:
     def dependencies(self):
         return self._dependencies
 
-    def use_python(self, callback):
-        self._operation = PythonOperation(callback)
+    def use_python(self, callback, executor: str = None, workers: int = None, ordered=True, batch_size=64,
+                   fields: list[str] = None, where: dict = None):
+        self._operation = PythonOperation(callback, executor, workers, ordered, batch_size, fields, where)
+        self._attempt_auto_configuration()
+
+    def use_python_batch(self, callback, executor: str = None, workers: int = None, ordered=True, batch_size=512,
+                         fields: list[str] = None, where: dict = None):
+        self._operation = PythonBatchOperation(callback, executor, workers, ordered, batch_size, fields, where)
+        self._attempt_auto_configuration()
+
+    def use_join(self, callback, mode: str = "merge", key="_id", how: str = "inner", memory_limit=256 * 2 ** 20,
+                 executor: str = None, workers: int = None, ordered=True, batch_size=64):
+        self._operation = JoinOperation(callback, mode, key, how, memory_limit, executor, workers, ordered, batch_size)
+        self._attempt_auto_configuration()
+
+    def use_lookup(self, database: str, collection: str, local_field: str, foreign_field: str = "_id", into: str = None,
+                   callback=keep, many: bool = False, projection: dict = None, cache_size: int = 10_000,
+                   ttl: float = None, executor: str = None, workers: int = None, ordered=True, batch_size=512):
+        self._operation = LookupOperation(database, collection, local_field, foreign_field, into, callback, many,
+                                          projection, cache_size, ttl, executor, workers, ordered, batch_size)
         self._attempt_auto_configuration()
 
     def use_aggregation(self, aggregation):
@@ -82,6 +128,9 @@ class Phase:
                 return
             case 1:
                 self._configure_dependency(self._needs_configuration[0])
+            case _ if self._operation.accepts_multiple_dependencies():
+                for dependency in self._needs_configuration:
+                    self._configure_dependency(dependency)
             case _:
                 print(f"Unable to auto-configure phase {self.name()} because it has multiple dependencies.")
                 return
@@ -89,12 +138,72 @@ class Phase:
     def operation(self):
         return self._operation
 
-    def into_temporary(self, database: str):
-        pass
+    def into_temporary(self, directory: Optional[str] = None, segment_size: Union[int, str] = DEFAULT_SEGMENT_SIZE,
+                       raw: bool = False):
+        # Materializes the output on the local disk instead of a temporary collection, every dependant processing it
+        # in python reads it from there. Aggregations still get a collection, they can only read from the server.
+        root = Path(directory) if directory is not None else Path(tempfile.gettempdir()) / "mongration-segments"
+        size = parse_size(segment_size) if isinstance(segment_size, str) else segment_size
+        store = SegmentStore(root, self._name, size, raw)
+        self.finalize_with(f"Delete temporary segments of {self._name}", lambda client: store.discard())
+        destination = store
+        if self._destination is not None and len(self._readers) > 0:
+            destination = Tee.of(self._destination, destination)
+        self._destination = destination
 
-    def into_collection(self, database: str, collection: str):
+    def into_collection(self, database: str, collection: str, batch_size: int = 1000, max_in_flight: int = 2,
+                        mode: str = "set", key=None):
         # TODO: Check if operation is an aggregation, and if is, add an $out stage. A lot fast than python.
-        self._destination = CollectionDestination(database, collection)
+        destination = CollectionDestination(
+            database, collection, batch_size, max_in_flight=max_in_flight, mode=mode, key=key
+        )
+        if self._destination is not None and len(self._readers) > 0:
+            # A dependant configured earlier reads the current output, pipe or collection, it is written alongside.
+            destination = Tee.of(self._destination, destination)
+        self._destination = destination
+
+    @staticmethod
+    def fuse(chain: list["Phase"], operation: Operation) -> "Phase":
+        first = chain[0]
+        last = chain[-1]
+        fused = Phase(" -> ".join(phase.name() for phase in chain))
+        fused._operation = operation
+        fused._source = first._source
+        fused._destination = last._destination
+        fused._dependencies = first._dependencies
+        fused._must_wait = first._must_wait
+        fused._wait_for = first._wait_for
+        fused._extra_sources = first._extra_sources
+        for phase in chain:
+            fused._finalizers.extend(phase._finalizers)
+            fused._completionCallbacks.extend(phase._completionCallbacks)
+        return fused
+
+    def replace_dependency(self, old: "Phase", new: "Phase"):
+        self._dependencies = [new if dependency is old else dependency for dependency in self._dependencies]
+        self._wait_for = [new if phase is old else phase for phase in self._wait_for]
+
+    def inline_dependency(self, dependency: "Phase", replaced_source: Source, new_source: Source):
+        # The dependency's work now happens as part of this phase, reading new_source instead of its output.
+        if self._source is replaced_source:
+            self._source = new_source
+        else:
+            self._extra_sources = [new_source if src is replaced_source else src for src in self._extra_sources]
+        self._dependencies = [phase for phase in self._dependencies if phase is not dependency]
+        self._dependencies.extend(dependency._dependencies)
+        self._wait_for = [phase for phase in self._wait_for if phase is not dependency]
+        self._wait_for.extend(dependency._wait_for)
+        self._must_wait.extend(dependency._must_wait)
+        self._finalizers.extend(dependency._finalizers)
+        self._completionCallbacks.extend(dependency._completionCallbacks)
+
+    def replace_source(self, old: Source, new: Source):
+        if self._source is old:
+            self._source = new
+        self._extra_sources = [new if source is old else source for source in self._extra_sources]
+
+    def replace_destination(self, destination: Destination):
+        self._destination = destination
 
     def __str__(self):
         return f"Phase(name={self._name})"
@@ -102,26 +211,52 @@ class Phase:
     def source(self):
         return self._source
 
+    def sources(self) -> list[Source]:
+        if self._source is None:
+            return list(self._extra_sources)
+        return [self._source] + self._extra_sources
+
+    def _add_source(self, source: Source):
+        if self._source is None:
+            self._source = source
+        else:
+            self._extra_sources.append(source)
+
     def destination(self):
         return self._destination
 
+    def checkpoint(self):
+        return self._checkpoint
+
+    def use_checkpoint(self, checkpoint):
+        self._checkpoint = checkpoint
+
     def wait_on(self, future):
         self._must_wait.append(future)
 
     def wait_for_phase(self, phase):
-        completed_future = Future()
-        self.wait_on(completed_future)
-        phase.on_completed(lambda: completed_future.set_result(None))
+        self._wait_for.append(phase)
+
+    async def completion(self):
+        if self._isComplete:
+            return
+        # Created lazily, so it belongs to the loop the engine runs on rather than to whatever loop existed at load.
+        if self._completion_event is None:
+            self._completion_event = asyncio.Event()
+        await self._completion_event.wait()
 
     async def prepare(self, engine):
-        if len(self._must_wait) == 0:
+        to_wait = list(self._must_wait) + [phase.completion() for phase in self._wait_for]
+        if len(to_wait) == 0:
             return
-        await engine.wait_all(self._must_wait)
+        await engine.wait_all(to_wait)
 
     def notify_completion(self):
         if self._isComplete:
             return
         self._isComplete = True
+        if self._completion_event is not None:
+            self._completion_event.set()
         for callback in self._completionCallbacks:
             callback()
 
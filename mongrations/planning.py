@@ -0,0 +1,153 @@
+from mongrations.graph import DependencyGraph
+from mongrations.io.collection_destination import CollectionDestination
+from mongrations.io.pipe import Pipe
+from mongrations.io.source import CollectionSource
+from mongrations.operations.aggregation_operation import AggregationOperation
+from mongrations.operations.python_operation import FusedPythonOperation, PythonOperation
+from mongrations.phase import Phase
+
+
+def build_dependency_graph(phases: list[Phase]) -> DependencyGraph[Phase]:
+    dependency_graph = DependencyGraph()
+    phase_id_cache = dict()
+    for phase in phases:
+        phase_id_cache[phase] = dependency_graph.add(phase)
+
+    for phase in phases:
+        src = phase_id_cache[phase]
+        for dependency in phase.dependencies():
+            dest = phase_id_cache[dependency]
+            dependency_graph.add_dependency(src, dest)
+
+    return dependency_graph
+
+
+def push_down_restrictions(phases: list[Phase]):
+    # Fields and predicates declared by a phase are handed to whatever feeds it: a collection source turns them
+    # into the find() projection and filter, a pipe drops and trims documents before they are queued.
+    for phase in phases:
+        operation = phase.operation()
+        source = phase.source()
+        if operation is None or source is None:
+            continue
+        restriction = operation.restriction()
+        if restriction is not None:
+            source.restrict(restriction)
+
+
+def _fusable_successor(graph: DependencyGraph[Phase], index: int):
+    phase = graph[index]
+    operation = phase.operation()
+    if not isinstance(operation, PythonOperation) or not isinstance(phase.destination(), Pipe):
+        return None
+    dependants = graph.dependants_on(index)
+    if len(dependants) != 1:
+        return None
+    successor = dependants[0]
+    successor_phase = graph[successor]
+    if len(graph.dependencies_of(successor)) != 1 or successor_phase.source() is not phase.destination():
+        return None
+    if not operation.can_fuse_with(successor_phase.operation()):
+        return None
+    return successor
+
+
+def fuse_python_chains(graph: DependencyGraph[Phase]) -> list[Phase]:
+    successors = dict()
+    for index in graph.all_indices():
+        successor = _fusable_successor(graph, index)
+        if successor is not None:
+            successors[index] = successor
+    chained = set(successors.values())
+
+    phases = list()
+    # Planned phase standing in for every phase heading a chain (or left alone), and fused phase of every chain tail.
+    planned = dict()
+    replaced = dict()
+    for index in graph.all_indices():
+        if index in chained:
+            continue
+        chain = [index]
+        while chain[-1] in successors:
+            chain.append(successors[chain[-1]])
+        if len(chain) == 1:
+            planned[index] = graph[index]
+            phases.append(graph[index])
+            continue
+        chain_phases = [graph[i] for i in chain]
+        operation = FusedPythonOperation(
+            [phase.name() for phase in chain_phases],
+            [phase.operation() for phase in chain_phases]
+        )
+        fused = Phase.fuse(chain_phases, operation)
+        planned[index] = fused
+        replaced[chain[-1]] = fused
+        phases.append(fused)
+
+    # Only the dependants of a chain's tail read from it, the other phases are left untouched.
+    for tail, fused in replaced.items():
+        for dependant in graph.dependants_on(tail):
+            if dependant in planned:
+                planned[dependant].replace_dependency(graph[tail], fused)
+    return phases
+
+
+def _temporary_source(phase: Phase, dependency: Phase):
+    destination = dependency.destination()
+    if not isinstance(destination, CollectionDestination) or not destination.temporary:
+        return None
+    for source in phase.sources():
+        if (isinstance(source, CollectionSource) and source.database == destination.database
+                and source.collection == destination.collection):
+            return source
+    return None
+
+
+def _inline_aggregation(graph: DependencyGraph[Phase], index_of: dict[Phase, int], phase: Phase):
+    for dependency in phase.dependencies():
+        operation = dependency.operation()
+        if not isinstance(operation, AggregationOperation) or operation.writes_output():
+            continue
+        # A dependency's only dependant is this phase, or a phase that was already inlined into it.
+        if len(graph.dependants_on(index_of[dependency])) != 1:
+            continue
+        if not all(isinstance(source, CollectionSource) for source in dependency.sources()):
+            continue
+        replaced = _temporary_source(phase, dependency)
+        if replaced is None:
+            continue
+        upstream = dependency.source()
+        # The upstream pipeline runs as a prefix of this one (or inside $unionWith), so its temporary collection
+        # is never written. $unionWith can only read from the database the primary input lives in.
+        if replaced is not phase.source() and upstream.database != phase.source().database:
+            continue
+        view = CollectionSource(upstream.database, upstream.collection, None,
+                                pipeline=operation.pipeline_for(dependency), raw=upstream.raw)
+        phase.inline_dependency(dependency, replaced, view)
+        return dependency
+    return None
+
+
+def fuse_aggregations(phases: list[Phase]) -> list[Phase]:
+    graph = build_dependency_graph(phases)
+    index_of = {graph[index]: index for index in graph.all_indices()}
+    inlined = set()
+    # Upstream first, a phase's pipeline is complete by the time its dependant inlines it.
+    for index in graph.topological_order():
+        phase = graph[index]
+        if phase in inlined or not isinstance(phase.operation(), AggregationOperation):
+            continue
+        while True:
+            dependency = _inline_aggregation(graph, index_of, phase)
+            if dependency is None:
+                break
+            inlined.add(dependency)
+    return [phase for phase in phases if phase not in inlined]
+
+
+def plan(phases: list[Phase], fuse: bool = True) -> tuple[list[Phase], DependencyGraph[Phase]]:
+    push_down_restrictions(phases)
+    if fuse:
+        phases = fuse_python_chains(build_dependency_graph(phases))
+        phases = fuse_aggregations(phases)
+    return phases, build_dependency_graph(phases)
@@ -0,0 +1,82 @@
+import os
+from pathlib import Path
+from typing import Optional
+
+from bson import json_util
+from motor.motor_asyncio import AsyncIOMotorClient
+
+STATE_DATABASE = "mongrations"
+STATE_COLLECTION = "mongration-state"
+
+
+class StateStore:
+    async def load(self, key: str) -> Optional[dict]:
+        pass
+
+    async def save(self, key: str, state: dict):
+        pass
+
+    async def clear(self, key: str):
+        pass
+
+
+class CollectionStateStore(StateStore):
+    def __init__(self, client: AsyncIOMotorClient, database: str = STATE_DATABASE, collection: str = STATE_COLLECTION):
+        self._collection = client.get_database(database).get_collection(collection)
+
+    async def load(self, key: str) -> Optional[dict]:
+        document = await self._collection.find_one({"_id": key})
+        if document is None:
+            return None
+        return document["state"]
+
+    async def save(self, key: str, state: dict):
+        await self._collection.replace_one({"_id": key}, {"_id": key, "state": state}, upsert=True)
+
+    async def clear(self, key: str):
+        await self._collection.delete_one({"_id": key})
+
+    def __str__(self):
+        return f"{self._collection.database.name}/{self._collection.name}"
+
+
+class FileStateStore(StateStore):
+    def __init__(self, path: str):
+        self._path = Path(path)
+
+    def _read(self) -> dict:
+        if not self._path.exists():
+            return dict()
+        with open(self._path, "r") as file:
+            return json_util.loads(file.read())
+
+    def _write(self, states: dict):
+        # Written to a sibling file and renamed over the original, a crash mid-write never leaves a torn file.
+        temporary = self._path.with_suffix(self._path.suffix + ".tmp")
+        with open(temporary, "w") as file:
+            file.write(json_util.dumps(states, json_options=json_util.CANONICAL_JSON_OPTIONS))
+            file.flush()
+            os.fsync(file.fileno())
+        os.replace(temporary, self._path)
+
+    async def load(self, key: str) -> Optional[dict]:
+        return self._read().get(key)
+
+    async def save(self, key: str, state: dict):
+        states = self._read()
+        states[key] = state
+        self._write(states)
+
+    async def clear(self, key: str):
+        states = self._read()
+        if states.pop(key, None) is not None:
+            self._write(states)
+
+    def __str__(self):
+        return str(self._path)
+
+
+def create_state_store(settings, client: AsyncIOMotorClient) -> StateStore:
+    if settings.state_file is not None:
+        return FileStateStore(settings.state_file)
+    return CollectionStateStore(client)
@@ -0,0 +1,36 @@
+from mongrations.state import StateStore
+
+
+class Watermarks:
+    def __init__(self, store: StateStore, namespace: str):
+        self._store = store
+        self._namespace = namespace
+
+    def _key(self, source):
+        # Phase names change when phases are fused and the description of a source with its partitions, neither may
+        # reset the watermark.
+        return f"{self._namespace}:watermark:{source.database}/{source.collection}:{source.watermark_field()}"
+
+    @staticmethod
+    def incremental_sources(phases):
+        for phase in phases:
+            for source in phase.sources():
+                if source.watermark_field() is not None:
+                    yield phase, source
+
+    async def restore(self, phases):
+        for phase, source in self.incremental_sources(phases):
+            state = await self._store.load(self._key(source))
+            source.restore_watermark(None if state is None else state["value"])
+
+    async def commit(self, phases):
+        # Only called once the whole run succeeded, a failed run re-reads the same delta next time.
+        reached = dict()
+        for phase, source in self.incremental_sources(phases):
+            if source.watermark_reached is None:
+                continue
+            key = self._key(source)
+            # Sources sharing a key keep the lowest watermark, documents are read again rather than skipped.
+            reached[key] = source.watermark_reached if key not in reached else min(reached[key], source.watermark_reached)
+        for key, value in reached.items():
+            await self._store.save(key, {"value": value})
@@ -0,0 +1,22 @@
+from mongrations.io.collection_destination import CollectionDestination
+from mongrations.operations.aggregation_operation import output_stage
+
+
+def test_write_modes_map_to_merge_stages():
+    def when_matched(mode):
+        return output_stage(CollectionDestination("db", "target", mode=mode))["$merge"]["whenMatched"]
+
+    assert when_matched("insert") == "fail"
+    assert when_matched("replace") == "replace"
+    assert when_matched("set") == "merge"
+
+
+def test_upserts_merge_on_their_key():
+    stage = output_stage(CollectionDestination("db", "target", mode="upsert", key=["a", "b"]))["$merge"]
+    assert stage == {"into": {"db": "db", "coll": "target"}, "whenMatched": "merge", "whenNotMatched": "insert",
+                     "on": ["a", "b"]}
+
+
+def test_temporary_collections_are_swapped_in_with_out():
+    destination = CollectionDestination("mongrations", "mongration-tmp-phase", mode="insert", temporary=True)
+    assert output_stage(destination) == {"$out": {"db": "mongrations", "coll": "mongration-tmp-phase"}}
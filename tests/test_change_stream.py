@@ -0,0 +1,73 @@
+import asyncio
+
+from mongrations.io.change_stream import ChangeFeed, _on_full_document
+from mongrations.misc.documents import Deletion
+from mongrations.misc.matching import matches
+
+
+class _Cursor:
+    def __init__(self, documents):
+        self._documents = documents
+
+    async def _iterate(self):
+        for document in self._documents:
+            yield document
+
+    def __aiter__(self):
+        return self._iterate()
+
+
+class _Collection:
+    def __init__(self, documents):
+        self.documents = documents
+        self.queries = list()
+
+    def find(self, query, projection=None):
+        self.queries.append(query)
+        return _Cursor([{"_id": document["_id"]} for document in self.documents if matches(document, query)])
+
+
+def _change(operation, document):
+    if operation == "delete":
+        return {"operationType": "delete", "documentKey": {"_id": document["_id"]}}
+    return {"operationType": operation, "fullDocument": document}
+
+
+def test_filter_moves_under_full_document():
+    assert _on_full_document({"a": 1, "$or": [{"b": {"$gt": 2}}, {"c": 3}]}) == {
+        "fullDocument.a": 1, "$or": [{"fullDocument.b": {"$gt": 2}}, {"fullDocument.c": 3}]
+    }
+    assert _on_full_document({"$expr": {"$gt": ["$a", 1]}}) is None
+
+
+def test_inserts_are_filtered_by_the_change_stream():
+    feed = ChangeFeed(_Collection([]), None, {"geometry": {"$geoWithin": {}}}, 10)
+    stages = feed._pipeline()
+    assert stages[0]["$match"]["$or"][1] == {"$and": [{"operationType": "insert"},
+                                                      {"fullDocument.geometry": {"$geoWithin": {}}}]}
+
+
+def test_updates_leaving_the_filter_become_deletions():
+    current = [{"_id": 1, "state": "active"}, {"_id": 2, "state": "archived"}]
+    collection = _Collection(current)
+    feed = ChangeFeed(collection, None, {"state": "active"}, 10)
+    items = asyncio.run(feed._to_items([
+        _change("insert", {"_id": 3, "state": "active"}),
+        _change("update", current[0]),
+        _change("update", current[1]),
+        _change("delete", {"_id": 4}),
+    ]))
+    assert items[0] == {"_id": 3, "state": "active"}
+    assert items[1] == current[0]
+    assert isinstance(items[2], Deletion) and items[2].document_id == 2
+    assert isinstance(items[3], Deletion) and items[3].document_id == 4
+    # Inserts were already filtered server side, only the updated documents are checked.
+    assert collection.queries == [{"$and": [{"_id": {"$in": [1, 2]}}, {"state": "active"}]}]
+
+
+def test_without_filter_nothing_is_checked():
+    collection = _Collection([])
+    feed = ChangeFeed(collection, None, None, 10)
+    items = asyncio.run(feed._to_items([_change("update", {"_id": 1}), _change("update", None)]))
+    assert items == [{"_id": 1}]
+    assert collection.queries == []
@@ -0,0 +1,65 @@
+import asyncio
+from pathlib import Path
+
+from mongrations.checkpoint import Checkpointer
+from mongrations.io.collection_destination import CollectionDestination, WriteMode
+from mongrations.io.pipe import Pipe
+from mongrations.io.segments import SegmentStore
+from mongrations.state import FileStateStore
+
+
+class _Phase:
+    def __init__(self, name, destination):
+        self._name = name
+        self._destination = destination
+
+    def name(self):
+        return self._name
+
+    def destination(self):
+        return self._destination
+
+    def source(self):
+        return None
+
+
+def _checkpointer(tmp_path):
+    return Checkpointer(FileStateStore(str(tmp_path / "state.json")), "test", 1.0)
+
+
+def test_group_is_skipped_once_every_phase_completed(tmp_path):
+    producer = _Phase("producer", Pipe())
+    consumer = _Phase("consumer", CollectionDestination("db", "target", mode=WriteMode.INSERT))
+    checkpointer = _checkpointer(tmp_path)
+    asyncio.run(checkpointer.complete(producer))
+    asyncio.run(checkpointer.complete(consumer))
+    assert asyncio.run(_checkpointer(tmp_path).restore([producer, consumer]))
+
+
+def test_group_runs_again_unless_every_phase_completed(tmp_path):
+    producer = _Phase("producer", Pipe())
+    consumer = _Phase("consumer", CollectionDestination("db", "target", mode=WriteMode.INSERT))
+    asyncio.run(_checkpointer(tmp_path).complete(consumer))
+    checkpointer = _checkpointer(tmp_path)
+    assert not asyncio.run(checkpointer.restore([producer, consumer]))
+    # The consumer already wrote its documents once, writing them again must not fail on their _id.
+    checkpointer.rewrite_modes(consumer)
+    assert consumer.destination().mode == WriteMode.REPLACE
+
+
+def test_phases_started_by_an_interrupted_run_write_idempotently(tmp_path):
+    temporary = _Phase("temporary", CollectionDestination("mongrations", "mongration-tmp-temporary",
+                                                          mode=WriteMode.INSERT, temporary=True))
+    asyncio.run(_checkpointer(tmp_path).restore([temporary]))
+    fresh = _checkpointer(tmp_path)
+    fresh.rewrite_modes(temporary)
+    assert temporary.destination().mode == WriteMode.INSERT
+    assert not asyncio.run(fresh.restore([temporary]))
+    fresh.rewrite_modes(temporary)
+    assert temporary.destination().mode == WriteMode.REPLACE
+
+
+def test_segment_writers_always_run_again(tmp_path):
+    writer = _Phase("writer", SegmentStore(Path(tmp_path), "writer"))
+    asyncio.run(_checkpointer(tmp_path).complete(writer))
+    assert not asyncio.run(_checkpointer(tmp_path).restore([writer]))
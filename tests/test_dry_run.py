@@ -0,0 +1,104 @@
+import asyncio
+
+from mongrations.dry_run import DryRun
+from mongrations.io.memory import MemoryCollection, MemorySource
+from mongrations.io.source import CollectionSource
+from mongrations.loading import load_mongration
+from mongrations.misc.matching import Restriction
+
+
+class _Database:
+    def __init__(self):
+        self.pipelines = list()
+
+    def aggregate(self, pipeline, batchSize=None):
+        self.pipelines.append(pipeline)
+
+        async def documents():
+            for document in pipeline[0]["$documents"]:
+                yield document
+
+        return documents()
+
+
+class _Client:
+    def __init__(self):
+        self.database = _Database()
+
+    def get_database(self, name):
+        return self.database
+
+
+async def _read(source, client=None):
+    batches, total = await source.batches(client, 2)
+    return [document async for batch in batches for document in batch], total
+
+
+def test_memory_source_filters_and_projects_locally():
+    memory = MemoryCollection("db", "out")
+    asyncio.run(memory.push_batch([{"_id": 1, "a": 1, "b": 1}, {"_id": 2, "a": 2, "b": 2}]))
+    source = MemorySource(memory)
+    source.restrict(Restriction(fields=["a"], where={"a": {"$gt": 1}}))
+    documents, total = asyncio.run(_read(source))
+    assert documents == [{"_id": 2, "a": 2}]
+    assert total == 2
+
+
+def test_memory_source_hands_server_only_operators_to_the_server():
+    memory = MemoryCollection("db", "out")
+    asyncio.run(memory.push_batch([{"_id": 1, "location": [0, 0]}]))
+    source = MemorySource(memory, {"location": {"$geoWithin": {"$center": [[0, 0], 1]}}})
+    client = _Client()
+    documents, _ = asyncio.run(_read(source, client))
+    assert documents == [{"_id": 1, "location": [0, 0]}]
+    assert client.database.pipelines[0][1] == {"$match": {"location": {"$geoWithin": {"$center": [[0, 0], 1]}}}}
+
+
+def _two_phases(mongration):
+    read = mongration.phase("Read")
+    read.from_collection("db", "input", filter={"kind": "a"})
+    read.use_python(lambda document: document)
+    write = mongration.phase("Write")
+    write.from_phase(read)
+    write.use_python(lambda document: document)
+    write.into_collection("db", "output")
+
+
+def test_scales_come_from_the_filtered_count():
+    _, graph = load_mongration(_two_phases, draw=False)
+    dry_run = DryRun(graph, 100)
+    dry_run.prepare()
+    for sources in dry_run._sampled.values():
+        for source in sources:
+            assert source.sample == 100
+            # count_documents of the filter, not the size of the whole collection.
+            source.full_count = 1000
+    scales = dry_run._scales()
+    assert all(scale == 10.0 for scale in scales.values())
+
+
+class _Counted:
+    async def count_documents(self, filter):
+        return 50
+
+    async def estimated_document_count(self, maxTimeMS=None):
+        return 5000
+
+
+class _CountingClient:
+    def get_database(self, name):
+        return self
+
+    def get_collection(self, name):
+        return _Counted()
+
+
+def test_sampled_filtered_sources_count_their_matches():
+    filtered = CollectionSource("db", "input", {"kind": "a"})
+    filtered.use_sample(10)
+    assert asyncio.run(filtered.estimate_total(_CountingClient())) == 10
+    assert filtered.full_count == 50
+    whole = CollectionSource("db", "input", None)
+    whole.use_sample(10)
+    asyncio.run(whole.estimate_total(_CountingClient()))
+    assert whole.full_count == 5000
@@ -0,0 +1,88 @@
+import asyncio
+
+from mongrations.engine.governor import ResourceGovernor, parse_size
+from mongrations.io.pipe import Pipe
+
+
+def test_budget_is_shared_by_every_account():
+    async def scenario():
+        governor = ResourceGovernor(memory_budget=100)
+        first, second = governor.account("first"), governor.account("second")
+        await first.acquire(80)
+        # The second account holds nothing yet, it still has to wait for the first one's bytes.
+        waiting = asyncio.create_task(second.acquire(40))
+        await asyncio.sleep(0)
+        assert not waiting.done()
+        await first.release(80)
+        await asyncio.wait_for(waiting, 1)
+        return governor, second
+
+    governor, second = asyncio.run(scenario())
+    assert governor.bytes_in_use == 40
+    assert second.waits == 1
+
+
+def test_oversized_request_runs_alone():
+    async def scenario():
+        governor = ResourceGovernor(memory_budget=100)
+        account = governor.account("phase")
+        await account.acquire(500)
+        return governor
+
+    assert asyncio.run(scenario()).peak_bytes == 500
+
+
+def test_pipe_charges_never_block_writes():
+    async def scenario():
+        governor = ResourceGovernor(memory_budget=100)
+        producer, consumer = governor.account("producer"), governor.account("consumer")
+        producer.charge(150)
+        # Only the consumer can drain what the producer charged, it must get its bytes.
+        await asyncio.wait_for(consumer.acquire(50), 1)
+        await producer.discharge(150)
+        return governor
+
+    assert asyncio.run(scenario()).bytes_in_use == 50
+
+
+def test_cursors_are_charged_one_at_a_time():
+    async def scenario():
+        governor = ResourceGovernor(cursor_budget=2)
+        first, second = governor.account("first"), governor.account("second")
+        await first.open_cursor()
+        await second.open_cursor()
+        waiting = asyncio.create_task(second.open_cursor())
+        await asyncio.sleep(0)
+        assert not waiting.done()
+        await first.close_cursor()
+        await asyncio.wait_for(waiting, 1)
+        return governor
+
+    assert asyncio.run(scenario()).cursors_in_use == 2
+
+
+def test_parse_size():
+    assert parse_size("512MiB") == 512 * 2 ** 20
+    assert parse_size("1.5g") == int(1.5 * 2 ** 30)
+    assert parse_size("1000") == 1000
+    assert parse_size(None) is None
+
+
+def test_pipes_are_bounded_by_their_share_of_the_budget():
+    async def scenario():
+        governor = ResourceGovernor(memory_budget=1000)
+        small, large = Pipe(capacity_bytes=100), Pipe()
+        governor.bound_pipes([small, large])
+        account = governor.account("phase")
+        await account.acquire(650)
+        # Writes only get what the pipes do not hold.
+        waiting = asyncio.create_task(account.acquire(1))
+        await asyncio.sleep(0)
+        assert not waiting.done()
+        await account.release(650)
+        await asyncio.wait_for(waiting, 1)
+        return governor, small, large
+
+    governor, small, large = asyncio.run(scenario())
+    assert (small.capacity_bytes, large.capacity_bytes) == (100, 250)
+    assert "2 pipes hold up to" in governor.report()[1]
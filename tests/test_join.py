@@ -0,0 +1,65 @@
+import asyncio
+
+import pytest
+
+from mongrations.operations.join_operation import HashJoin, _SortedInput, merge_join
+from mongrations.phase import Phase
+
+
+async def _batches(documents, size=2):
+    for start in range(0, len(documents), size):
+        yield documents[start:start + size]
+
+
+async def _collect(combinations):
+    return [combination async for combination in combinations]
+
+
+def _ids(combinations):
+    # Inputs a combination has no document from show up as -1.
+    return sorted(tuple(-1 if document is None else document["_id"] for document in combination)
+                  for combination in combinations)
+
+
+_LEFT = [{"_id": 1, "k": 1}, {"_id": 2, "k": 2}, {"_id": 3, "k": 2}, {"_id": 4, "k": 4}]
+_RIGHT = [{"_id": 10, "k": 2}, {"_id": 11, "k": 3}, {"_id": 12, "k": 4}]
+
+
+def test_merge_join_kinds():
+    def join(how):
+        inputs = [_SortedInput(0, _batches(_LEFT), "k"), _SortedInput(1, _batches(_RIGHT), "k")]
+        return _ids(asyncio.run(_collect(merge_join(inputs, how))))
+
+    assert join("inner") == [(2, 10), (3, 10), (4, 12)]
+    assert join("left") == [(1, -1), (2, 10), (3, 10), (4, 12)]
+    assert join("outer") == [(-1, 11), (1, -1), (2, 10), (3, 10), (4, 12)]
+
+
+def test_merge_join_rejects_unsorted_inputs():
+    inputs = [_SortedInput(0, _batches([{"k": 2}, {"k": 1}]), "k"), _SortedInput(1, _batches(_RIGHT), "k")]
+    with pytest.raises(Exception, match="not sorted"):
+        asyncio.run(_collect(merge_join(inputs, "inner")))
+
+
+@pytest.mark.parametrize("memory_limit", [2 ** 20, 1])
+def test_hash_join_matches_whether_it_spills_or_not(memory_limit):
+    join = HashJoin(["k", "k"], "outer", memory_limit, partitions=4)
+    combinations = asyncio.run(_collect(join.run([_batches(_LEFT), _batches(_RIGHT)])))
+    assert _ids(combinations) == [(-1, 11), (1, -1), (2, 10), (3, 10), (4, 12)]
+    assert (join.spilled_bytes > 0) == (memory_limit == 1)
+
+
+def test_merge_join_rejects_inputs_streamed_from_one_producer():
+    producer = Phase("producer")
+    producer.from_collection("db", "documents")
+    producer.use_python(lambda document: document)
+    evens, odds = Phase("evens"), Phase("odds")
+    for branch in (evens, odds):
+        branch.from_phase(producer)
+        branch.use_python(lambda document: document)
+    joined = Phase("joined")
+    joined.from_phase(evens)
+    joined.from_phase(odds)
+    joined.use_join(lambda left, right: left)
+    with pytest.raises(Exception, match="streamed from phase producer"):
+        asyncio.run(joined.operation()._read(None, joined))
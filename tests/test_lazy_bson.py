@@ -0,0 +1,70 @@
+import pickle
+
+import bson
+
+from mongrations.misc.lazy_bson import LazyDocument
+
+_DOCUMENT = {"_id": 1, "name": "a", "nested": {"x": 1, "y": [1, {"z": 2}]}, "tags": ["t"]}
+
+
+def _lazy(document=None):
+    return LazyDocument(bson.encode(_DOCUMENT if document is None else document))
+
+
+def test_unchanged_documents_keep_their_bytes():
+    document = _lazy()
+    assert document["name"] == "a"
+    assert document["nested"]["x"] == 1
+    assert not document.modified()
+    assert document.raw is document._data
+
+
+def test_changes_are_spliced_into_the_original_bytes():
+    document = _lazy()
+    document["name"] = "b"
+    document["nested"]["x"] = 2
+    del document["tags"]
+    document["added"] = True
+    assert bson.decode(document.raw) == {"_id": 1, "name": "b", "nested": {"x": 2, "y": [1, {"z": 2}]}, "added": True}
+    assert list(document) == ["_id", "name", "nested", "added"]
+    assert len(document) == 4
+
+
+def test_arrays_mutated_in_place_are_written_back():
+    document = _lazy()
+    document["tags"].append("u")
+    assert bson.decode(document.raw)["tags"] == ["t", "u"]
+
+
+def test_removed_keys_are_gone():
+    document = _lazy()
+    del document["name"]
+    assert "name" not in document
+    assert document.get("name") is None
+
+
+def test_copies_and_pickles_are_independent():
+    document = _lazy()
+    copy = document.copy()
+    copy["name"] = "c"
+    assert document["name"] == "a"
+    assert bson.decode(pickle.loads(pickle.dumps(copy)).raw)["name"] == "c"
+
+
+def test_spliced_bytes_are_reused_until_the_next_change():
+    document = _lazy()
+    document["name"] = "b"
+    spliced = document.raw
+    assert document.raw is spliced
+    document["nested"]["x"] = 3
+    assert bson.decode(document.raw)["nested"]["x"] == 3
+    document["name"] = "c"
+    assert bson.decode(document.raw)["name"] == "c"
+
+
+def test_documents_holding_mutable_values_are_spliced_every_time():
+    document = _lazy()
+    document["nested"]["y"].append(3)
+    assert bson.decode(document.raw)["nested"]["y"] == [1, {"z": 2}, 3]
+    document["nested"]["y"].append(4)
+    assert bson.decode(document.raw)["nested"]["y"] == [1, {"z": 2}, 3, 4]
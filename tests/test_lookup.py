@@ -0,0 +1,85 @@
+import asyncio
+import time
+
+import bson
+from bson.raw_bson import RawBSONDocument
+
+from mongrations.operations.lookup_operation import LookupCache, LookupOperation, _MISSING
+
+
+class _Cursor:
+    def __init__(self, documents):
+        self._documents = documents
+
+    async def _iterate(self):
+        for document in self._documents:
+            yield document
+
+    def __aiter__(self):
+        return self._iterate()
+
+
+class _Collection:
+    def __init__(self, documents):
+        self.documents = documents
+        self.queries = list()
+
+    def with_options(self, codec_options):
+        return self
+
+    def find(self, query, projection=None):
+        field, condition = next(iter(query.items()))
+        self.queries.append(condition["$in"])
+        return _Cursor([RawBSONDocument(bson.encode(document)) for document in self.documents
+                        if document[field] in condition["$in"]])
+
+
+async def _batches(*batches):
+    for batch in batches:
+        yield batch
+
+
+def test_cache_evicts_least_recently_used_keys():
+    cache = LookupCache(capacity=2)
+    cache.put("a", 1)
+    cache.put("b", 2)
+    assert cache.get("a") == 1
+    cache.put("c", 3)
+    assert cache.get("b") is _MISSING
+    assert (len(cache), cache.hits, cache.misses, cache.evictions) == (2, 1, 1, 1)
+
+
+def test_cache_expires_entries_past_their_ttl():
+    cache = LookupCache(ttl=0.01)
+    cache.put("a", 1)
+    time.sleep(0.02)
+    assert cache.get("a") is _MISSING
+
+
+def test_lookup_queries_every_key_once_and_decodes_private_copies():
+    lookup = LookupOperation("db", "countries", "country", "code", into="details")
+    countries = _Collection([{"_id": 1, "code": "fr", "name": "France"}])
+    documents = [{"_id": 1, "country": "fr"}, {"_id": 2, "country": "fr"}, {"_id": 3, "country": "xx"}]
+
+    async def scenario():
+        enriched = lookup._enrich(countries, _batches(documents[:2], documents[2:]))
+        return [batch async for batch in enriched]
+
+    asyncio.run(scenario())
+    assert countries.queries == [["fr"], ["xx"]]
+    assert documents[0]["details"] == {"_id": 1, "code": "fr", "name": "France"}
+    assert documents[0]["details"] is not documents[1]["details"]
+    assert documents[2]["details"] is None
+
+
+def test_lookup_tells_booleans_from_integers():
+    lookup = LookupOperation("db", "flags", "flag", "value", many=True)
+    flags = _Collection([{"_id": 1, "value": 1}, {"_id": 2, "value": True}])
+    documents = [{"_id": 1, "flag": True}, {"_id": 2, "flag": 1}]
+
+    async def scenario():
+        return [batch async for batch in lookup._enrich(flags, _batches(documents))]
+
+    asyncio.run(scenario())
+    assert [match["_id"] for match in documents[0]["flags"]] == [2]
+    assert [match["_id"] for match in documents[1]["flags"]] == [1]
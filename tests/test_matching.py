@@ -0,0 +1,66 @@
+import re
+
+import pytest
+from bson.regex import Regex
+
+from mongrations.misc.documents import Deletion
+from mongrations.misc.matching import Restriction, matches, project, validate_query
+
+
+def test_equality_and_comparisons():
+    document = {"a": 5, "b": {"c": "x"}, "tags": ["red", "blue"]}
+    assert matches(document, {"a": 5, "b.c": "x"})
+    assert not matches(document, {"a": 6})
+    assert matches(document, {"a": {"$gt": 4, "$lte": 5}})
+    assert not matches(document, {"a": {"$lt": 5}})
+    assert matches(document, {"a": {"$in": [1, 5]}, "b.c": {"$nin": ["y"]}})
+    assert matches(document, {"tags": "red"})
+    assert matches(document, {"missing": None})
+    assert matches(document, {"missing": {"$exists": False}, "a": {"$exists": True}})
+
+
+def test_mismatched_types_never_compare():
+    assert not matches({"a": "5"}, {"a": {"$gt": 4}})
+    assert not matches({"a": None}, {"a": {"$gte": 0}})
+
+
+def test_logical_operators():
+    document = {"a": 1, "b": 2}
+    assert matches(document, {"$or": [{"a": 2}, {"b": 2}]})
+    assert not matches(document, {"$and": [{"a": 1}, {"b": 3}]})
+    assert not matches(document, {"$nor": [{"a": 1}]})
+    assert matches(document, {"a": {"$not": {"$gt": 1}}})
+
+
+def test_regexes():
+    assert matches({"n": "abc"}, {"n": re.compile("^a")})
+    assert matches({"n": "abc"}, {"n": Regex("B", "i")})
+    assert matches({"n": ["x", "Ab"]}, {"n": {"$regex": "^a", "$options": "i"}})
+    assert not matches({"n": 1}, {"n": {"$regex": "1"}})
+    assert not matches({"n": "abc"}, {"n": {"$not": re.compile("^a")}})
+    assert matches({"n": "bcd"}, {"n": {"$not": re.compile("^a")}})
+
+
+def test_validation_rejects_what_only_the_server_evaluates():
+    validate_query({"n": {"$not": re.compile("^a")}, "a": {"$regex": "x", "$options": "i"}})
+    with pytest.raises(Exception):
+        validate_query({"geometry": {"$geoWithin": {}}})
+    with pytest.raises(Exception):
+        validate_query({"$where": "this.a > 1"})
+    with pytest.raises(Exception):
+        validate_query({"a": {"$not": 3}})
+    with pytest.raises(Exception):
+        validate_query({"a": {"$options": "i"}})
+
+
+def test_project_keeps_nested_paths():
+    document = {"_id": 1, "a": {"b": 1, "c": 2}, "d": 3}
+    assert project(document, ["_id", "a.b", "missing"]) == {"_id": 1, "a": {"b": 1}}
+
+
+def test_restriction_lets_deletions_through():
+    restriction = Restriction(fields=["a"], where={"a": {"$gt": 1}})
+    deletion = Deletion(3)
+    batch = restriction.apply([{"_id": 1, "a": 1}, {"_id": 2, "a": 2, "b": 0}, deletion])
+    assert batch == [{"_id": 2, "a": 2}, deletion]
+    assert restriction.projection() == {"_id": 1, "a": 1}
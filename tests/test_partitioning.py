@@ -0,0 +1,51 @@
+from mongrations.io.partitioning import combine_filters, partition_filters, partition_ranges, range_filter
+from mongrations.io.source import CollectionSource, PartitionBatch
+from mongrations.misc.matching import matches
+
+
+def test_ranges_are_open_ended():
+    assert partition_ranges([]) == [(None, None)]
+    assert partition_ranges([10, 20]) == [(None, 10), (10, 20), (20, None)]
+    assert range_filter("_id", None, None) is None
+    assert range_filter("_id", 10, 20) == {"_id": {"$gte": 10, "$lt": 20}}
+
+
+def test_unsplit_collection_is_read_whole():
+    assert partition_filters("_id", []) == [None]
+
+
+def test_every_document_falls_in_exactly_one_partition():
+    filters = partition_filters("k", [10, 20])
+    assert len(filters) == 4
+    documents = [{"k": 5}, {"k": 10}, {"k": 25}, {"k": None}, {}, {"k": "text"}, {"k": 1.5}]
+    for document in documents:
+        matched = [number for number, bounds in enumerate(filters) if matches(document, bounds)]
+        assert len(matched) == 1, document
+    assert matches({"k": "text"}, filters[-1])
+    assert matches({}, filters[-1])
+    assert not matches({"k": 15}, filters[-1])
+
+
+def test_combine_filters_drops_empty_ones():
+    assert combine_filters(None, {}) is None
+    assert combine_filters({"a": 1}, None) == {"a": 1}
+    assert combine_filters({"a": 1}, {"b": 2}) == {"$and": [{"a": 1}, {"b": 2}]}
+
+
+def test_resume_keeps_documents_sharing_the_last_key():
+    source = CollectionSource("db", "collection", None, partition_key="group")
+    source.resume(None)
+    source._boundaries = []
+    documents = [{"_id": index, "group": index // 3} for index in range(9)]
+    source.acknowledge(PartitionBatch(0, documents[:4]))
+    position = source.checkpoint_state()["positions"][0][1]
+    remaining = [document["_id"] for document in documents if matches(document, source._after(position))]
+    assert remaining == [4, 5, 6, 7, 8]
+
+
+def test_resume_on_id_compares_the_id_alone():
+    source = CollectionSource("db", "collection", None)
+    source.resume(None)
+    source._boundaries = []
+    source.acknowledge(PartitionBatch(0, [{"_id": 1}, {"_id": 2}]))
+    assert source._after(source.checkpoint_state()["positions"][0][1]) == {"_id": {"$gt": 2}}
@@ -0,0 +1,62 @@
+import asyncio
+
+from mongrations.io.pipe import Pipe
+from mongrations.misc.matching import Restriction
+
+
+async def _drain(pipe):
+    batches, _ = await pipe.batches(None, 10)
+    return [batch async for batch in batches]
+
+
+def test_producer_waits_for_room():
+    async def scenario():
+        pipe = Pipe(capacity=3)
+        await pipe.push_batch([1, 2])
+        blocked = asyncio.create_task(pipe.push_batch([3, 4]))
+        await asyncio.sleep(0)
+        assert not blocked.done()
+        pipe.hint_total(4)
+        batches, total = await pipe.batches(None, 10)
+        iterator = batches.__aiter__()
+        first = await iterator.__anext__()
+        await asyncio.wait_for(blocked, 1)
+        await pipe.close()
+        return total, [first] + [batch async for batch in iterator]
+
+    total, batches = asyncio.run(scenario())
+    assert total == 4
+    # Chunks come out exactly as they were pushed.
+    assert batches == [[1, 2], [3, 4]]
+
+
+def test_oversized_chunk_enters_an_empty_pipe():
+    async def scenario():
+        pipe = Pipe(capacity=2)
+        await asyncio.wait_for(pipe.push_batch([1, 2, 3, 4]), 1)
+        await pipe.close()
+        return await _drain(pipe)
+
+    assert asyncio.run(scenario()) == [[1, 2, 3, 4]]
+
+
+def test_byte_capacity_applies_backpressure():
+    async def scenario():
+        pipe = Pipe(capacity=None, capacity_bytes=64)
+        await pipe.push_batch([{"payload": "x" * 40}])
+        blocked = asyncio.create_task(pipe.push_batch([{"payload": "y" * 40}]))
+        await asyncio.sleep(0)
+        return blocked.done()
+
+    assert not asyncio.run(scenario())
+
+
+def test_restriction_filters_and_projects_entering_documents():
+    async def scenario():
+        pipe = Pipe()
+        pipe.restrict(Restriction(["a"], {"b": {"$gt": 1}}))
+        await pipe.push_batch([{"_id": 1, "a": 1, "b": 1}, {"_id": 2, "a": 2, "b": 2}])
+        await pipe.close()
+        return await _drain(pipe)
+
+    assert asyncio.run(scenario()) == [[{"_id": 2, "a": 2}]]
@@ -0,0 +1,43 @@
+from mongrations.loading import load_mongration
+
+
+def _chains(mongration, count):
+    for index in range(count):
+        first = mongration.phase(f"first {index}")
+        first.from_collection("db", f"input {index}")
+        first.use_python(lambda document: document)
+        second = mongration.phase(f"second {index}")
+        second.from_phase(first)
+        second.use_python(lambda document: document)
+        second.into_collection("db", f"output {index}")
+        reader = mongration.phase(f"reader {index}")
+        reader.from_phase(second)
+        reader.use_aggregation([])
+        reader.into_collection("db", f"copy {index}")
+
+
+def test_dependants_read_from_the_fused_chain():
+    _, graph = load_mongration(lambda mongration: _chains(mongration, 3), draw=False)
+    phases = {graph[index].name(): graph[index] for index in graph.all_indices()}
+    assert len(phases) == 6
+    for index in range(3):
+        fused = phases[f"first {index} -> second {index}"]
+        assert phases[f"reader {index}"].dependencies() == [fused]
+
+
+def test_outputs_read_by_a_dependant_are_kept_when_another_is_added():
+    def build(mongration):
+        source = mongration.phase("source")
+        source.from_collection("db", "input")
+        source.use_python(lambda document: document)
+        reader = mongration.phase("reader")
+        reader.from_phase(source)
+        reader.use_aggregation([])
+        reader.into_collection("db", "copy")
+        source.into_collection("db", "output")
+
+    _, graph = load_mongration(build, draw=False)
+    phases = {graph[index].name(): graph[index] for index in graph.all_indices()}
+    branches = phases["source"].destination().branches()
+    # The aggregation reads the temporary collection it was configured with, which still has to be written.
+    assert [str(branch) for branch in branches] == ["mongrations/mongration-tmp-source", "db/output"]
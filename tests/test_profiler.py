@@ -0,0 +1,37 @@
+import sys
+
+from mongrations.engine.profiler import Profiler
+
+
+class _Operation:
+    def sample(self, profiler):
+        profiler._record(sys._getframe(), True)
+
+
+class _Phase:
+    def __init__(self):
+        self._operation = _Operation()
+
+    def name(self):
+        return "phase"
+
+    def operation(self):
+        return self._operation
+
+    def destination(self):
+        return None
+
+
+def test_samples_are_symbolized_once_the_run_stops():
+    profiler = Profiler()
+    phase = _Phase()
+    profile = profiler.phase(phase)
+    for _ in range(3):
+        phase.operation().sample(profiler)
+    profiler._record(sys._getframe(), True)
+    assert len(profile.stacks) == 0
+    profiler.stop()
+    # Frames of the operation's methods attribute the sample to its phase, the others go to the engine.
+    assert profile.samples["engine"] == 3
+    assert all(stack.endswith("sample (test_profiler.py:7)") for stack in profile.stacks)
+    assert sum(profiler._engine.samples.values()) == 1
@@ -0,0 +1,82 @@
+import asyncio
+
+import pytest
+
+from mongrations.engine.scheduler import PhaseScheduler
+from mongrations.graph import DependencyGraph
+from mongrations.io.collection_destination import CollectionDestination
+from mongrations.io.pipe import Pipe
+
+
+class _Phase:
+    def __init__(self, name, destination=None, sources=()):
+        self.name = name
+        self._destination = destination
+        self._sources = list(sources)
+
+    def destination(self):
+        return self._destination
+
+    def sources(self):
+        return self._sources
+
+
+def _graph(phases, dependencies):
+    graph = DependencyGraph()
+    indices = {phase.name: graph.add(phase) for phase in phases}
+    for dependant, dependency in dependencies:
+        graph.add_dependency(indices[dependant], indices[dependency])
+    return graph, indices
+
+
+def _streaming_graph():
+    # a streams into b, c reads the collection b writes.
+    pipe = Pipe()
+    a = _Phase("a", pipe)
+    b = _Phase("b", CollectionDestination("db", "b"), [pipe])
+    c = _Phase("c", CollectionDestination("db", "c"))
+    return _graph([a, b, c], [("b", "a"), ("c", "b")])
+
+
+def test_phases_joined_by_a_pipe_form_one_group():
+    graph, indices = _streaming_graph()
+    groups = sorted(sorted(graph[index].name for index in group) for group in PhaseScheduler(graph).groups())
+    assert groups == [["a", "b"], ["c"]]
+
+
+def test_groups_start_once_their_dependencies_completed():
+    graph, indices = _streaming_graph()
+    events = list()
+
+    async def start(index):
+        events.append(f"start {graph[index].name}")
+        await asyncio.sleep(0)
+        events.append(f"end {graph[index].name}")
+
+    asyncio.run(PhaseScheduler(graph).run(start))
+    # The pipe's ends run at the same time, the phase reading b's collection waits for both.
+    assert events.index("start b") < events.index("end a")
+    assert events.index("start c") > max(events.index("end a"), events.index("end b"))
+
+
+def test_concurrency_limit_holds_independent_groups_back():
+    phases = [_Phase(name, CollectionDestination("db", name)) for name in "abc"]
+    graph, _ = _graph(phases, [])
+    running, peak = 0, 0
+
+    async def start(index):
+        nonlocal running, peak
+        running += 1
+        peak = max(peak, running)
+        await asyncio.sleep(0)
+        running -= 1
+
+    asyncio.run(PhaseScheduler(graph, max_concurrent=2).run(start))
+    assert peak == 2
+
+
+def test_cycles_are_rejected():
+    a, b = _Phase("a", CollectionDestination("db", "a")), _Phase("b", CollectionDestination("db", "b"))
+    graph, _ = _graph([a, b], [("a", "b"), ("b", "a")])
+    with pytest.raises(Exception, match="cyclic"):
+        PhaseScheduler(graph)
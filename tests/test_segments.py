@@ -0,0 +1,67 @@
+import asyncio
+
+import bson
+
+from mongrations.io.segments import SegmentSource, SegmentStore
+from mongrations.misc.documents import Deletion
+from mongrations.misc.lazy_bson import LazyDocument
+from mongrations.misc.matching import Restriction
+
+
+async def _write(store, batches):
+    store.init(None)
+    for batch in batches:
+        await store.push_batch(batch)
+    await store.close()
+
+
+async def _read(source, batch_size=2):
+    batches, total = await source.batches(None, batch_size)
+    return [batch async for batch in batches], total
+
+
+def _documents(count):
+    return [{"_id": index, "value": index % 3, "payload": "x" * 16} for index in range(count)]
+
+
+def test_documents_roll_over_segments_and_read_back_in_order(tmp_path):
+    store = SegmentStore(tmp_path, "phase", segment_size=100)
+    asyncio.run(_write(store, [_documents(3) + [Deletion(9)], _documents(5)[3:]]))
+    assert store.segment_count == len(store.segments()) > 1
+    batches, total = asyncio.run(_read(SegmentSource(store)))
+    assert total == 5
+    assert [document["_id"] for batch in batches for document in batch] == [0, 1, 2, 3, 4]
+    assert all(len(batch) <= 2 for batch in batches)
+
+
+def test_filters_and_projections_apply_locally(tmp_path):
+    store = SegmentStore(tmp_path, "phase")
+    asyncio.run(_write(store, [_documents(6)]))
+    source = SegmentSource(store)
+    source.restrict(Restriction(["value"], {"value": 1}))
+    batches, _ = asyncio.run(_read(source, 10))
+    assert batches == [[{"_id": 1, "value": 1}, {"_id": 4, "value": 1}]]
+
+
+def test_raw_stores_hand_out_lazy_documents(tmp_path):
+    store = SegmentStore(tmp_path, "phase", raw=True)
+    raw = LazyDocument(bson.encode({"_id": 1, "value": 2}))
+    asyncio.run(_write(store, [[raw]]))
+    batches, _ = asyncio.run(_read(SegmentSource(store)))
+    assert isinstance(batches[0][0], LazyDocument)
+    assert batches[0][0].raw == raw.raw
+
+
+def test_every_run_writes_into_a_directory_of_its_own(tmp_path):
+    first, second = SegmentStore(tmp_path, "phase"), SegmentStore(tmp_path, "phase")
+    first.use_namespace("ns")
+    second.use_namespace("ns")
+    asyncio.run(_write(first, [_documents(1)]))
+    asyncio.run(_write(second, [_documents(1)]))
+    assert first.directory != second.directory
+    assert first.directory.name.startswith("ns-phase-")
+    directory = first.directory
+    first.discard()
+    assert not directory.exists()
+    assert second.directory.exists()
+    assert asyncio.run(_read(SegmentSource(first)))[1] is None
@@ -0,0 +1,63 @@
+import asyncio
+
+from mongrations.io.destination import Destination
+from mongrations.io.pipe import Pipe
+from mongrations.io.tee import Tee
+from mongrations.misc.documents import Deletion
+
+
+class _Buffer(Destination):
+    # Holds on to the pushed documents like the write buffer of a collection does.
+    def __init__(self):
+        self.items = list()
+
+    async def push_batch(self, items: list):
+        self.items.extend(items)
+
+
+async def _drain(pipe):
+    batches, _ = await pipe.batches(None, 10)
+    return [item async for batch in batches for item in batch]
+
+
+def test_pipe_branches_get_copies_when_a_collection_also_reads():
+    async def scenario():
+        pipe, buffer = Pipe(), _Buffer()
+        tee = Tee([buffer, pipe])
+        await tee.push_batch([{"_id": 1, "value": 1}, Deletion(2)])
+        await tee.close()
+        items = await _drain(pipe)
+        # A python consumer changing its document in place must not touch the one waiting to be written.
+        items[0]["value"] = 2
+        return buffer.items, items
+
+    buffered, piped = asyncio.run(scenario())
+    assert buffered[0] == {"_id": 1, "value": 1}
+    assert piped[0] == {"_id": 1, "value": 2}
+    assert piped[1] is buffered[1]
+
+
+def test_only_the_first_of_several_pipes_keeps_the_originals():
+    async def scenario():
+        first, second = Pipe(), Pipe()
+        document = {"_id": 1}
+        tee = Tee.of(first, second)
+        await tee.push_batch([document])
+        await tee.close()
+        return document, await _drain(first), await _drain(second)
+
+    document, first, second = asyncio.run(scenario())
+    assert first[0] is document
+    assert second[0] == document and second[0] is not document
+
+
+def test_every_branch_must_accept_a_batch():
+    async def scenario():
+        full, empty = Pipe(capacity=1), Pipe()
+        await full.push_batch([{"_id": 0}])
+        tee = Tee([full, empty])
+        blocked = asyncio.create_task(tee.push_batch([{"_id": 1}]))
+        await asyncio.sleep(0)
+        return blocked.done()
+
+    assert not asyncio.run(scenario())